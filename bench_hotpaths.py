@@ -0,0 +1,156 @@
+"""
+Microbenchmarks das funções puras do caminho quente (sem banco de dados).
+
+    python bench_hotpaths.py                    # compara com bench_baseline.json
+    python bench_hotpaths.py --threshold 0.5    # tolera até 50% de piora
+    python bench_hotpaths.py --update-baseline  # grava os números atuais como baseline
+
+Cada caso é medido como o melhor tempo por chamada entre várias repetições, intercaladas
+com um laço de calibração; o resultado é a razão entre os dois, para que o baseline gravado
+em uma máquina continue comparável em outra (e com a CPU ocupada por outros processos).
+Sai com código 1 se algum caso piorar além do limite.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+
+# o módulo só abre o pool na primeira consulta; importar não conecta ao banco
+os.environ.setdefault("DATABASE_URL", "postgresql://bench@localhost/bench")
+import shortner
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+REPEAT = 40         # muitas amostras curtas: o mínimo descarta interferência de outros processos
+MIN_SECONDS = 0.005  # duração mínima de cada amostra
+
+def _calibration():
+    # mesmo tipo de trabalho dos casos (dict, str, chamadas), para acompanhar a máquina do mesmo jeito
+    seen = {}
+    for i in range(200):
+        key = str(i)
+        seen[key] = seen.get(key, 0) + len(key.split("1"))
+    return seen
+
+def _handler_with_cookie(cookie):
+    h = shortner.ShortenerHandler.__new__(shortner.ShortenerHandler)  # sem socket
+    h.headers = {"Cookie": cookie}
+    return h
+
+def _cases():
+    targets = [
+        {"id": i, "url": f"https://wa.me/55119999{i:05d}", "weight": float(w), "hits": 10 * i}
+        for i, w in enumerate([5, 3, 1, 1, 0, 2, 4, 1])
+    ]
+    cookie_handler = _handler_with_cookie("_ga=GA1.2.3; theme=dark; vid=Zx81kq0PaL2; session=" + "a" * 64)
+    entries = []
+    for i in range(200):
+        if i % 3:
+            entries.append({"code": f"c{i}", "type": "single", "url": f"https://example.com/p/{i}", "hits": i})
+        else:
+            entries.append({"code": f"m{i}", "type": "multi", "hits": 3 * i, "targets": targets[:4]})
+    swrr = shortner.SmoothWRR([t["weight"] for t in targets])
+    ring = shortner.HashRing(targets)
+    topk = shortner.SpaceSaving(256)
+    hot = [f"c{i % 300}" for i in range(997)]  # mais códigos que contadores: exercita a troca do menor
+    hot_iter = iter(hot * 10**4)
+    cache = shortner.LinkCache(1024, 3600)
+    cache.put("promo", {"type": "single", "url": "https://example.com", "cache_max_age": None})
+
+    return {
+        "base62_encode": lambda: shortner.base62_encode(56_800_235_583),
+        "validate_slug_path": lambda: shortner.validate_slug_path("PromocaoMercadoPago/Whats/abc-123"),
+        "validate_slug_path_reserved": lambda: shortner.validate_slug_path("promo/list"),
+        "get_cookie": lambda: cookie_handler.get_cookie("session"),
+        "weighted_random": lambda: shortner.weighted_random(targets),
+        "sticky_ring_lookup": lambda: ring.lookup("203.0.113.9|Mozilla/5.0"),
+        "swrr_next": swrr.next,
+        "format_list_lines_200": lambda: shortner.format_list_lines(entries),
+        "topk_record": lambda: topk.record(next(hot_iter)),
+        "link_cache_get": lambda: cache.get("promo"),
+    }
+
+def _timer(fn):
+    timer = timeit.Timer(fn)
+    number = 1
+    while timer.timeit(number) < MIN_SECONDS:
+        number *= 2
+    return timer, number
+
+def _relative_cost(fn) -> float:
+    """Melhor tempo do caso / melhor tempo da calibração, medidos alternadamente."""
+    case, n_case = _timer(fn)
+    calib, n_calib = _timer(_calibration)
+    best_case = best_calib = float("inf")
+    for _ in range(REPEAT):
+        best_case = min(best_case, case.timeit(n_case) / n_case)
+        best_calib = min(best_calib, calib.timeit(n_calib) / n_calib)
+    return best_case / best_calib
+
+def measure(only=None) -> dict:
+    """{"results": {caso: custo relativo à calibração}, "calibration_ns": referência da máquina}."""
+    calib, n_calib = _timer(_calibration)
+    calib_ns = min(calib.repeat(repeat=REPEAT, number=n_calib)) / n_calib * 1e9
+    results = {}
+    for name, fn in _cases().items():
+        if only and name not in only:
+            continue
+        results[name] = _relative_cost(fn)
+    return {"calibration_ns": calib_ns, "results": results}
+
+def remeasure(name) -> float:
+    return _relative_cost(_cases()[name])
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--threshold", type=float, default=float(os.getenv("BENCH_THRESHOLD", "0.3")),
+                    help="piora relativa tolerada (0.3 = 30%%)")
+    ap.add_argument("--baseline", default=BASELINE_PATH)
+    ap.add_argument("--update-baseline", action="store_true")
+    ap.add_argument("--only", nargs="*", help="nomes dos casos a medir")
+    args = ap.parse_args(argv)
+
+    current = measure(args.only)
+    if args.update_baseline:
+        current["python"] = platform.python_version()
+        current["machine"] = platform.machine()
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+            f.write("\n")
+        for name, rel in current["results"].items():
+            print(f"{name:32s} {rel * current['calibration_ns']:12.1f} ns")
+        print(f"Baseline gravado em {args.baseline}.")
+        return 0
+
+    try:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print(f"Sem baseline em {args.baseline}; rode com --update-baseline.")
+        return 1
+
+    # tempos em ns desta máquina; a comparação usa só os custos relativos
+    unit = current["calibration_ns"]
+    failed = []
+    print(f"{'caso':32s} {'baseline':>12s} {'atual':>12s} {'variação':>9s}")
+    for name, rel in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            print(f"{name:32s} {'-':>12s} {rel * unit:10.1f}ns {'novo':>9s}")
+            continue
+        if rel / base - 1 > args.threshold:
+            rel = min(rel, remeasure(name))  # confirma antes de acusar: uma amostra ruidosa não reprova
+        change = rel / base - 1
+        flag = ""
+        if change > args.threshold:
+            failed.append(name)
+            flag = "  <-- regressão"
+        print(f"{name:32s} {base * unit:10.1f}ns {rel * unit:10.1f}ns {change:+8.1%}{flag}")
+    if failed:
+        print(f"Regressão acima de {args.threshold:.0%}: {', '.join(failed)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,31 +4,228 @@ import http.server
 from socketserver import ThreadingTCPServer
 import urllib.parse
 import os
+import sys
+import gzip
+import csv
+import fcntl
+import io
 import time
 import random
 import re
 import json
 import hmac
 import hashlib
-from datetime import datetime, timedelta
+import threading
+import queue
+import bisect
+import heapq
+import functools
+import itertools
+import mmap
+import struct
+import shutil
+import tempfile
+import zlib
+import weakref
+from collections import OrderedDict, deque
+from contextlib import contextmanager, ExitStack
+from datetime import datetime, timedelta, timezone
 
 import psycopg
 from psycopg.rows import dict_row
-from psycopg_pool import ConnectionPool
+from psycopg_pool import ConnectionPool, PoolTimeout
 
 # -------------------- Config --------------------
 HOST = "0.0.0.0"
 PORT = int(os.getenv("PORT", "8000"))  # Render define PORT automaticamente
 DATABASE_URL = os.getenv("DATABASE_URL")  # defina no Render (Internal Database URL)
 
+# Réplica de leitura opcional (get/list/stats e a consulta do redirect). Escritas e hits
+# ficam no primário. Sem réplica saudável ou com atraso acima do tolerado, lê do primário.
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL")
+READ_POOL_MAX = int(os.getenv("READ_POOL_MAX", "20"))
+READ_MAX_STALENESS_SECONDS = float(os.getenv("READ_MAX_STALENESS_SECONDS", "5"))
+READ_LAG_CHECK_SECONDS = float(os.getenv("READ_LAG_CHECK_SECONDS", "2"))
+READ_CHECKOUT_TIMEOUT = float(os.getenv("READ_CHECKOUT_TIMEOUT", "1"))
+READ_RETRY_SECONDS = float(os.getenv("READ_RETRY_SECONDS", "10"))  # pausa após falha na réplica
+
 ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
-RESERVED = {"new", "list", "stats", "help", "index.html", "get", "update", "delete", "login", "logout"}
+RESERVED = {"new", "list", "stats", "help", "index.html", "get", "update", "delete", "login", "logout",
+            "register", "metrics", "bulk", "events", "search", "export", "top", "qr"}
 
 ADMIN_USER = os.getenv("ADMIN_USER", "admin")
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD")  # se None, geramos e exibimos nos logs
 SESSION_TTL_HOURS = int(os.getenv("SESSION_TTL_HOURS", "12"))
 COOKIE_SECURE = os.getenv("COOKIE_SECURE", "true").lower() == "true"
 
+# Escritas em lote: prepared statements (desligue atrás de PgBouncer em modo transaction)
+# e COPY para listas grandes de destinos.
+DB_PREPARE = os.getenv("DB_PREPARE", "true").lower() == "true"
+TARGETS_COPY_MIN = int(os.getenv("TARGETS_COPY_MIN", "50"))
+
+# Distribuição de destinos MULTI por link: "random" (sorteio ponderado a cada clique),
+# "sticky" (mesmo visitante -> mesmo destino, via anel de hash consistente ponderado) ou
+# "swrr" (round-robin ponderado suave em memória, sem rajadas no mesmo destino)
+DISTRIBUTIONS = ("random", "sticky", "swrr")
+VISITOR_COOKIE = "vid"
+STICKY_VNODES = int(os.getenv("STICKY_VNODES", "64"))          # pontos no anel por unidade de peso
+STICKY_MAX_VNODES = int(os.getenv("STICKY_MAX_VNODES", "2048"))  # teto por destino
+STICKY_RING_CACHE = int(os.getenv("STICKY_RING_CACHE", "1024"))  # anéis mantidos em memória (LRU)
+SWRR_STATE_CACHE = int(os.getenv("SWRR_STATE_CACHE", "4096"))    # links "swrr" com estado em memória (LRU)
+SWRR_RECONCILE_SECONDS = int(os.getenv("SWRR_RECONCILE_SECONDS", "300"))  # 0 = só ao criar o estado
+
+# Redirects cacheáveis (opt-in por link SINGLE via cache_max_age): 301 ou 308 com
+# Cache-Control público. CACHE_HIT_SOURCE define como os hits desses links são contados:
+# "sample" = origem conta 1 em CACHE_HIT_SAMPLE_RATE acessos (somando N; só vê o que o
+# cache não absorveu); "cdnlog" = origem não conta, hits vêm de import_cdn_log().
+CACHE_REDIRECT_STATUS = int(os.getenv("CACHE_REDIRECT_STATUS", "301"))
+CACHE_HIT_SOURCE = os.getenv("CACHE_HIT_SOURCE", "sample").lower()
+CACHE_HIT_SAMPLE_RATE = max(1, int(os.getenv("CACHE_HIT_SAMPLE_RATE", "10")))
+CACHE_MAX_AGE_LIMIT = 31_536_000  # 1 ano
+
+# Expiração por link (expires_at) + arquivador em background que move links expirados
+# (e, se ARCHIVE_IDLE_DAYS > 0, os sem cliques há N dias) para urls_archive em lotes. Links
+# cacheáveis só entram na regra de ociosidade com CACHE_HIT_SOURCE=cdnlog: com amostragem a
+# origem quase não os vê e last_hit_at não reflete os cliques servidos pelo CDN.
+ARCHIVE_INTERVAL_SECONDS = int(os.getenv("ARCHIVE_INTERVAL_SECONDS", "300"))  # 0 = desligado
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", "500"))
+ARCHIVE_IDLE_DAYS = int(os.getenv("ARCHIVE_IDLE_DAYS", "0"))
+GONE_CACHE_MAX = int(os.getenv("GONE_CACHE_MAX", "100000"))  # códigos expirados respondidos com 410 da memória
+# Validade vista pelo redirect vale como atalho para o 410 só por estes segundos; depois o banco
+# confirma (outro processo pode ter estendido ou removido o expires_at).
+EXPIRY_HINT_SECONDS = float(os.getenv("EXPIRY_HINT_SECONDS", "30"))
+
+def _env_map(name: str, default: str) -> dict[str, float]:
+    """Lê variáveis no formato "redirect=16,api=6,auth=4"."""
+    out = {}
+    for item in os.getenv(name, default).split(","):
+        if "=" in item:
+            k, v = item.split("=", 1)
+            out[k.strip()] = float(v)
+    return out
+
+# Backpressure por classe de rota (redirect / api / auth / stream): concorrência máxima, fila
+# limitada com espera máxima e statement_timeout; acima disso, 503 com Retry-After.
+# "stream" são as conexões longas de GET /events (uma thread cada, sem fila).
+ADMISSION_CONCURRENCY = _env_map("ADMISSION_CONCURRENCY", "redirect=16,api=6,auth=4,stream=32")
+ADMISSION_QUEUE = _env_map("ADMISSION_QUEUE", "redirect=64,api=16,auth=8,stream=0")
+ADMISSION_WAIT_SECONDS = _env_map("ADMISSION_WAIT_SECONDS", "redirect=0.5,api=2,auth=2,stream=0")
+STATEMENT_TIMEOUT_MS = _env_map("STATEMENT_TIMEOUT_MS", "redirect=1000,api=10000,auth=5000,stream=1000")
+DB_CHECKOUT_TIMEOUT = float(os.getenv("DB_CHECKOUT_TIMEOUT", "2"))  # espera máxima por conexão do pool
+# Um pool de conexões por classe de rota (bulkhead): um /list lento ou uma rajada de logins não
+# tomam as conexões do redirect. "background" atende os jobs internos (sem rota). O pool só
+# abre conexões sob demanda; o start recusa um pool menor que a concorrência admitida da
+# classe, exceto nas de DB_POOL_BRIEF_ROUTES, que usam o banco só por um instante por
+# requisição (o /events consulta a sessão e depois só espera eventos).
+# DB_CHECKOUT_TIMEOUTS sobrepõe DB_CHECKOUT_TIMEOUT por classe (ex.: "redirect=0.5").
+DB_POOL_SIZES = _env_map("DB_POOL_SIZES", "redirect=16,api=6,auth=4,stream=2,background=2")
+DB_POOL_BRIEF_ROUTES = {r.strip() for r in os.getenv("DB_POOL_BRIEF_ROUTES", "stream").split(",") if r.strip()}
+DB_CHECKOUT_TIMEOUTS = _env_map("DB_CHECKOUT_TIMEOUTS", "")
+# GET /export monta o CSV inteiro (em memória até EXPORT_MEMORY_BYTES, depois em arquivo
+# temporário) antes de responder: a conexão volta ao pool sem esperar um cliente lento.
+EXPORT_MEMORY_BYTES = int(os.getenv("EXPORT_MEMORY_BYTES", str(8 * 1024 * 1024)))
+MAX_THREADS = int(os.getenv("MAX_THREADS", "256"))  # conexões HTTP simultâneas; acima disso, 503 direto
+RETRY_AFTER_SECONDS = int(os.getenv("RETRY_AFTER_SECONDS", "1"))
+
+# Log de acesso estruturado (JSON por linha) escrito por uma thread própria.
+# ACCESS_LOG: "-" = stderr, caminho de arquivo, ou "off". Amostragem por classe de rota
+# (respostas 5xx são sempre registradas); com o buffer cheio, entradas são descartadas e contadas.
+ACCESS_LOG = os.getenv("ACCESS_LOG", "-")
+ACCESS_LOG_SAMPLE = _env_map("ACCESS_LOG_SAMPLE", "redirect=1,api=1,auth=1")
+ACCESS_LOG_BUFFER = int(os.getenv("ACCESS_LOG_BUFFER", "10000"))
+ACCESS_LOG_BATCH = int(os.getenv("ACCESS_LOG_BATCH", "256"))
+ACCESS_LOG_FLUSH_SECONDS = float(os.getenv("ACCESS_LOG_FLUSH_SECONDS", "1"))
+
+# Índice binário somente leitura de urls+targets (python shortner.py export-index [ARQUIVO]),
+# mapeado em memória por todos os processos do host: o redirect resolve o destino sem consultar
+# o banco e só grava a contagem. Um arquivo novo (os.replace) é assumido sem reiniciar.
+# A contagem confere urls.version (trigger a cada alteração): link alterado em outro processo
+# volta ao banco no primeiro hit. SINGLE cacheável sem hit amostrado não passa pelo banco, então
+# uma geração mais velha que LINK_INDEX_MAX_AGE_SECONDS é ignorada (0 = sem limite): reexporte
+# com o cron em intervalo menor. Vazio = desligado.
+LINK_INDEX_PATH = os.getenv("LINK_INDEX_PATH", "")
+LINK_INDEX_CHECK_SECONDS = float(os.getenv("LINK_INDEX_CHECK_SECONDS", "1"))  # intervalo do stat
+LINK_INDEX_MAX_AGE_SECONDS = float(os.getenv("LINK_INDEX_MAX_AGE_SECONDS", "900"))
+
+# Contadores ao vivo no painel (GET /events, Server-Sent Events): deltas de hits por código,
+# agregados em memória a cada EVENTS_WINDOW_SECONDS a partir dos redirects deste processo.
+EVENTS_WINDOW_SECONDS = float(os.getenv("EVENTS_WINDOW_SECONDS", "1"))
+EVENTS_HEARTBEAT_SECONDS = float(os.getenv("EVENTS_HEARTBEAT_SECONDS", "15"))
+EVENTS_QUEUE = int(os.getenv("EVENTS_QUEUE", "64"))  # janelas pendentes por painel; acima disso, desconecta
+
+# Slugs curinga ("Promo/*" atende "Promo/qualquer/coisa" sem link exato). Cada processo mantém
+# os curingas numa trie por segmento, atualizada nas próprias escritas e recarregada do banco
+# a cada WILDCARD_REFRESH_SECONDS (escritas de outros processos). A recarga periódica só começa
+# quando existe algum curinga; antes disso, um 404 com "/" consulta o banco no máximo uma vez
+# por intervalo.
+WILDCARD_REFRESH_SECONDS = int(os.getenv("WILDCARD_REFRESH_SECONDS", "30"))
+
+# Destinos com template (opt-in por link, "template": true): {query} (query string recebida),
+# {path} (restante de um slug curinga) e {nome} (valor do parâmetro "nome", ex.: {utm_source}).
+# Sem a flag, chaves no destino são literais. Compilados uma vez por URL (LRU).
+DEST_TEMPLATE_CACHE = int(os.getenv("DEST_TEMPLATE_CACHE", "4096"))
+
+# Bots e previews de link (WhatsApp, Telegram, Facebook...) recebem o redirect, mas não contam
+# hits nem gravam no banco; ficam só num contador em memória (/metrics). BOT_UA_EXTRA acrescenta
+# trechos de User-Agent (separados por vírgula). "bot" só casa como palavra, "xbot/..." ou "-bot"
+# (o modelo CUBOT de celular não é bot). Nomes de crawlers, não de apps: o navegador embutido do
+# Pinterest é gente clicando. BOT_EMPTY_UA: User-Agent vazio conta como bot.
+BOT_FILTER = os.getenv("BOT_FILTER", "true").lower() == "true"
+BOT_EMPTY_UA = os.getenv("BOT_EMPTY_UA", "true").lower() == "true"
+BOT_UA_TOKENS = (
+    "bot/", "-bot", "telegrambot", "twitterbot", "slackbot", "discordbot", "linkedinbot",
+    "crawler", "spider", "slurp", "facebookexternalhit", "facebookcatalog", "whatsapp",
+    "bingpreview", "embedly", "vkshare", "pinterestbot", "pinterest/0.", "bitly", "skypeuripreview",
+    "headlesschrome",
+    "lighthouse", "curl/", "wget/", "python-requests", "python-urllib", "go-http-client",
+)
+BOT_UA_EXTRA = [t.strip().lower() for t in os.getenv("BOT_UA_EXTRA", "").split(",") if t.strip()]
+BOT_UA_CACHE = int(os.getenv("BOT_UA_CACHE", "4096"))  # veredictos de User-Agents recentes (LRU)
+
+# Links mais acessados: top-K aproximado (Space-Saving) alimentado pelo redirect, em GET /top.
+# LINK_CACHE_SIZE links ficam em memória por LINK_CACHE_TTL_SECONDS na frente do banco; os
+# TOPK_PIN mais acessados ficam fixados (recarregados em segundo plano, nunca saem pelo LRU).
+# TOPK_STATE_PATH guarda o top-K a cada TOPK_SAVE_SECONDS para aquecer o cache no próximo start.
+TOPK_CAPACITY = int(os.getenv("TOPK_CAPACITY", "256"))              # contadores do Space-Saving
+TOPK_PIN = int(os.getenv("TOPK_PIN", "32"))
+TOPK_HALF_LIFE_SECONDS = float(os.getenv("TOPK_HALF_LIFE_SECONDS", "3600"))  # 0 = sem decaimento
+TOPK_STATE_PATH = os.getenv("TOPK_STATE_PATH", "")
+TOPK_SAVE_SECONDS = float(os.getenv("TOPK_SAVE_SECONDS", "60"))
+LINK_CACHE_SIZE = int(os.getenv("LINK_CACHE_SIZE", "10000"))        # 0 = desligado
+LINK_CACHE_TTL_SECONDS = float(os.getenv("LINK_CACHE_TTL_SECONDS", "5"))
+
+# Banco fora ou lento: com HIT_SPOOL_DIR definido, o redirect continua servindo os links que
+# este processo já conhece (LINK_CACHE, mesmo expirados, e o índice mmap) e os hits vão para
+# segmentos append-only nesse diretório (fsync em lote), reaplicados quando o banco volta.
+# Cada processo escreve num subdiretório próprio, travado (flock) enquanto vive; os de processos
+# encerrados são adotados e reaplicados por quem estiver rodando. Depois de uma falha, o banco
+# é evitado por HIT_SPOOL_RETRY_SECONDS.
+HIT_SPOOL_DIR = os.getenv("HIT_SPOOL_DIR", "")
+HIT_SPOOL_FSYNC_SECONDS = float(os.getenv("HIT_SPOOL_FSYNC_SECONDS", "0.2"))
+HIT_SPOOL_FSYNC_BATCH = int(os.getenv("HIT_SPOOL_FSYNC_BATCH", "512"))   # hits pendentes que antecipam o fsync
+HIT_SPOOL_SEGMENT_BYTES = int(os.getenv("HIT_SPOOL_SEGMENT_BYTES", str(8 * 1024 * 1024)))
+HIT_SPOOL_MAX_BYTES = int(os.getenv("HIT_SPOOL_MAX_BYTES", str(256 * 1024 * 1024)))  # acima disso, descarta
+HIT_SPOOL_REPLAY_SECONDS = float(os.getenv("HIT_SPOOL_REPLAY_SECONDS", "5"))
+HIT_SPOOL_RETRY_SECONDS = float(os.getenv("HIT_SPOOL_RETRY_SECONDS", "5"))
+
+# QR codes (GET /qr/{code}.png|svg): renderizados uma vez e guardados num LRU limitado por bytes;
+# com QR_CACHE_DIR, também em disco (sobrevivem a restarts e são compartilhados entre processos).
+QR_CACHE_BYTES = int(os.getenv("QR_CACHE_BYTES", str(16 * 1024 * 1024)))
+QR_CACHE_DIR = os.getenv("QR_CACHE_DIR", "")
+QR_SCALE = int(os.getenv("QR_SCALE", "8"))  # pixels por módulo no PNG (padrão; ?scale=N sobrepõe)
+QR_MAX_AGE = int(os.getenv("QR_MAX_AGE", "86400"))
+QR_CACHE_DIR_BYTES = int(os.getenv("QR_CACHE_DIR_BYTES", str(256 * 1024 * 1024)))  # teto do cache em disco
+# URL codificada no QR: QR_PUBLIC_BASE (ex.: https://sho.rt) se definido; senão o Host da requisição
+# só quando listado em QR_ALLOWED_HOSTS; senão http://HOST:PORT. Nunca um Host arbitrário do cliente.
+QR_PUBLIC_BASE = os.getenv("QR_PUBLIC_BASE", "").rstrip("/")
+QR_ALLOWED_HOSTS = {h.strip().lower() for h in os.getenv("QR_ALLOWED_HOSTS", "").split(",") if h.strip()}
+
+# Startup: migrações em background (padrão), "blocking" (antes de aceitar conexões) ou "off"
+MIGRATE_ON_START = os.getenv("MIGRATE_ON_START", "background").lower()
+
+# Redirect em um único round trip via função shortener_pick() no Postgres
+REDIRECT_SQL_FUNCTION = os.getenv("REDIRECT_SQL_FUNCTION", "false").lower() == "true"
+
 # -------------------- Base62 --------------------
 def base62_encode(n: int) -> str:
     if n == 0:
@@ -41,6 +238,8 @@ def base62_encode(n: int) -> str:
     return "".join(reversed(s))
 
 # -------------------- Validações --------------------
+_SEGMENT_RE = re.compile(r"[A-Za-z0-9-]{1,32}")
+
 def is_http_url(u: str) -> bool:
     return isinstance(u, str) and (u.startswith("http://") or u.startswith("https://"))
 
@@ -48,7 +247,8 @@ def validate_slug_path(slug: str) -> bool:
     """
     Valida slug com múltiplos segmentos separados por '/'. Cada segmento: [A-Za-z0-9-], 1..32 chars.
     Sem barra inicial/final e sem '//' duplicado. Bloqueia nomes reservados.
-    Ex.: 'PromocaoMercadoPago/Whats'
+    O último segmento pode ser '*' (curinga) se houver ao menos um antes.
+    Ex.: 'PromocaoMercadoPago/Whats', 'PromocaoMercadoPago/*'
     """
     if not isinstance(slug, str):
         return False
@@ -57,13 +257,46 @@ def validate_slug_path(slug: str) -> bool:
     if slug.startswith("/") or slug.endswith("/") or "//" in slug:
         return False
     segments = slug.split("/")
+    if segments[-1] == "*" and len(segments) > 1:
+        segments.pop()
     for seg in segments:
         if seg in RESERVED:
             return False
-        if not re.fullmatch(r"[A-Za-z0-9-]{1,32}", seg):
+        if not _SEGMENT_RE.fullmatch(seg):
             return False
     return True
 
+_TEMPLATE_FIELD_RE = re.compile(r"\{([A-Za-z0-9_]+)\}")
+
+TEMPLATE_ERROR = "Erro: campos de template ({query}, {path}, {parametro}) só depois do domínio."
+
+def valid_destination_template(u: str) -> bool:
+    """Campos {..} bem formados e só depois do domínio: o visitante não escolhe o host do redirect."""
+    if "{" not in u and "}" not in u:
+        return True
+    if "{" in _TEMPLATE_FIELD_RE.sub("", u) or "}" in _TEMPLATE_FIELD_RE.sub("", u):
+        return False
+    start = u.find("://") + 3
+    ends = [i for i in (u.find(c, start) for c in "/?#") if i != -1]
+    return "{" not in u[:min(ends) if ends else len(u)]
+
+def format_list_lines(entries) -> list[str]:
+    """Linhas do GET /list (o painel faz o parse delas)."""
+    lines = []
+    for e in entries:
+        if e["type"] == "single":
+            lines.append(f"{e['code']} -> {e['url']} (hits: {e['hits']})")
+        else:
+            parts = [f"{t['url']} [w={t['weight']} hits={t['hits']}]" for t in e["targets"]]
+            lines.append(f"{e['code']} -> MULTI: {', '.join(parts)} (total hits: {e['hits']})")
+    return lines
+
+def valid_cache_max_age(v) -> bool:
+    """cache_max_age: None (sem cache) ou inteiro em 1..CACHE_MAX_AGE_LIMIT."""
+    if v is None:
+        return True
+    return isinstance(v, int) and not isinstance(v, bool) and 1 <= v <= CACHE_MAX_AGE_LIMIT
+
 def build_short_base(handler: http.server.BaseHTTPRequestHandler) -> str:
     host_hdr = handler.headers.get("Host")
     if host_hdr:
@@ -72,6 +305,15 @@ def build_short_base(handler: http.server.BaseHTTPRequestHandler) -> str:
         return f"{scheme}://{host_hdr}"
     return f"http://{HOST}:{PORT}"
 
+def qr_short_base(handler: http.server.BaseHTTPRequestHandler) -> str:
+    """Base da URL nos QR codes (públicos e cacheados): só de configuração ou de hosts permitidos."""
+    if QR_PUBLIC_BASE:
+        return QR_PUBLIC_BASE
+    host_hdr = (handler.headers.get("Host") or "").strip().lower()
+    if host_hdr in QR_ALLOWED_HOSTS:
+        return f"{'https' if COOKIE_SECURE else 'http'}://{host_hdr}"
+    return f"http://{HOST}:{PORT}"
+
 # -------------------- HTML: UI & Login --------------------
 INDEX_HTML = """
 <!doctype html>
@@ -131,7 +373,10 @@ hr{border:none;border-top:1px solid #1f2937;margin:16px 0}
       <div>
         <label>Slug (opcional)</label>
         <input id="slugCode" placeholder="ex.: PromocaoMercadoPago/Whats" />
-        <div class="small">Apenas letras, números e hífen por segmento. Ex.: <code>PromocaoMercadoPago/Whats</code>.</div>
+        <div class="small">Apenas letras, números e hífen por segmento. Ex.: <code>PromocaoMercadoPago/Whats</code>.
+          Termine com <code>/*</code> para atender qualquer sub-slug sem link próprio.</div>
+        <label class="small"><input id="forwardPath" type="checkbox" style="width:auto" /> Repassar o restante do caminho ao destino</label>
+        <label class="small"><input id="destTemplate" type="checkbox" style="width:auto" /> Destino com campos <code>{query}</code>, <code>{path}</code>, <code>{parametro}</code></label>
       </div>
       <div class="row" style="align-items:flex-end">
         <label class="badge">Tipo de destino</label>
@@ -140,6 +385,24 @@ hr{border:none;border-top:1px solid #1f2937;margin:16px 0}
           <option value="wa">WhatsApp (wa.me)</option>
         </select>
       </div>
+      <div>
+        <label>Distribuição (vários destinos)</label>
+        <select id="distribution">
+          <option value="random">Aleatória ponderada (a cada clique)</option>
+          <option value="sticky">Fixa por visitante (mesmo visitante, mesmo destino)</option>
+          <option value="swrr">Rodízio ponderado (sequência equilibrada)</option>
+        </select>
+      </div>
+      <div>
+        <label>Cache do redirect em segundos (opcional, só destino único)</label>
+        <input id="cacheMaxAge" type="number" min="1" step="1" placeholder="vazio = sem cache" />
+        <div class="small">Com cache, CDN/navegador repetem o redirect sem passar pelo servidor; os hits passam a ser estimados.</div>
+      </div>
+      <div>
+        <label>Expira em (opcional)</label>
+        <input id="expiresAt" type="datetime-local" />
+        <div class="small">Depois da data o link responde 410 e é arquivado.</div>
+      </div>
     </div>
 
     <!-- WEB FORM -->
@@ -147,7 +410,8 @@ hr{border:none;border-top:1px solid #1f2937;margin:16px 0}
       <div>
         <label>URLs (uma por linha)</label>
         <textarea id="webUrls" placeholder="https://site1.com\nhttps://site2.com"></textarea>
-        <div class="small">Todas devem começar com <code>http://</code> ou <code>https://</code>.</div>
+        <div class="small">Todas devem começar com <code>http://</code> ou <code>https://</code>.
+          Campos opcionais: <code>{query}</code> (query recebida), <code>{utm_source}</code> (um parâmetro), <code>{path}</code> (restante de slug <code>/*</code>).</div>
       </div>
       <div>
         <label>Pesos (opcional, uma por linha na mesma ordem)</label>
@@ -232,6 +496,27 @@ hr{border:none;border-top:1px solid #1f2937;margin:16px 0}
           <textarea id="editWeights"></textarea>
           <div class="small">Se vazio, peso = 1 para todos. Valores negativos viram 0.</div>
         </div>
+        <div>
+          <label>Distribuição</label>
+          <select id="editDistribution">
+            <option value="random">Aleatória ponderada (a cada clique)</option>
+            <option value="sticky">Fixa por visitante (mesmo visitante, mesmo destino)</option>
+            <option value="swrr">Rodízio ponderado (sequência equilibrada)</option>
+          </select>
+        </div>
+        <div>
+          <label>Cache do redirect em segundos (só destino único)</label>
+          <input id="editCacheMaxAge" type="number" min="1" step="1" placeholder="vazio = sem cache" />
+        </div>
+        <div>
+          <label>Expira em</label>
+          <input id="editExpiresAt" type="datetime-local" />
+          <div class="small">Vazio = nunca expira.</div>
+        </div>
+        <div>
+          <label class="small"><input id="editForwardPath" type="checkbox" style="width:auto" /> Repassar o restante do caminho (slugs <code>/*</code>)</label>
+          <label class="small"><input id="editTemplate" type="checkbox" style="width:auto" /> Destino com campos <code>{query}</code>, <code>{path}</code>, <code>{parametro}</code></label>
+        </div>
       </div>
       <div class="modal-actions">
         <button class="btn" id="editCancel">Cancelar</button>
@@ -261,6 +546,11 @@ const createResult = document.getElementById('createResult');
 const linksTableBody = document.querySelector('#linksTable tbody');
 const refreshListBtn = document.getElementById('refreshList');
 const slugCode = document.getElementById('slugCode');
+const distribution = document.getElementById('distribution');
+const cacheMaxAge = document.getElementById('cacheMaxAge');
+const forwardPath = document.getElementById('forwardPath');
+const destTemplate = document.getElementById('destTemplate');
+const expiresAt = document.getElementById('expiresAt');
 
 // Modal edição
 const editModal = document.getElementById('editModal');
@@ -268,6 +558,11 @@ const editCode = document.getElementById('editCode');
 const editNewCode = document.getElementById('editNewCode');
 const editUrls = document.getElementById('editUrls');
 const editWeights = document.getElementById('editWeights');
+const editDistribution = document.getElementById('editDistribution');
+const editCacheMaxAge = document.getElementById('editCacheMaxAge');
+const editForwardPath = document.getElementById('editForwardPath');
+const editTemplate = document.getElementById('editTemplate');
+const editExpiresAt = document.getElementById('editExpiresAt');
 const editCancel = document.getElementById('editCancel');
 const editSave = document.getElementById('editSave');
 const editResult = document.getElementById('editResult');
@@ -333,8 +628,23 @@ function renderWaList() {
   });
 }
 
-async function criarLinkCurto(urls, weights, code) {
-  const payload = { urls, weights };
+function lerCacheMaxAge(input) {
+  const n = parseInt(input.value, 10);
+  return (Number.isNaN(n) || n < 1) ? null : n;
+}
+
+// datetime-local (hora local) <-> ISO 8601 em UTC
+function lerExpiracao(input) {
+  return input.value ? new Date(input.value).toISOString() : null;
+}
+function paraDatetimeLocal(iso) {
+  if (!iso) return '';
+  const d = new Date(iso);
+  return new Date(d.getTime() - d.getTimezoneOffset() * 60000).toISOString().slice(0, 16);
+}
+
+async function criarLinkCurto(urls, weights, code, distribution, cacheMaxAge, expires, forward, template) {
+  const payload = { urls, weights, distribution, cache_max_age: cacheMaxAge, expires_at: expires, forward_path: forward, template };
   if (code && code.trim()) payload.code = code.trim();
   const resp = await fetch('/new', {
     method: 'POST',
@@ -366,7 +676,9 @@ createBtn.addEventListener('click', async () => {
       weights = waDestinos.map(d => (Number.isFinite(d.weight) && d.weight >= 0) ? d.weight : 1);
     }
 
-    const short = await criarLinkCurto(urls, weights, code);
+    const cache = urls.length === 1 ? lerCacheMaxAge(cacheMaxAge) : null;
+    const short = await criarLinkCurto(urls, weights, code, distribution.value, cache, lerExpiracao(expiresAt), forwardPath.checked,
+                                       destTemplate.checked);
     createResult.innerHTML = `✅ Criado: ${short}${short}</a>`;
     if (destType.value === 'wa') { waDestinos = []; renderWaList(); waWeight.value='1'; }
     slugCode.value = '';
@@ -407,10 +719,11 @@ async function carregarLista() {
     const arrayHitsNumero = arrayHits.map(h => parseInt(h, 10) || 0);
     
     const totalHits = arrayHitsNumero.reduce((acc, n) => acc + n, 0);
+    tr.dataset.code = code;
     tr.innerHTML = `
       <td><code>${code}</code></td>
-      <td>${arrayNumeros.map((num, i) => `<p>${num} Hits = ${arrayHits[i] || '0'}</p>`).join('')}</td>
-      <td>${totalHits}</td>
+      <td>${arrayNumeros.map((num, i) => `<p data-num="${num}">${num} Hits = <span class="hits">${arrayHits[i] || '0'}</span></p>`).join('')}</td>
+      <td class="hits-total">${totalHits}</td>
       <td class="row">
         <button class="btn" onclick="copiar('${location.origin}/${code}')">Copiar</button>
         <button class="btn" onclick="abrirEdicao('${code}')">Editar</button>
@@ -428,6 +741,34 @@ function copiar(txt) {
 refreshListBtn.addEventListener('click', carregarLista);
 window.addEventListener('load', carregarLista);
 
+// ------- CONTADORES AO VIVO (SSE) -------
+function somarHits(el, n) {
+  if (el) el.textContent = (parseInt(el.textContent, 10) || 0) + n;
+}
+
+function aplicarHits(delta) {
+  for (const [code, n] of Object.entries(delta.links)) {
+    const tr = [...linksTableBody.rows].find(r => r.dataset.code === code);
+    if (!tr) continue;
+    somarHits(tr.querySelector('.hits-total'), n);
+    for (const [url, k] of Object.entries(delta.targets[code] || {})) {
+      const m = url.match(/wa\.me\/(\d+)/i) || url.match(/(\d{10,15})/);
+      if (!m) continue;
+      const p = [...tr.querySelectorAll('p[data-num]')].find(el => el.dataset.num === m[1]);
+      if (p) somarHits(p.querySelector('.hits'), k);
+    }
+  }
+}
+
+if (window.EventSource) {
+  const eventos = new EventSource('/events');
+  let eventosCaiu = false;
+  eventos.addEventListener('hits', ev => aplicarHits(JSON.parse(ev.data)));
+  eventos.onerror = () => { eventosCaiu = true; };
+  // deltas perdidos durante a queda: recarrega a lista ao reconectar
+  eventos.onopen = () => { if (eventosCaiu) { eventosCaiu = false; carregarLista(); } };
+}
+
 // ------- EDIÇÃO -------
 async function abrirEdicao(code) {
   editResult.textContent = '';
@@ -443,6 +784,11 @@ async function abrirEdicao(code) {
     const weights = (data.type === 'single') ? [1] : (data.targets.map(t => t.weight || 1));
     editUrls.value = urls.join('\\n');
     editWeights.value = weights.join('\\n');
+    editDistribution.value = data.distribution || 'random';
+    editCacheMaxAge.value = data.cache_max_age || '';
+    editExpiresAt.value = paraDatetimeLocal(data.expires_at);
+    editForwardPath.checked = !!data.forward_path;
+    editTemplate.checked = !!data.template;
     editModal.style.display = 'flex';
   } catch (e) {
     alert('Erro ao abrir edição: ' + e.message);
@@ -459,7 +805,10 @@ editSave.addEventListener('click', async () => {
   const weights = (editWeights.value || '').split('\\n').map(s=>s.trim()).filter(Boolean)
                     .map(x => { const n = parseFloat(x); return (Number.isNaN(n) || n < 0) ? 1 : n; });
   try {
-    const payload = { code, urls, weights };
+    const payload = { code, urls, weights, distribution: editDistribution.value,
+                      cache_max_age: urls.length === 1 ? lerCacheMaxAge(editCacheMaxAge) : null,
+                      expires_at: lerExpiracao(editExpiresAt), forward_path: editForwardPath.checked,
+                      template: editTemplate.checked };
     if (newCode) payload.new_code = newCode;
     const resp = await fetch('/update', {
       method: 'POST',
@@ -553,92 +902,469 @@ async function logout() {
 """
 
 # -------------------- DB Pool & Schema --------------------
-if not DATABASE_URL:
-    raise RuntimeError("DATABASE_URL não definido nas variáveis de ambiente.")
+class LazyPool:
+    """
+    ConnectionPool criado no primeiro uso e aberto sem bloquear (open(wait=False)):
+    importar o módulo não conecta ao banco nem exige DATABASE_URL.
+    """
+
+    def __init__(self, conninfo: str | None, **kwargs):
+        self.conninfo = conninfo
+        self.kwargs = kwargs
+        self._pool = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def get(self) -> ConnectionPool:
+        pool = self._pool
+        if pool is None:
+            with self._lock:
+                if self._pool is None:
+                    if not self.conninfo:
+                        raise RuntimeError("DATABASE_URL não definido nas variáveis de ambiente.")
+                    pool = ConnectionPool(conninfo=self.conninfo, open=False, **self.kwargs)
+                    pool.open(wait=False)
+                    self._pool = pool
+                pool = self._pool
+        return pool
+
+    @contextmanager
+    def connection(self, timeout: float | None = None):
+        """Checkout com espera limitada (PoolTimeout) e statement_timeout da rota atual."""
+        if timeout is None:
+            timeout = DB_CHECKOUT_TIMEOUT
+        t0 = time.perf_counter()
+        depth = getattr(_REQUEST, "db_depth", 0)
+        _REQUEST.db_depth = depth + 1
+        try:
+            with ExitStack() as stack:
+                try:
+                    conn = stack.enter_context(self.get().connection(timeout=timeout))
+                except PoolTimeout:
+                    with self._stats_lock:
+                        self.timeouts += 1
+                    raise
+                self._count_wait(time.perf_counter() - t0)
+                _apply_statement_timeout(conn)
+                yield conn
+        finally:
+            _REQUEST.db_depth = depth
+            if depth == 0:
+                # tempo de banco da requisição (espera no pool incluída) para o log de acesso
+                _REQUEST.db_time = getattr(_REQUEST, "db_time", 0.0) + time.perf_counter() - t0
+
+    def _count_wait(self, wait: float):
+        with self._stats_lock:
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            out = {
+                "checkouts": self.checkouts, "checkout_timeouts": self.timeouts,
+                "wait_ms_avg": round(self.wait_total / self.checkouts * 1000, 3) if self.checkouts else 0.0,
+                "wait_ms_max": round(self.wait_max * 1000, 3),
+            }
+        if self._pool is not None:
+            out.update(self._pool.get_stats())
+        return out
 
-DB_POOL = ConnectionPool(conninfo=DATABASE_URL, min_size=1, max_size=20)
+class RoutedPool:
+    """
+    Um LazyPool por classe de rota, escolhido pela rota da requisição atual (current_route()).
+    Cada pool tem tamanho, espera máxima e métricas próprias; jobs de fundo e classes sem
+    pool configurado usam "background".
+    """
+
+    def __init__(self, conninfo: str | None, sizes: dict, timeouts: dict):
+        sizes = dict(sizes)
+        sizes.setdefault("background", 2)
+        self.timeouts = timeouts
+        self.pools = {
+            route: LazyPool(conninfo, min_size=1, max_size=max(1, int(size)), name=f"shortner-{route}")
+            for route, size in sizes.items()
+        }
+
+    def _route(self) -> str:
+        route = current_route()
+        return route if route in self.pools else "background"
+
+    def open(self):
+        """Abre todos os pools em background (as conexões sobem enquanto o socket já aceita)."""
+        for pool in self.pools.values():
+            pool.get()
+
+    def connection(self, timeout: float | None = None):
+        route = self._route()
+        if timeout is None:
+            timeout = self.timeouts.get(route, DB_CHECKOUT_TIMEOUT)
+        return self.pools[route].connection(timeout=timeout)
+
+    def stats(self) -> dict:
+        return {route: pool.stats() for route, pool in self.pools.items()}
+
+DB_POOL = RoutedPool(DATABASE_URL, DB_POOL_SIZES, DB_CHECKOUT_TIMEOUTS)
+READ_POOL = LazyPool(DATABASE_READ_URL, min_size=1, max_size=READ_POOL_MAX) if DATABASE_READ_URL else None
+
+# Estado da réplica compartilhado entre threads (corridas aqui só custam uma checagem a mais)
+_REPLICA = {"lag": 0.0, "checked_at": float("-inf"), "down_until": 0.0}
+
+# Atraso em segundos; 0 se não é standby (ex.: dois Postgres independentes em testes locais) ou
+# se o receptor de WAL está conectado e tudo o que recebeu já foi aplicado. Sem receptor ativo
+# (primário fora, rede caída) "recebido = aplicado" não diz nada: vale a idade da última
+# transação aplicada, e uma réplica que nunca aplicou nada conta como atrasada.
+REPLICA_LAG_SQL = """
+SELECT CASE
+  WHEN NOT pg_is_in_recovery() THEN 0
+  WHEN EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming')
+       AND pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+  ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 'Infinity'::float8)
+END;
+"""
+
+def _replica_down(err):
+    _REPLICA["down_until"] = time.monotonic() + READ_RETRY_SECONDS
+    ACCESS_LOGGER.event(f"Réplica indisponível por {READ_RETRY_SECONDS:.0f}s, lendo do primário: {err}")
+
+def _replica_fresh(conn) -> bool:
+    now = time.monotonic()
+    if now - _REPLICA["checked_at"] >= READ_LAG_CHECK_SECONDS:
+        _REPLICA["lag"] = float(conn.execute(REPLICA_LAG_SQL).fetchone()[0])
+        _REPLICA["checked_at"] = now
+    return _REPLICA["lag"] <= READ_MAX_STALENESS_SECONDS
+
+@contextmanager
+def read_connection():
+    """
+    Conexão para consultas somente leitura: réplica (DATABASE_READ_URL) quando configurada,
+    acessível e com atraso <= READ_MAX_STALENESS_SECONDS; caso contrário, o primário.
+    """
+    if READ_POOL is not None and time.monotonic() >= _REPLICA["down_until"]:
+        with ExitStack() as stack:
+            try:
+                conn = stack.enter_context(READ_POOL.connection(timeout=READ_CHECKOUT_TIMEOUT))
+                fresh = _replica_fresh(conn)
+            except (psycopg.OperationalError, PoolTimeout) as e:
+                _replica_down(e)
+                fresh = False
+            if fresh:
+                try:
+                    yield conn
+                except psycopg.OperationalError as e:
+                    _replica_down(e)
+                    raise
+                return
+    with DB_POOL.connection() as conn:
+        yield conn
+
+# Seleção ponderada + incrementos em uma única chamada (mesma semântica de
+# pick_target_and_count: peso 0 nunca é escolhido; todos 0 => distribuição uniforme).
+# Retorna nenhuma linha se o código não existe; url NULL para MULTI sem targets;
+# kind 'defer' para MULTI com distribuição diferente de 'random' e para SINGLE cacheável
+# (resolvidos em Python); kind 'gone' para link expirado (sem contar hit).
+PICK_FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION shortener_pick(p_code TEXT)
+RETURNS TABLE(kind TEXT, url TEXT)
+LANGUAGE plpgsql AS $$
+DECLARE
+  v_type TEXT;
+  v_url TEXT;
+  v_dist TEXT;
+  v_cache INTEGER;
+  v_exp TIMESTAMPTZ;
+  v_id INTEGER;
+  v_tpl BOOLEAN;
+  v_r DOUBLE PRECISION := random();
+BEGIN
+  SELECT u.type, u.url, u.distribution, u.cache_max_age, u.expires_at, u.template
+  INTO v_type, v_url, v_dist, v_cache, v_exp, v_tpl
+  FROM urls u WHERE u.code = p_code;
+  IF NOT FOUND THEN
+    RETURN;
+  END IF;
+  IF v_exp IS NOT NULL AND v_exp <= now() THEN
+    RETURN QUERY SELECT 'gone'::TEXT, NULL::TEXT;
+    RETURN;
+  END IF;
+  IF v_tpl OR (v_type = 'single' AND v_cache IS NOT NULL) THEN
+    RETURN QUERY SELECT 'defer'::TEXT, NULL::TEXT;
+    RETURN;
+  END IF;
+  IF v_type = 'single' THEN
+    UPDATE urls SET hits = hits + 1, last_hit_at = now() WHERE code = p_code;
+    RETURN QUERY SELECT v_type, v_url;
+    RETURN;
+  END IF;
+  IF v_dist <> 'random' THEN
+    RETURN QUERY SELECT 'defer'::TEXT, NULL::TEXT;
+    RETURN;
+  END IF;
+
+  SELECT t.id, t.url INTO v_id, v_url
+  FROM (
+    SELECT s.id, s.url, s.w, SUM(s.w) OVER (ORDER BY s.id) AS cum, SUM(s.w) OVER () AS total
+    FROM (
+      SELECT tg.id, tg.url,
+             CASE WHEN SUM(tg.weight) OVER () > 0 THEN tg.weight ELSE 1.0 END AS w
+      FROM targets tg WHERE tg.code = p_code
+    ) s
+  ) t
+  WHERE t.w > 0 AND t.cum > v_r * t.total
+  ORDER BY t.id
+  LIMIT 1;
+  IF NOT FOUND THEN
+    -- sem targets (ou arredondamento no último acumulado): último destino com peso
+    SELECT tg.id, tg.url INTO v_id, v_url FROM targets tg
+    WHERE tg.code = p_code
+    ORDER BY (tg.weight > 0) DESC, tg.id DESC
+    LIMIT 1;
+    IF NOT FOUND THEN
+      RETURN QUERY SELECT v_type, NULL::TEXT;
+      RETURN;
+    END IF;
+  END IF;
+
+  UPDATE urls SET hits = hits + 1, last_hit_at = now() WHERE code = p_code;
+  UPDATE targets SET hits = hits + 1 WHERE id = v_id;
+  RETURN QUERY SELECT v_type, v_url;
+END;
+$$;
+"""
+
+def _bootstrap_admin(cur):
+    cur.execute("SELECT COUNT(*) FROM users;")
+    count = cur.fetchone()[0]
+    if count == 0:
+        # cria admin
+        pwd = ADMIN_PASSWORD if ADMIN_PASSWORD else _generate_password()
+        salt_hex, hash_hex = hash_password(pwd)
+        cur.execute(
+            "INSERT INTO users(username, password_salt, password_hash) VALUES (%s,%s,%s) RETURNING id;",
+            (ADMIN_USER, salt_hex, hash_hex)
+        )
+        print("="*60)
+        print(f"Usuário admin criado: {ADMIN_USER}")
+        if ADMIN_PASSWORD:
+            print("Senha definida pelo ambiente (ADMIN_PASSWORD).")
+        else:
+            print(f"Senha gerada (anote com segurança): {pwd}")
+        print("="*60)
+
+# Migrações versionadas: (versão, nome, SQL ou função(cur)). Nunca edite uma migração já
+# publicada; acrescente uma nova versão ao final.
+# urls.version sobe a cada alteração do que o redirect usa, venha de onde vier (API, massa,
+# SQL manual): quem resolveu o destino fora do banco conta com "AND version = %s".
+# A contagem de hits não dispara os triggers.
+LINK_VERSION_SQL = """
+ALTER TABLE urls ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 1;
+
+CREATE OR REPLACE FUNCTION shortener_bump_version() RETURNS trigger AS $$
+BEGIN
+  NEW.version := OLD.version + 1;
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION shortener_bump_target_version() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP <> 'INSERT' THEN
+    UPDATE urls SET version = version + 1 WHERE code = OLD.code;
+  END IF;
+  IF TG_OP <> 'DELETE' AND (TG_OP = 'INSERT' OR NEW.code IS DISTINCT FROM OLD.code) THEN
+    UPDATE urls SET version = version + 1 WHERE code = NEW.code;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS urls_version ON urls;
+CREATE TRIGGER urls_version BEFORE UPDATE ON urls FOR EACH ROW
+WHEN ((OLD.type, OLD.url, OLD.distribution, OLD.cache_max_age, OLD.expires_at, OLD.forward_path)
+      IS DISTINCT FROM (NEW.type, NEW.url, NEW.distribution, NEW.cache_max_age, NEW.expires_at, NEW.forward_path))
+EXECUTE FUNCTION shortener_bump_version();
+
+DROP TRIGGER IF EXISTS targets_version_upd ON targets;
+CREATE TRIGGER targets_version_upd AFTER UPDATE ON targets FOR EACH ROW
+WHEN ((OLD.code, OLD.url, OLD.weight) IS DISTINCT FROM (NEW.code, NEW.url, NEW.weight))
+EXECUTE FUNCTION shortener_bump_target_version();
+
+DROP TRIGGER IF EXISTS targets_version_ins_del ON targets;
+CREATE TRIGGER targets_version_ins_del AFTER INSERT OR DELETE ON targets FOR EACH ROW
+EXECUTE FUNCTION shortener_bump_target_version();
+"""
+
+MIGRATIONS = [
+    (1, "tabelas do encurtador", """
+    CREATE TABLE IF NOT EXISTS urls (
+      code TEXT PRIMARY KEY,
+      type TEXT NOT NULL CHECK (type IN ('single','multi')),
+      url TEXT,
+      created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+      hits BIGINT NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS targets (
+      id SERIAL PRIMARY KEY,
+      code TEXT NOT NULL REFERENCES urls(code) ON DELETE CASCADE,
+      url TEXT NOT NULL,
+      weight DOUBLE PRECISION NOT NULL DEFAULT 1.0,
+      hits BIGINT NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS counters (
+      name TEXT PRIMARY KEY,
+      value BIGINT NOT NULL
+    );
+    INSERT INTO counters(name, value) VALUES ('short_counter', 1000)
+    ON CONFLICT (name) DO NOTHING;
+    """),
+    (2, "autenticação", """
+    CREATE TABLE IF NOT EXISTS users (
+      id SERIAL PRIMARY KEY,
+      username TEXT UNIQUE NOT NULL,
+      password_salt TEXT NOT NULL,
+      password_hash TEXT NOT NULL,
+      created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+      last_login_at TIMESTAMPTZ
+    );
+    CREATE TABLE IF NOT EXISTS sessions (
+      token TEXT PRIMARY KEY,
+      user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+      expires_at TIMESTAMPTZ NOT NULL,
+      created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+      ip TEXT,
+      user_agent TEXT
+    );
+    """),
+    # PICK_FUNCTION_SQL é sempre a versão atual (CREATE OR REPLACE); cada alteração da
+    # função ganha uma nova migração que a recria.
+    (3, "função shortener_pick", PICK_FUNCTION_SQL),
+    (4, "usuário admin inicial", _bootstrap_admin),
+    (5, "distribuição por link", """
+    ALTER TABLE urls ADD COLUMN IF NOT EXISTS distribution TEXT NOT NULL DEFAULT 'random';
+    """),
+    (6, "shortener_pick: adia links não aleatórios", PICK_FUNCTION_SQL),
+    (7, "redirects cacheáveis", """
+    ALTER TABLE urls ADD COLUMN IF NOT EXISTS cache_max_age INTEGER;
+    CREATE TABLE IF NOT EXISTS cdn_log_imports (
+      digest TEXT PRIMARY KEY,
+      path TEXT NOT NULL,
+      lines BIGINT NOT NULL,
+      hits BIGINT NOT NULL,
+      imported_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+    """),
+    (8, "shortener_pick: adia SINGLE cacheável", PICK_FUNCTION_SQL),
+    (9, "expiração e arquivo de links", """
+    ALTER TABLE urls ADD COLUMN IF NOT EXISTS expires_at TIMESTAMPTZ;
+    ALTER TABLE urls ADD COLUMN IF NOT EXISTS last_hit_at TIMESTAMPTZ;
+    CREATE INDEX IF NOT EXISTS urls_expires_at_idx ON urls (expires_at) WHERE expires_at IS NOT NULL;
+    CREATE TABLE IF NOT EXISTS urls_archive (
+      code TEXT PRIMARY KEY,
+      type TEXT NOT NULL,
+      url TEXT,
+      distribution TEXT,
+      cache_max_age INTEGER,
+      targets JSONB NOT NULL DEFAULT '[]',
+      hits BIGINT NOT NULL,
+      created_at TIMESTAMPTZ NOT NULL,
+      expires_at TIMESTAMPTZ,
+      last_hit_at TIMESTAMPTZ,
+      archived_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS urls_archive_archived_at_idx ON urls_archive (archived_at);
+    """),
+    (10, "shortener_pick: expiração", PICK_FUNCTION_SQL),
+    (11, "índices de URL de destino (alteração em massa)", """
+    CREATE INDEX IF NOT EXISTS targets_url_idx ON targets (url text_pattern_ops);
+    CREATE INDEX IF NOT EXISTS urls_url_idx ON urls (url text_pattern_ops) WHERE url IS NOT NULL;
+    """),
+    (12, "slugs curinga", """
+    ALTER TABLE urls ADD COLUMN IF NOT EXISTS forward_path BOOLEAN NOT NULL DEFAULT false;
+    CREATE INDEX IF NOT EXISTS urls_wildcard_idx ON urls (code) WHERE code LIKE '%/*';
+    """),
+    (13, "dono dos links", """
+    ALTER TABLE urls ADD COLUMN IF NOT EXISTS owner_id INTEGER REFERENCES users(id) ON DELETE SET NULL;
+    UPDATE urls SET owner_id = (SELECT MIN(id) FROM users) WHERE owner_id IS NULL;
+    CREATE INDEX IF NOT EXISTS urls_owner_created_idx ON urls (owner_id, created_at DESC);
+    ALTER TABLE urls_archive ADD COLUMN IF NOT EXISTS owner_id INTEGER;
+    UPDATE urls_archive SET owner_id = (SELECT MIN(id) FROM users) WHERE owner_id IS NULL;
+    CREATE INDEX IF NOT EXISTS urls_archive_owner_idx ON urls_archive (owner_id, archived_at DESC);
+    """),
+    (14, "segmentos do spool de hits já reaplicados", """
+    CREATE TABLE IF NOT EXISTS hit_spool_segments (
+      segment TEXT PRIMARY KEY,
+      hits BIGINT NOT NULL,
+      replayed_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+    """),
+    (15, "versão do link (índice e caches conferem na contagem)", LINK_VERSION_SQL),
+    (16, "templates de destino opcionais por link", r"""
+    ALTER TABLE urls ADD COLUMN IF NOT EXISTS template BOOLEAN NOT NULL DEFAULT false;
+    DROP TRIGGER IF EXISTS urls_version ON urls;
+    CREATE TRIGGER urls_version BEFORE UPDATE ON urls FOR EACH ROW
+    WHEN ((OLD.type, OLD.url, OLD.distribution, OLD.cache_max_age, OLD.expires_at, OLD.forward_path, OLD.template)
+          IS DISTINCT FROM
+          (NEW.type, NEW.url, NEW.distribution, NEW.cache_max_age, NEW.expires_at, NEW.forward_path, NEW.template))
+    EXECUTE FUNCTION shortener_bump_version();
+    """),
+    (17, "shortener_pick: adia templates", PICK_FUNCTION_SQL),
+]
+
+# Chave do pg_advisory_xact_lock que serializa instâncias subindo em paralelo
+MIGRATIONS_LOCK_KEY = 0x5348_4F52
 
 def ensure_schema():
+    """
+    Aplica as migrações pendentes sob advisory lock.
+    Com o schema em dia custa uma única consulta (sem DDL nem locks).
+    """
+    latest = MIGRATIONS[-1][0]
     with DB_POOL.connection() as conn:
         with conn.cursor() as cur:
-            # tabelas do encurtador
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS urls (
-              code TEXT PRIMARY KEY,
-              type TEXT NOT NULL CHECK (type IN ('single','multi')),
-              url TEXT,
-              created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
-              hits BIGINT NOT NULL DEFAULT 0
-            );
-            """)
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS targets (
-              id SERIAL PRIMARY KEY,
-              code TEXT NOT NULL REFERENCES urls(code) ON DELETE CASCADE,
-              url TEXT NOT NULL,
-              weight DOUBLE PRECISION NOT NULL DEFAULT 1.0,
-              hits BIGINT NOT NULL DEFAULT 0
-            );
-            """)
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS counters (
-              name TEXT PRIMARY KEY,
-              value BIGINT NOT NULL
-            );
-            """)
-            cur.execute("""
-            INSERT INTO counters(name, value) VALUES ('short_counter', 1000)
-            ON CONFLICT (name) DO NOTHING;
-            """)
+            try:
+                cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations;")
+                if cur.fetchone()[0] >= latest:
+                    return
+            except psycopg.errors.UndefinedTable:
+                pass
+            conn.rollback()
 
-            # autenticação
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-              id SERIAL PRIMARY KEY,
-              username TEXT UNIQUE NOT NULL,
-              password_salt TEXT NOT NULL,
-              password_hash TEXT NOT NULL,
-              created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
-              last_login_at TIMESTAMPTZ
-            );
-            """)
+            cur.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATIONS_LOCK_KEY,))
             cur.execute("""
-            CREATE TABLE IF NOT EXISTS sessions (
-              token TEXT PRIMARY KEY,
-              user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-              expires_at TIMESTAMPTZ NOT NULL,
-              created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
-              ip TEXT,
-              user_agent TEXT
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+              version INTEGER PRIMARY KEY,
+              name TEXT NOT NULL,
+              applied_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
             );
             """)
-            # usuário inicial
-            cur.execute("SELECT COUNT(*) FROM users;")
-            count = cur.fetchone()[0]
-            if count == 0:
-                # cria admin
-                pwd = ADMIN_PASSWORD if ADMIN_PASSWORD else _generate_password()
-                salt_hex, hash_hex = hash_password(pwd)
-                cur.execute(
-                    "INSERT INTO users(username, password_salt, password_hash) VALUES (%s,%s,%s) RETURNING id;",
-                    (ADMIN_USER, salt_hex, hash_hex)
-                )
-                admin_id = cur.fetchone()[0]
-                print("="*60)
-                print(f"Usuário admin criado: {ADMIN_USER}")
-                if ADMIN_PASSWORD:
-                    print("Senha definida pelo ambiente (ADMIN_PASSWORD).")
+            # outra instância pode ter aplicado enquanto esperávamos o lock
+            cur.execute("SELECT version FROM schema_migrations;")
+            applied = {r[0] for r in cur.fetchall()}
+            for version, name, step in MIGRATIONS:
+                if version in applied:
+                    continue
+                if callable(step):
+                    step(cur)
                 else:
-                    print(f"Senha gerada (anote com segurança): {pwd}")
-                print("="*60)
+                    cur.execute(step)
+                cur.execute("INSERT INTO schema_migrations(version, name) VALUES (%s,%s);", (version, name))
+                print(f"Migração {version} aplicada: {name}")
         conn.commit()
 
-def next_code() -> str:
-    with DB_POOL.connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute("UPDATE counters SET value = value + 1 WHERE name = 'short_counter' RETURNING value;")
-            val = cur.fetchone()[0]
-        conn.commit()
+def next_code(conn) -> str:
+    """
+    Próximo código sequencial, na conexão que o chamador já segura (uma segunda do mesmo pool
+    poderia esperar para sempre com o pool cheio). Faz commit na hora: a linha do contador não
+    fica travada até o fim da transação do chamador.
+    """
+    with conn.cursor() as cur:
+        cur.execute("UPDATE counters SET value = value + 1 WHERE name = 'short_counter' RETURNING value;")
+        val = cur.fetchone()[0]
+    conn.commit()
     return base62_encode(val)
 
 # -------------------- Password hashing --------------------
@@ -658,216 +1384,2550 @@ def verify_password(password: str, salt_hex: str, hash_hex: str) -> bool:
     return hmac.compare_digest(test, expected)
 
 # -------------------- CRUD de links --------------------
-def get_entry(code: str):
-    with DB_POOL.connection() as conn:
+def get_entry(code: str, owner_id: int):
+    with read_connection() as conn:
         with conn.cursor(row_factory=dict_row) as cur:
-            cur.execute("SELECT * FROM urls WHERE code = %s;", (code,))
+            cur.execute("SELECT * FROM urls WHERE code = %s AND owner_id = %s;", (code, owner_id))
             url_row = cur.fetchone()
+            archived = False
             if not url_row:
-                return None
+                # links arquivados continuam consultáveis (targets vêm do JSONB do arquivo)
+                cur.execute("SELECT * FROM urls_archive WHERE code = %s AND owner_id = %s;", (code, owner_id))
+                url_row = cur.fetchone()
+                if not url_row:
+                    return None
+                archived = True
+            entry = {
+                "type": url_row["type"],
+                "hits": url_row["hits"],
+                "created_at": url_row["created_at"],
+                "expires_at": url_row["expires_at"],
+            }
+            if not archived:
+                entry["forward_path"] = url_row["forward_path"]
+                entry["template"] = url_row["template"]
+            if archived:
+                entry["archived_at"] = url_row["archived_at"]
             if url_row["type"] == "single":
-                return {
-                    "type": "single",
-                    "url": url_row["url"],
-                    "hits": url_row["hits"],
-                    "created_at": url_row["created_at"]
-                }
+                entry.update(url=url_row["url"], cache_max_age=url_row["cache_max_age"])
             else:
-                cur.execute("SELECT id, url, weight, hits FROM targets WHERE code = %s ORDER BY id;", (code,))
-                targets = cur.fetchall()
-                return {
-                    "type": "multi",
-                    "targets": targets,
-                    "hits": url_row["hits"],
-                    "created_at": url_row["created_at"]
-                }
-
-def list_all():
-    out = []
-    with DB_POOL.connection() as conn:
-        with conn.cursor(row_factory=dict_row) as cur:
-            cur.execute("SELECT * FROM urls ORDER BY created_at DESC;")
-            for u in cur.fetchall():
-                if u["type"] == "single":
-                    out.append({"code": u["code"], "type": "single", "url": u["url"], "hits": u["hits"]})
+                if archived:
+                    targets = url_row["targets"]
                 else:
-                    cur.execute("SELECT url, weight, hits FROM targets WHERE code = %s ORDER BY id;", (u["code"],))
-                    ts = cur.fetchall()
-                    out.append({"code": u["code"], "type": "multi", "targets": ts, "hits": u["hits"]})
+                    cur.execute("SELECT id, url, weight, hits FROM targets WHERE code = %s ORDER BY id;", (code,))
+                    targets = cur.fetchall()
+                entry.update(targets=targets, distribution=url_row["distribution"])
+            return entry
+
+def _with_targets(cur, rows):
+    """Entradas do /list e /search; os targets de todos os MULTI vêm numa única consulta."""
+    multi = [u["code"] for u in rows if u["type"] == "multi"]
+    targets = {}
+    if multi:
+        cur.execute("SELECT code, url, weight, hits FROM targets WHERE code = ANY(%s) ORDER BY code, id;", (multi,))
+        for t in cur.fetchall():
+            targets.setdefault(t.pop("code"), []).append(t)
+    out = []
+    for u in rows:
+        if u["type"] == "single":
+            out.append({"code": u["code"], "type": "single", "url": u["url"], "hits": u["hits"]})
+        else:
+            out.append({"code": u["code"], "type": "multi", "targets": targets.get(u["code"], []), "hits": u["hits"]})
     return out
 
-def create_short(urls, weights, custom_code=None):
-    with DB_POOL.connection() as conn:
+def list_all(owner_id: int):
+    with read_connection() as conn:
         with conn.cursor(row_factory=dict_row) as cur:
-            # reaproveitar se mesma configuração já existe
-            cur.execute("SELECT code, type, url, hits FROM urls;")
-            existing = cur.fetchall()
-            for e in existing:
-                code = e["code"]
-                if e["type"] == "single" and len(urls) == 1 and e["url"] == urls[0]:
-                    return code
-                elif e["type"] == "multi":
-                    cur.execute("SELECT url, weight FROM targets WHERE code=%s ORDER BY id;", (code,))
-                    ex_targets = cur.fetchall()
-                    ex_urls = [t["url"] for t in ex_targets]
-                    ex_weights = [float(t["weight"]) for t in ex_targets]
-                    if ex_urls == urls and ex_weights == weights:
-                        return code
+            cur.execute(
+                "SELECT code, type, url, hits FROM urls WHERE owner_id = %s ORDER BY created_at DESC;", (owner_id,)
+            )
+            return _with_targets(cur, cur.fetchall())
 
-            # gerar código
-            if custom_code:
-                cur.execute("SELECT 1 FROM urls WHERE code = %s;", (custom_code,))
-                if cur.fetchone():
-                    raise ValueError("Erro: slug já está em uso.")
-                code = custom_code
-            else:
-                code = next_code()
+def search_links(owner_id: int, q: str, limit: int = 100):
+    """Links do usuário cujo código, URL ou destino contém q (sem diferenciar maiúsculas)."""
+    pattern = "%" + q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    with read_connection() as conn:
+        with conn.cursor(row_factory=dict_row) as cur:
+            cur.execute("""
+                SELECT u.code, u.type, u.url, u.hits FROM urls u
+                WHERE u.owner_id = %(owner)s
+                  AND (u.code ILIKE %(p)s OR u.url ILIKE %(p)s
+                       OR EXISTS (SELECT 1 FROM targets t WHERE t.code = u.code AND t.url ILIKE %(p)s))
+                ORDER BY u.created_at DESC
+                LIMIT %(limit)s;
+            """, {"owner": owner_id, "p": pattern, "limit": limit})
+            return _with_targets(cur, cur.fetchall())
 
-            # inserir
-            if len(urls) == 1:
-                cur.execute("INSERT INTO urls(code, type, url) VALUES (%s,'single',%s);", (code, urls[0]))
-            else:
-                cur.execute("INSERT INTO urls(code, type, url) VALUES (%s,'multi',NULL);", (code,))
-                for u, w in zip(urls, weights):
-                    cur.execute("INSERT INTO targets(code, url, weight, hits) VALUES (%s,%s,%s,0);", (code, u, float(w)))
-        conn.commit()
-    return code
+EXPORT_COLUMNS = ("code", "type", "distribution", "url", "weight", "target_hits", "link_hits", "created_at", "expires_at")
+
+def export_rows(owner_id: int):
+    """Linhas do CSV do /export (um destino por linha), lidas em lotes por cursor no servidor."""
+    with read_connection() as conn:
+        with conn.cursor(name="export_links") as cur:
+            cur.itersize = 2000
+            cur.execute("""
+                SELECT u.code, u.type, u.distribution, COALESCE(t.url, u.url), t.weight,
+                       COALESCE(t.hits, u.hits), u.hits, u.created_at, u.expires_at
+                FROM urls u LEFT JOIN targets t ON t.code = u.code
+                WHERE u.owner_id = %s
+                ORDER BY u.created_at DESC, u.code, t.id;
+            """, (owner_id,))
+            yield from cur
+        conn.rollback()
+
+def export_csv(owner_id: int):
+    """CSV do /export num arquivo temporário já rebobinado: (arquivo, tamanho em bytes)."""
+    out = tempfile.SpooledTemporaryFile(max_size=EXPORT_MEMORY_BYTES)
+    try:
+        text = io.TextIOWrapper(out, encoding="utf-8", newline="")
+        writer = csv.writer(text)
+        writer.writerow(EXPORT_COLUMNS)
+        writer.writerows(export_rows(owner_id))
+        text.flush()
+        text.detach()
+    except BaseException:
+        out.close()
+        raise
+    size = out.tell()
+    out.seek(0)
+    return out, size
+
+def _insert_targets(conn, code, urls, weights):
+    """
+    Insere os destinos de um link MULTI em um número constante de round trips:
+    COPY para listas grandes, executemany (pipeline) para as demais.
+    COPY não é permitido dentro de conn.pipeline(); use _targets_use_copy() para decidir.
+    """
+    rows = [(code, u, float(w)) for u, w in zip(urls, weights)]
+    with conn.cursor() as cur:
+        if _targets_use_copy(len(rows)):
+            with cur.copy("COPY targets (code, url, weight) FROM STDIN") as copy:
+                for r in rows:
+                    copy.write_row(r)
+        else:
+            cur.executemany("INSERT INTO targets(code, url, weight, hits) VALUES (%s,%s,%s,0);", rows)
 
-def update_short(code, new_code, urls, weights):
+def _targets_use_copy(n: int) -> bool:
+    return n >= TARGETS_COPY_MIN
+
+def create_short(urls, weights, custom_code=None, distribution="random", cache_max_age=None, expires_at=None,
+                 forward_path=False, owner_id=None, template=False):
+    weights = [float(w) for w in weights]
+    multi = len(urls) > 1
+    wildcard = bool(custom_code) and custom_code.endswith("/*")
     with DB_POOL.connection() as conn:
         with conn.cursor() as cur:
-            cur.execute("SELECT type FROM urls WHERE code = %s;", (code,))
-            row = cur.fetchone()
-            if not row:
-                return None
-            # renomear
-            if new_code and new_code != code:
-                cur.execute("SELECT 1 FROM urls WHERE code = %s;", (new_code,))
-                if cur.fetchone():
-                    raise ValueError("Erro: slug já está em uso.")
-                cur.execute("UPDATE urls SET code = %s WHERE code = %s;", (new_code, code))
-                cur.execute("UPDATE targets SET code = %s WHERE code = %s;", (new_code, code))
-                code = new_code
-            # aplicar nova configuração
-            if len(urls) == 1:
-                cur.execute("UPDATE urls SET type='single', url=%s WHERE code=%s;", (urls[0], code))
-                cur.execute("DELETE FROM targets WHERE code=%s;", (code,))
-            else:
-                cur.execute("UPDATE urls SET type='multi', url=NULL WHERE code=%s;", (code,))
-                cur.execute("DELETE FROM targets WHERE code=%s;", (code,))
-                for u, w in zip(urls, weights):
-                    cur.execute("INSERT INTO targets(code, url, weight, hits) VALUES (%s,%s,%s,0);", (code, u, float(w)))
+            # reaproveitar se mesma configuração já existe (uma única consulta);
+            # curinga não: o slug é o que define o comportamento
+            row = None
+            if not wildcard:
+                if not multi:
+                    cur.execute(
+                        "SELECT code FROM urls WHERE owner_id = %s AND type = 'single' AND url = %s AND code NOT LIKE '%%/*' "
+                        "AND cache_max_age IS NOT DISTINCT FROM %s AND expires_at IS NOT DISTINCT FROM %s "
+                        "AND template = %s LIMIT 1;",
+                        (owner_id, urls[0], cache_max_age, expires_at, template), prepare=DB_PREPARE
+                    )
+                else:
+                    cur.execute("""
+                        SELECT code FROM targets
+                        WHERE code IN (
+                          SELECT t.code FROM targets t JOIN urls u ON u.code = t.code
+                          WHERE t.url = %s AND u.owner_id = %s AND u.distribution = %s
+                            AND u.expires_at IS NOT DISTINCT FROM %s AND u.code NOT LIKE '%%/*' AND u.template = %s
+                        )
+                        GROUP BY code
+                        HAVING array_agg(url ORDER BY id) = %s::text[]
+                           AND array_agg(weight ORDER BY id) = %s::float8[]
+                        LIMIT 1;
+                    """, (urls[0], owner_id, distribution, expires_at, template, urls, weights), prepare=DB_PREPARE)
+                row = cur.fetchone()
+            if row:
+                return row[0]
+
+            # gerar código
+            code = custom_code if custom_code else next_code(conn)
+
+            # inserir: urls + targets no mesmo pipeline (um round trip)
+            with conn.pipeline():
+                cur.execute(
+                    "INSERT INTO urls(code, type, url, distribution, cache_max_age, expires_at, forward_path, owner_id, "
+                    "template) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s) ON CONFLICT (code) DO NOTHING RETURNING code;",
+                    (code, "multi" if multi else "single", None if multi else urls[0], distribution,
+                     None if multi else cache_max_age, expires_at, forward_path, owner_id, template),
+                    prepare=DB_PREPARE
+                )
+                if multi and not _targets_use_copy(len(urls)):
+                    _insert_targets(conn, code, urls, weights)
+            if cur.fetchone() is None:
+                conn.rollback()
+                raise ValueError("Erro: slug já está em uso.")
+            if multi and _targets_use_copy(len(urls)):
+                _insert_targets(conn, code, urls, weights)
         conn.commit()
+    link_changed(code)
+    if wildcard:
+        WILDCARDS.add(code, forward_path)
+        start_wildcard_loop()
     return code
 
-def delete_short(code):
+_KEEP = object()  # update_short: manter o valor atual da coluna
+
+def update_short(code, new_code, urls, weights, distribution=None, cache_max_age=_KEEP, expires_at=_KEEP,
+                 forward_path=_KEEP, owner_id=None, template=_KEEP):
+    """
+    Retorna o código final ou None se o código não existe (ou é de outro usuário).
+    ValueError se o link continua com template e alguma URL tem campos inválidos.
+    """
+    new_code = new_code or code
+    multi = len(urls) > 1
+    try:
+        with DB_POOL.connection() as conn:
+            with conn.cursor() as cur:
+                # renomear + aplicar nova configuração em um único round trip.
+                # Os targets antigos saem antes do rename (a FK não tem ON UPDATE CASCADE).
+                with conn.pipeline():
+                    cur.execute("DELETE FROM targets WHERE code = %s;", (code,), prepare=DB_PREPARE)
+                    keep_cache = cache_max_age is _KEEP
+                    keep_exp = expires_at is _KEEP
+                    keep_fwd = forward_path is _KEEP
+                    keep_tpl = template is _KEEP
+                    cur.execute(
+                        "UPDATE urls SET code = %s, type = %s, url = %s, distribution = COALESCE(%s, distribution), "
+                        "cache_max_age = CASE WHEN %s THEN NULL WHEN %s THEN cache_max_age ELSE %s END, "
+                        "expires_at = CASE WHEN %s THEN expires_at ELSE %s END, "
+                        "forward_path = CASE WHEN %s THEN forward_path ELSE %s END, "
+                        "template = CASE WHEN %s THEN template ELSE %s END "
+                        "WHERE code = %s AND owner_id = %s RETURNING code, forward_path, template;",
+                        (new_code, "multi" if multi else "single", None if multi else urls[0], distribution,
+                         multi, keep_cache, None if keep_cache else cache_max_age,
+                         keep_exp, None if keep_exp else expires_at,
+                         keep_fwd, False if keep_fwd else forward_path,
+                         keep_tpl, False if keep_tpl else template, code, owner_id),
+                        prepare=DB_PREPARE
+                    )
+                    if multi and not _targets_use_copy(len(urls)):
+                        _insert_targets(conn, new_code, urls, weights)
+                row = cur.fetchone()
+                if row is None:
+                    conn.rollback()
+                    return None
+                if row[2] and not all(valid_destination_template(u) for u in urls):
+                    conn.rollback()
+                    raise ValueError(TEMPLATE_ERROR)
+                if multi and _targets_use_copy(len(urls)):
+                    _insert_targets(conn, new_code, urls, weights)
+            conn.commit()
+    except psycopg.errors.UniqueViolation:
+        raise ValueError("Erro: slug já está em uso.")
+    except psycopg.errors.ForeignKeyViolation:
+        # código inexistente: os targets do pipeline não têm a quem referenciar
+        return None
+    link_changed(code)
+    link_changed(new_code)
+    WILDCARDS.discard(code)
+    if new_code.endswith("/*"):
+        WILDCARDS.add(new_code, row[1])
+        start_wildcard_loop()
+    return new_code
+
+def delete_short(code, owner_id) -> bool:
     with DB_POOL.connection() as conn:
         with conn.cursor() as cur:
-            cur.execute("DELETE FROM urls WHERE code=%s;", (code,))
+            cur.execute("DELETE FROM urls WHERE code=%s AND owner_id=%s;", (code, owner_id))
+            deleted = cur.rowcount > 0
         conn.commit()
+    if deleted:
+        link_changed(code)
+        WILDCARDS.discard(code)
+    return deleted
+
+BULK_ACTIONS = ("replace", "remove", "reweight")
+_WA_PREFIXES = ("https://wa.me/", "http://wa.me/")
+
+def normalize_phone(v):
+    """Telefone para casar links wa.me: só dígitos (8–15, com DDI). None se inválido."""
+    if not isinstance(v, str):
+        return None
+    digits = re.sub(r"[\s()+.-]", "", v)
+    return digits if re.fullmatch(r"[0-9]{8,15}", digits) else None
+
+def _bulk_match(column, url=None, phone=None):
+    """Condição SQL que casa destinos por URL exata ou pelo telefone de links wa.me (usa o índice de prefixo)."""
+    if url is not None:
+        return f"{column} = %(url)s"
+    return f"(({column} LIKE %(p1)s OR {column} LIKE %(p2)s) AND {column} ~ %(re)s)"
+
+def bulk_targets(owner_id, action, url=None, phone=None, new_url=None, new_phone=None, weight=None) -> dict:
+    """
+    Altera um destino em todos os links que o contêm, em uma única transação:
+    "replace" troca a URL (ou só o telefone, mantendo ?text=...), "remove" tira o destino
+    dos links MULTI e "reweight" muda o peso. Links que ficariam vazios (remove) e links SINGLE
+    (remove/reweight: não têm destinos) são pulados e listados em "skipped"; destinos não tocados
+    mantêm hits. No replace, um destino que passa a repetir uma URL do mesmo link é fundido ao
+    que já existia (pesos somados) e o link vai para "merged". Só links do usuário.
+    Retorna {"links", "targets", "skipped", "merged"}.
+    """
+    params = {"url": url, "weight": weight, "owner": owner_id}
+    if phone is not None:
+        params.update(
+            p1=_WA_PREFIXES[0] + phone + "%", p2=_WA_PREFIXES[1] + phone + "%",
+            re=r"^https?://wa\.me/" + phone + r"([/?]|$)",
+            re_sub=r"^(https?://wa\.me/)" + phone + r"([/?]|$)",
+            new=(r"\1" + new_phone + r"\2") if new_phone else None,
+        )
+        new_t, new_u = "regexp_replace(t.url, %(re_sub)s, %(new)s)", "regexp_replace(u.url, %(re_sub)s, %(new)s)"
+    else:
+        params["new"] = new_url
+        new_t = new_u = "%(new)s"
+    match_t = _bulk_match("t.url", url, phone) + " AND t.code IN (SELECT code FROM urls WHERE owner_id = %(owner)s)"
+    match_u = _bulk_match("u.url", url, phone) + " AND u.owner_id = %(owner)s"
 
-def pick_target_and_count(code):
-    """Seleciona destino e incrementa hits (público, sem auth)."""
+    changed, skipped, merged, n = set(), set(), set(), 0
     with DB_POOL.connection() as conn:
-        with conn.cursor(row_factory=dict_row) as cur:
-            cur.execute("SELECT type, url FROM urls WHERE code=%s;", (code,))
-            u = cur.fetchone()
-            if not u:
-                return None
-            if u["type"] == "single":
-                cur.execute("UPDATE urls SET hits = hits + 1 WHERE code=%s;", (code,))
-                conn.commit()
-                return u["url"]
+        with conn.cursor() as cur:
+            if action == "replace":
+                # destino novo começa com hits zerados; o link (urls.hits) mantém o total
+                cur.execute(
+                    f"UPDATE targets t SET url = {new_t}, hits = 0, weight = COALESCE(%(weight)s, t.weight) "
+                    f"WHERE {match_t} RETURNING t.code, t.id;", params
+                )
+                replaced = cur.fetchall()
+                rows = [(code,) for code, _ in replaced]
+                if replaced:
+                    # URL repetida no mesmo link depois da troca: fica o destino que já existia (com hits)
+                    cur.execute("""
+                        WITH d AS (
+                          SELECT t.id, t.code, t.weight, first_value(t.id) OVER (
+                            PARTITION BY t.code, t.url ORDER BY t.id = ANY(%(ids)s), t.id
+                          ) AS keep
+                          FROM targets t WHERE t.code = ANY(%(codes)s)
+                        ),
+                        dup AS (SELECT * FROM d WHERE id <> keep AND (id = ANY(%(ids)s) OR keep = ANY(%(ids)s))),
+                        sums AS (SELECT keep, sum(weight) AS weight FROM dup GROUP BY keep),
+                        upd AS (UPDATE targets t SET weight = t.weight + sums.weight FROM sums WHERE t.id = sums.keep)
+                        DELETE FROM targets t USING dup WHERE t.id = dup.id RETURNING t.code;
+                    """, {"codes": list({code for code, _ in replaced}), "ids": [tid for _, tid in replaced]})
+                    merged = {r[0] for r in cur.fetchall()}
+                cur.execute(f"UPDATE urls u SET url = {new_u} WHERE u.type = 'single' AND {match_u} RETURNING u.code;", params)
+                rows += cur.fetchall()
+            elif action == "reweight":
+                cur.execute(f"UPDATE targets t SET weight = %(weight)s WHERE {match_t} RETURNING t.code;", params)
+                rows = cur.fetchall()
+                cur.execute(f"SELECT u.code FROM urls u WHERE u.type = 'single' AND {match_u};", params)
+                skipped = {r[0] for r in cur.fetchall()}
             else:
-                cur.execute("SELECT id, url, weight FROM targets WHERE code=%s ORDER BY id;", (code,))
-                ts = cur.fetchall()
-                if not ts:
-                    return "ERR_NO_TARGETS"
-                weights = [float(t["weight"]) for t in ts]
-                if sum(weights) == 0:
-                    weights = [1.0] * len(ts)
-                idx = random.choices(range(len(ts)), weights=weights, k=1)[0]
-                target_row = ts[idx]
-                # incrementos
-                cur.execute("UPDATE urls SET hits = hits + 1 WHERE code=%s;", (code,))
-                cur.execute("UPDATE targets SET hits = hits + 1 WHERE id=%s;", (target_row["id"],))
+                cur.execute(f"""
+                    WITH m AS (SELECT t.id, t.code FROM targets t WHERE {match_t}),
+                    emptied AS (
+                      SELECT m.code FROM m GROUP BY m.code
+                      HAVING count(*) = (SELECT count(*) FROM targets t WHERE t.code = m.code)
+                    )
+                    DELETE FROM targets t USING m
+                    WHERE t.id = m.id AND m.code NOT IN (SELECT code FROM emptied)
+                    RETURNING t.code;
+                """, params)
+                rows = cur.fetchall()
+                # o que ainda casa depois do DELETE é de link que ficaria sem destinos
+                cur.execute(
+                    f"SELECT t.code FROM targets t WHERE {match_t} "
+                    f"UNION SELECT u.code FROM urls u WHERE u.type = 'single' AND {match_u};", params
+                )
+                skipped = {r[0] for r in cur.fetchall()}
+            n = len(rows)
+            changed = {r[0] for r in rows}
         conn.commit()
-    return target_row["url"]
+    for code in changed:
+        link_changed(code)
+    return {"links": sorted(changed), "targets": n, "skipped": sorted(skipped), "merged": sorted(merged)}
 
-# -------------------- Sessões / Cookies --------------------
-def new_session(user_id: int, ip: str | None, user_agent: str | None) -> str:
-    token = os.urandom(32).hex()
-    expires = datetime.utcnow() + timedelta(hours=SESSION_TTL_HOURS)
-    with DB_POOL.connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                "INSERT INTO sessions(token, user_id, expires_at, ip, user_agent) VALUES (%s,%s,%s,%s,%s);",
-                (token, user_id, expires, ip, user_agent)
-            )
-    return token
+def link_changed(code):
+    """Chamado ao criar/alterar/excluir: descarta o que este processo guardou sobre o código."""
+    forget_expiry(code)
+    with _OWNERS_LOCK:
+        _OWNERS.pop(code, None)
+    if LINK_CACHE is not None:
+        LINK_CACHE.invalidate(code)
+    if LINK_INDEX is not None:
+        LINK_INDEX.invalidate(code)
 
-def get_session_user(token: str | None):
-    if not token:
+# -------------------- Expiração & arquivamento --------------------
+_GONE = set()           # códigos arquivados como expirados (410 sem consultar urls)
+_EXPIRY = OrderedDict()  # code -> (expires_at epoch, visto em monotonic) dos links já vistos pelo redirect
+_EXPIRY_LOCK = threading.Lock()  # protege _GONE e _EXPIRY
+
+def parse_expires_at(v):
+    """expires_at do payload: ISO 8601 (sem fuso = UTC) ou None. Levanta ValueError se inválido."""
+    if v is None:
         return None
-    with DB_POOL.connection() as conn:
-        with conn.cursor(row_factory=dict_row) as cur:
-            cur.execute("DELETE FROM sessions WHERE expires_at < NOW();")  # limpeza simples
+    if not isinstance(v, str):
+        raise ValueError("Erro: 'expires_at' deve ser data ISO 8601.")
+    try:
+        dt = datetime.fromisoformat(v.strip().replace("Z", "+00:00"))
+    except ValueError:
+        raise ValueError("Erro: 'expires_at' deve ser data ISO 8601.")
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+def remember_expiry(code, expires_at):
+    with _EXPIRY_LOCK:
+        _EXPIRY[code] = (expires_at.timestamp(), time.monotonic())
+        _EXPIRY.move_to_end(code)
+        while len(_EXPIRY) > GONE_CACHE_MAX:
+            _EXPIRY.popitem(last=False)
+
+def forget_expiry(code):
+    """O código pode voltar a existir com outra validade."""
+    with _EXPIRY_LOCK:
+        _GONE.discard(code)
+        _EXPIRY.pop(code, None)
+
+def link_gone(code) -> bool:
+    """True se o código sabidamente expirou, sem consultar urls (validade vista há até EXPIRY_HINT_SECONDS)."""
+    with _EXPIRY_LOCK:
+        if code in _GONE:
+            return True
+        entry = _EXPIRY.get(code)
+        if entry is None or entry[0] > time.time():
+            return False
+        if time.monotonic() - entry[1] > EXPIRY_HINT_SECONDS:
+            del _EXPIRY[code]  # dica velha: o redirect consulta o banco e registra de novo
+            return False
+        return True
+
+def refresh_gone_codes():
+    """Recarrega do arquivo os códigos expirados mais recentes que não voltaram a existir em urls."""
+    global _GONE
+    with read_connection() as conn:
+        with conn.cursor() as cur:
             cur.execute("""
-                SELECT u.id, u.username
-                FROM sessions s JOIN users u ON u.id = s.user_id
-                WHERE s.token = %s AND s.expires_at > NOW();
-            """, (token,))
-            return cur.fetchone()
+                SELECT a.code FROM urls_archive a
+                WHERE a.expires_at IS NOT NULL
+                  AND NOT EXISTS (SELECT 1 FROM urls u WHERE u.code = a.code)
+                ORDER BY a.archived_at DESC
+                LIMIT %s;
+            """, (GONE_CACHE_MAX,))
+            gone = {r[0] for r in cur.fetchall()}
+    with _EXPIRY_LOCK:
+        _GONE = gone
 
-def destroy_session(token: str | None):
-    if not token:
-        return
+ARCHIVE_BATCH_SQL = """
+WITH victims AS (
+  SELECT code FROM urls
+  WHERE (expires_at IS NOT NULL AND expires_at <= now())
+     OR (%(idle_days)s > 0 AND COALESCE(last_hit_at, created_at) < now() - make_interval(days => %(idle_days)s)
+         AND (cache_max_age IS NULL OR %(cacheable_idle)s))
+  LIMIT %(batch)s
+  FOR UPDATE SKIP LOCKED
+), moved AS (
+  INSERT INTO urls_archive (code, type, url, distribution, cache_max_age, targets, hits, created_at, expires_at,
+                            last_hit_at, owner_id)
+  SELECT u.code, u.type, u.url, u.distribution, u.cache_max_age,
+         COALESCE((SELECT jsonb_agg(jsonb_build_object('url', t.url, 'weight', t.weight, 'hits', t.hits) ORDER BY t.id)
+                   FROM targets t WHERE t.code = u.code), '[]'::jsonb),
+         u.hits, u.created_at, u.expires_at, u.last_hit_at, u.owner_id
+  FROM urls u JOIN victims v ON v.code = u.code
+  ON CONFLICT (code) DO UPDATE SET
+    type = EXCLUDED.type, url = EXCLUDED.url, distribution = EXCLUDED.distribution,
+    cache_max_age = EXCLUDED.cache_max_age, targets = EXCLUDED.targets, hits = EXCLUDED.hits,
+    created_at = EXCLUDED.created_at, expires_at = EXCLUDED.expires_at,
+    last_hit_at = EXCLUDED.last_hit_at, owner_id = EXCLUDED.owner_id, archived_at = now()
+  RETURNING code
+)
+DELETE FROM urls u USING moved m WHERE u.code = m.code
+RETURNING u.code, (u.expires_at IS NOT NULL AND u.expires_at <= now()) AS expired;
+"""
+
+def archive_batch() -> int:
+    """Move um lote de links expirados/ociosos para urls_archive. Seguro com várias instâncias (SKIP LOCKED)."""
     with DB_POOL.connection() as conn:
         with conn.cursor() as cur:
-            cur.execute("DELETE FROM sessions WHERE token = %s;", (token,))
+            cur.execute(ARCHIVE_BATCH_SQL, {"idle_days": ARCHIVE_IDLE_DAYS, "batch": ARCHIVE_BATCH,
+                                            "cacheable_idle": CACHE_HIT_SOURCE == "cdnlog"})
+            rows = cur.fetchall()
+        conn.commit()
+    with _EXPIRY_LOCK:
+        for code, expired in rows:
+            if expired and len(_GONE) < GONE_CACHE_MAX:
+                _GONE.add(code)
+    return len(rows)
 
-# -------------------- HTTP Handler --------------------
-class ShortenerHandler(http.server.SimpleHTTPRequestHandler):
+def _archiver_loop():
+    while True:
+        try:
+            refresh_gone_codes()
+            moved = 0
+            while True:
+                n = archive_batch()
+                moved += n
+                if n < ARCHIVE_BATCH:
+                    break
+            if moved:
+                print(f"Arquivador: {moved} links movidos para urls_archive.")
+        except Exception as e:
+            print(f"Arquivador: erro, tentando de novo no próximo ciclo: {e}")
+        time.sleep(ARCHIVE_INTERVAL_SECONDS)
 
-    # -------- Helpers de resposta --------
-    def send_json(self, raw_json, status=200):
-        self.send_response(status)
-        self.send_header("Content-Type", "application/json; charset=utf-8")
-        self.send_header("Content-Length", str(len(raw_json.encode("utf-8"))))
-        self.end_headers()
-        self.wfile.write(raw_json.encode("utf-8"))
+# -------------------- Bots / previews --------------------
+_BOT_UA_RE = re.compile(
+    "|".join([r"\bbot\b"] + [re.escape(t) for t in BOT_UA_TOKENS + tuple(BOT_UA_EXTRA)]), re.IGNORECASE
+)
+_BOT_HITS = {}  # trecho do User-Agent -> redirects servidos sem contar
+_BOT_LOCK = threading.Lock()
 
-    def respond_text(self, text, status=200):
-        data = text.encode("utf-8")
-        self.send_response(status)
-        self.send_header("Content-Type", "text/plain; charset=utf-8")
-        self.send_header("Content-Length", str(len(data)))
-        self.end_headers()
-        self.wfile.write(data)
+@functools.lru_cache(maxsize=BOT_UA_CACHE)
+def bot_kind(user_agent: str):
+    """Trecho que identificou o bot (uma única regex combinada) ou None para navegador."""
+    if not user_agent:
+        return "sem-user-agent" if BOT_EMPTY_UA else None
+    m = _BOT_UA_RE.search(user_agent)
+    return m.group(0).lower() if m else None
 
-    def respond_html(self, html, status=200):
-        data = html.encode("utf-8")
-        self.send_response(status)
-        self.send_header("Content-Type", "text/html; charset=utf-8")
-        # evitar cache da UI
-        self.send_header("Cache-Control", "no-store, no-cache, must-revalidate, max-age=0")
-        self.send_header("Pragma", "no-cache")
-        self.send_header("Expires", "0")
-        self.send_header("Content-Length", str(len(data)))
-        self.end_headers()
-        self.wfile.write(data)
+def record_bot(kind):
+    with _BOT_LOCK:
+        _BOT_HITS[kind] = _BOT_HITS.get(kind, 0) + 1
 
-    def redirect(self, location: str, status=302):
-        self.send_response(status)
-        self.send_header("Location", location)
-        self.end_headers()
+# -------------------- Slugs curinga --------------------
+class SlugTrie:
+    """
+    Slugs curinga ("Promo/*") numa trie por segmento: o maior prefixo que casa com o caminho
+    sai em O(segmentos), sem uma consulta ao banco por prefixo candidato.
+    """
 
-    # -------- Cookies / Auth --------
-    def get_cookie(self, name: str):
-        cookies = self.headers.get("Cookie", "")
-        for c in cookies.split(";"):
-            c = c.strip()
-            if not c: continue
+    def __init__(self):
+        self._root = {}  # segmento -> nó; a chave None guarda (code, forward_path)
+        self._lock = threading.Lock()
+
+    def add(self, code, forward_path):
+        with self._lock:
+            node = self._root
+            for seg in code[:-2].split("/"):
+                node = node.setdefault(seg, {})
+            node[None] = (code, bool(forward_path))
+
+    def discard(self, code):
+        if not code.endswith("/*"):
+            return
+        with self._lock:
+            node = self._root
+            for seg in code[:-2].split("/"):
+                node = node.get(seg)
+                if node is None:
+                    return
+            node.pop(None, None)
+
+    def replace_all(self, rows):
+        fresh = SlugTrie()
+        for code, forward_path in rows:
+            fresh.add(code, forward_path)
+        with self._lock:
+            self._root = fresh._root
+
+    def match(self, path):
+        """(code curinga, restante do caminho, forward_path) do maior prefixo, ou None."""
+        node = self._root
+        if not node:
+            return None
+        best = None
+        segs = path.split("/")
+        for i in range(len(segs) - 1):  # o curinga exige ao menos um segmento depois do prefixo
+            node = node.get(segs[i])
+            if node is None:
+                break
+            if None in node:
+                code, forward_path = node[None]
+                best = (code, "/".join(segs[i + 1:]), forward_path)
+        return best
+
+WILDCARDS = SlugTrie()
+
+def refresh_wildcards():
+    with DB_POOL.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT code, forward_path FROM urls WHERE code LIKE '%/*';")
+            rows = cur.fetchall()
+        conn.rollback()
+    WILDCARDS.replace_all(rows)
+    if rows:
+        start_wildcard_loop()
+
+_WILDCARD_STATE = {"loop": False, "probed_at": None}
+_WILDCARD_LOCK = threading.Lock()
+
+def start_wildcard_loop():
+    with _WILDCARD_LOCK:
+        if _WILDCARD_STATE["loop"]:
+            return
+        _WILDCARD_STATE["loop"] = True
+    threading.Thread(target=_wildcard_loop, name="wildcards", daemon=True).start()
+
+def probe_wildcards() -> bool:
+    """
+    Sem a recarga periódica rodando, busca curingas criados por outros processos (no máximo
+    uma vez a cada WILDCARD_REFRESH_SECONDS). True = recarregou agora.
+    """
+    now = time.monotonic()
+    with _WILDCARD_LOCK:
+        probed_at = _WILDCARD_STATE["probed_at"]
+        if _WILDCARD_STATE["loop"] or (probed_at is not None and now - probed_at < WILDCARD_REFRESH_SECONDS):
+            return False
+        _WILDCARD_STATE["probed_at"] = now
+    try:
+        refresh_wildcards()
+    except Exception as e:
+        ACCESS_LOGGER.event(f"Curingas: erro ao consultar o banco: {e}")
+        return False
+    return True
+
+def _wildcard_loop():
+    while True:
+        time.sleep(WILDCARD_REFRESH_SECONDS)
+        try:
+            refresh_wildcards()
+        except Exception as e:
+            ACCESS_LOGGER.event(f"Curingas: erro ao recarregar, mantendo os atuais: {e}")
+
+def forward_rest(target, rest):
+    """Acrescenta o restante do caminho ao path do destino, preservando query e fragmento."""
+    if not rest:
+        return target
+    parts = urllib.parse.urlsplit(target)
+    return urllib.parse.urlunsplit(parts._replace(path=parts.path.rstrip("/") + "/" + rest))
+
+# -------------------- Distribuição de destinos --------------------
+def _hash64(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+def weighted_random(ts):
+    """Sorteio ponderado; peso 0 nunca é escolhido, todos 0 => uniforme."""
+    weights = [float(t["weight"]) for t in ts]
+    if sum(weights) == 0:
+        weights = [1.0] * len(ts)
+    return random.choices(ts, weights=weights, k=1)[0]
+
+class HashRing:
+    """
+    Anel de hash consistente ponderado. Os pontos de cada destino dependem só da sua URL e
+    do seu peso, então mudar o peso de um destino move apenas os visitantes dos pontos
+    acrescentados/removidos (e recriar targets no /update não embaralha ninguém). Com pesos
+    grandes, todos são escalados juntos para que o maior caiba em STICKY_MAX_VNODES: o teto
+    preserva as proporções (nesse caso mudar o maior peso reescala o anel inteiro).
+    """
+
+    def __init__(self, ts):
+        weights = [float(t["weight"]) for t in ts]
+        if sum(weights) == 0:
+            weights = [1.0] * len(ts)
+        per_unit = min(float(STICKY_VNODES), STICKY_MAX_VNODES / max(weights))
+        points = []
+        for idx, (t, w) in enumerate(zip(ts, weights)):
+            if w <= 0:
+                continue
+            n = max(1, round(w * per_unit))
+            for i in range(n):
+                points.append((_hash64(f"{t['url']}#{i}"), idx))
+        points.sort()
+        self.keys = [p[0] for p in points]
+        self.owners = [p[1] for p in points]
+
+    def lookup(self, visitor_key: str) -> int:
+        i = bisect.bisect(self.keys, _hash64(visitor_key))
+        return self.owners[i % len(self.owners)]
+
+_RINGS = OrderedDict()  # code -> (assinatura, HashRing)
+_RINGS_LOCK = threading.Lock()
+
+def _sticky_ring(code, ts) -> HashRing:
+    signature = tuple((t["url"], float(t["weight"])) for t in ts)
+    with _RINGS_LOCK:
+        cached = _RINGS.get(code)
+        if cached and cached[0] == signature:
+            _RINGS.move_to_end(code)
+            return cached[1]
+    ring = HashRing(ts)  # fora do lock: pode custar alguns ms para links grandes
+    with _RINGS_LOCK:
+        _RINGS[code] = (signature, ring)
+        _RINGS.move_to_end(code)
+        while len(_RINGS) > STICKY_RING_CACHE:
+            _RINGS.popitem(last=False)
+    return ring
+
+class SmoothWRR:
+    """
+    Round-robin ponderado suave (algoritmo do nginx): pesos 5/1/1 geram a,a,b,a,c,a,a em
+    vez de rajadas. Estado O(targets) por processo; escolha O(targets).
+    """
+
+    def __init__(self, weights):
+        if sum(weights) == 0:
+            weights = [1.0] * len(weights)
+        self.weights = weights
+        self.total = sum(weights)
+        self.current = [0.0] * len(weights)
+        self.reconciled_at = 0.0
+
+    def reconcile(self, hits):
+        """
+        Semeia o estado com o déficit de cada destino frente à sua fatia em targets.hits
+        (que inclui os cliques servidos por outros processos). Limitado a uma volta
+        para não virar uma rajada no destino atrasado.
+        """
+        total_hits = sum(hits)
+        self.current = [
+            max(-self.total, min(self.total, total_hits * w / self.total - h))
+            for w, h in zip(self.weights, hits)
+        ]
+        self.reconciled_at = time.monotonic()
+
+    def next(self) -> int:
+        best = -1
+        for i, w in enumerate(self.weights):
+            if w <= 0:
+                continue
+            self.current[i] += w
+            if best < 0 or self.current[i] > self.current[best]:
+                best = i
+        self.current[best] -= self.total
+        return best
+
+_SWRR = OrderedDict()  # code -> (assinatura, SmoothWRR)
+_SWRR_LOCK = threading.Lock()
+
+def _swrr_next(code, ts) -> int:
+    signature = tuple((t["url"], float(t["weight"])) for t in ts)
+    with _SWRR_LOCK:
+        cached = _SWRR.get(code)
+        if cached and cached[0] == signature:
+            state = cached[1]
+            _SWRR.move_to_end(code)
+            if SWRR_RECONCILE_SECONDS and time.monotonic() - state.reconciled_at > SWRR_RECONCILE_SECONDS:
+                state.reconcile([int(t.get("hits") or 0) for t in ts])
+        else:
+            state = SmoothWRR([float(t["weight"]) for t in ts])
+            state.reconcile([int(t.get("hits") or 0) for t in ts])
+            _SWRR[code] = (signature, state)
+            while len(_SWRR) > SWRR_STATE_CACHE:
+                _SWRR.popitem(last=False)
+        return state.next()
+
+def choose_target(code, distribution, ts, visitor=None):
+    """
+    Escolhe um target (linha com id/url/weight/hits) conforme a distribuição do link.
+    visitor: função sem argumentos que devolve a chave do visitante; só é chamada para "sticky".
+    """
+    if distribution == "sticky" and visitor:
+        return ts[_sticky_ring(code, ts).lookup(visitor())]
+    if distribution == "swrr":
+        return ts[_swrr_next(code, ts)]
+    return weighted_random(ts)
+
+@functools.lru_cache(maxsize=DEST_TEMPLATE_CACHE)
+def compile_destination(url):
+    """
+    URL com campos -> (partes, usa parâmetros). As partes alternam texto literal e nome de
+    campo (re.split com grupo), então renderizar é só um join; nada é reparseado por clique.
+    """
+    parts = tuple(_TEMPLATE_FIELD_RE.split(url))
+    return parts, any(f not in ("query", "path") for f in parts[1::2])
+
+def render_destination(url, query="", rest=None):
+    parts, uses_params = compile_destination(url)
+    params = urllib.parse.parse_qs(query, keep_blank_values=True) if uses_params and query else {}
+    out = []
+    for i, part in enumerate(parts):
+        if not i % 2:
+            out.append(part)
+        elif part == "query":
+            out.append(query)
+        elif part == "path":
+            out.append(rest or "")
+        else:
+            values = params.get(part)
+            out.append(urllib.parse.quote(values[0], safe="") if values else "")
+    # "...?{query}" ou "...&{campo}" no fim e vazio: tira só esse "?"/"&", o resto é literal
+    if len(parts) > 1 and not parts[-1] and not out[-2] and parts[-3][-1:] in ("?", "&"):
+        out[-3] = out[-3][:-1]
+    return "".join(out)
+
+def _pick_target_sql(code):
+    """
+    Variante de pick_target_and_count em um único round trip (BEGIN+SELECT+COMMIT em pipeline).
+    Retorna "DEFER" para links cuja distribuição é resolvida em Python.
+    """
+    with DB_POOL.connection() as conn:
+        with conn.pipeline():
+            cur = conn.execute("SELECT kind, url FROM shortener_pick(%s);", (code,), prepare=DB_PREPARE)
+            conn.commit()
+        row = cur.fetchone()
+    if row is None:
+        return None
+    if row[0] == "defer":
+        return "DEFER"
+    if row[0] == "gone":
+        return "ERR_GONE"
+    return row[1] if row[1] is not None else "ERR_NO_TARGETS"
+
+def _load_link(cur, code):
+    """Consulta do redirect: linha de urls (+ targets, se MULTI) ou None."""
+    cur.execute(
+        "SELECT type, url, distribution, cache_max_age, expires_at, version, template FROM urls WHERE code=%s;",
+        (code,), prepare=DB_PREPARE
+    )
+    link = cur.fetchone()
+    if link and link["type"] == "multi":
+        cur.execute(
+            "SELECT id, url, weight, hits FROM targets WHERE code=%s ORDER BY id;", (code,), prepare=DB_PREPARE
+        )
+        link["targets"] = cur.fetchall()
+    return link
+
+def _cacheable_hit_increment() -> int:
+    """Hits de SINGLE cacheável: amostrados na origem ou deixados para import_cdn_log()."""
+    if CACHE_HIT_SOURCE != "sample" or random.random() * CACHE_HIT_SAMPLE_RATE >= 1:
+        return 0
+    return CACHE_HIT_SAMPLE_RATE
+
+def _redirect_decision(code, link, visitor=None):
+    """Retorna (destino, cache_max_age, hits a somar, target_id) para o link já carregado."""
+    if link is None:
+        return None, None, 0, None
+    if link["expires_at"] is not None:
+        remember_expiry(code, link["expires_at"])
+        if link["expires_at"] <= datetime.now(timezone.utc):
+            return "ERR_GONE", None, 0, None
+    if link["type"] == "single":
+        max_age = link["cache_max_age"]
+        if max_age is not None and link["expires_at"] is not None:
+            # o cache do CDN/navegador não pode durar além da validade (depois dela, 410)
+            max_age = min(max_age, int((link["expires_at"] - datetime.now(timezone.utc)).total_seconds()))
+        if max_age is not None and max_age > 0:
+            return link["url"], max_age, _cacheable_hit_increment(), None
+        return link["url"], None, 1, None
+    if not link["targets"]:
+        return "ERR_NO_TARGETS", None, 0, None
+    target_row = choose_target(code, link["distribution"], link["targets"], visitor)
+    return target_row["url"], None, 1, target_row["id"]
+
+def _count_hit(conn, code, n, target_id=None, version=None) -> bool:
+    """
+    Incrementa urls.hits (e targets.hits) em um único round trip.
+    False = link ou destino não existe mais, ou o link não está mais na versão informada
+    (destino resolvido fora do banco); nada é gravado.
+    """
+    with conn.pipeline():
+        with conn.cursor() as cur, conn.cursor() as tcur:
+            if version is None:
+                cur.execute(
+                    "UPDATE urls SET hits = hits + %s, last_hit_at = now() WHERE code=%s;",
+                    (n, code), prepare=DB_PREPARE
+                )
+            else:
+                cur.execute(
+                    "UPDATE urls SET hits = hits + %s, last_hit_at = now() WHERE code=%s AND version=%s;",
+                    (n, code, version), prepare=DB_PREPARE
+                )
+            if target_id is not None:
+                tcur.execute("UPDATE targets SET hits = hits + 1 WHERE id=%s;", (target_id,), prepare=DB_PREPARE)
+    if cur.rowcount == 0 or (target_id is not None and tcur.rowcount == 0):
+        conn.rollback()
+        return False
+    conn.commit()
+    return True
+
+def pick_target_and_count(code, visitor=None, query="", rest=None, count=True, forward=False):
+    """
+    Seleciona destino e incrementa hits (público, sem auth).
+    Retorna (destino, cache_max_age, hits somados); destino None = código inexistente.
+    Os hits somados são 0 em SINGLE cacheável fora da amostra e CACHE_HIT_SAMPLE_RATE nela.
+    Links com template recebem a query string e o restante do slug curinga; forward=True
+    (curinga com forward_path) acrescenta o restante ao path, exceto se o destino usa {path}.
+    count=False (bots): só leitura, sem hits e sem estado de distribuição.
+    """
+    if count:
+        target, max_age, n, template = _pick_and_count(code, visitor)
+    else:
+        (target, max_age, template), n = _peek_target(code), 0
+    if target is None or target.startswith("ERR_"):
+        return target, max_age, n
+    uses_path = False
+    if template:
+        uses_path = "{path}" in target
+        target = render_destination(target, query, rest)
+    if forward and not uses_path:
+        target = forward_rest(target, rest)
+    return target, max_age, n
+
+def _peek_target(code):
+    """Destino sem gravar nada: sorteio ponderado (sticky/swrr não avançam por causa de bots)."""
+    if LINK_INDEX is not None:
+        decision = LINK_INDEX.resolve(code)  # sem visitante: sorteio pelos pesos acumulados
+        if decision is not None:
+            return decision[0], decision[1], decision[5]
+    link = LINK_CACHE.get(code) if LINK_CACHE is not None else None
+    if link is None:
+        loaded_at = time.monotonic()
+        with read_connection() as conn:
+            with conn.cursor(row_factory=dict_row) as cur:
+                link = _load_link(cur, code)
+        if link is not None and LINK_CACHE is not None:
+            LINK_CACHE.put(code, link, loaded_at)
+    if link is not None and link["type"] == "multi":
+        link = dict(link, distribution="random")  # cópia: a linha pode estar no LINK_CACHE
+    target, max_age, _, _ = _redirect_decision(code, link)
+    return target, max_age, link is not None and link["template"]
+
+def _count_or_spool(code, n, target_id=None, version=None) -> bool:
+    """_count_hit em uma conexão própria; com o banco fora e HIT_SPOOL ligado, o hit vai para o spool."""
+    if HIT_SPOOL is not None and HIT_SPOOL.db_down():
+        HIT_SPOOL.append(code, n, target_id)
+        return True
+    try:
+        with DB_POOL.connection() as conn:
+            return _count_hit(conn, code, n, target_id, version)
+    except DB_UNAVAILABLE_ERRORS:
+        if HIT_SPOOL is None:
+            raise
+        HIT_SPOOL.mark_down()
+        HIT_SPOOL.append(code, n, target_id)
+        return True
+
+def _pick_and_count(code, visitor=None):
+    if LINK_INDEX is not None:
+        decision = LINK_INDEX.resolve(code, visitor)
+        if decision is not None:
+            target, max_age, n, target_id, version, template = decision
+            if not n or _count_or_spool(code, n, target_id, version):
+                return target, max_age, n, template
+            # excluído ou alterado depois da exportação: vale o banco
+            LINK_INDEX.invalidate(code)
+    if LINK_CACHE is not None:
+        link = LINK_CACHE.get(code)
+        if link is not None:
+            target, max_age, n, target_id = _redirect_decision(code, link, visitor)
+            if not n or _count_or_spool(code, n, target_id, link["version"]):
+                return target, max_age, n, link["template"]
+            LINK_CACHE.invalidate(code)  # alterado em outro processo: vale o banco
+    if HIT_SPOOL is None:
+        return _pick_and_count_db(code, visitor)
+    stale = LINK_CACHE.get(code, stale=True) if LINK_CACHE is not None else None
+    if stale is None or not HIT_SPOOL.db_down():
+        try:
+            return _pick_and_count_db(code, visitor)
+        except DB_UNAVAILABLE_ERRORS:
+            HIT_SPOOL.mark_down()
+            if stale is None:
+                raise
+    # banco fora: última configuração conhecida deste processo, hit no spool
+    target, max_age, n, target_id = _redirect_decision(code, stale, visitor)
+    if n:
+        HIT_SPOOL.append(code, n, target_id)
+    return target, max_age, n, stale["template"]
+
+def _pick_and_count_db(code, visitor=None):
+    if REDIRECT_SQL_FUNCTION:
+        target = _pick_target_sql(code)
+        if target != "DEFER":
+            counted = target is not None and not target.startswith("ERR_")
+            return target, None, 1 if counted else 0, False  # templates voltam como "defer"
+    loaded_at = time.monotonic()
+    if READ_POOL is None:
+        with DB_POOL.connection() as conn:
+            with conn.cursor(row_factory=dict_row) as cur:
+                link = _load_link(cur, code)
+            if link is not None and LINK_CACHE is not None:
+                LINK_CACHE.put(code, link, loaded_at)
+            target, max_age, n, target_id = _redirect_decision(code, link, visitor)
+            if n:
+                _count_hit(conn, code, n, target_id)
+        return target, max_age, n, link is not None and link["template"]
+
+    # leitura na réplica, contagem no primário
+    with read_connection() as conn:
+        with conn.cursor(row_factory=dict_row) as cur:
+            link = _load_link(cur, code)
+    if link is not None and LINK_CACHE is not None:
+        LINK_CACHE.put(code, link, loaded_at)
+    target, max_age, n, target_id = _redirect_decision(code, link, visitor)
+    if n:
+        _count_or_spool(code, n, target_id)
+    return target, max_age, n, link is not None and link["template"]
+
+# -------------------- Links mais acessados (top-K) --------------------
+class SpaceSaving:
+    """
+    Top-K aproximado (Space-Saving): no máximo `capacity` contadores. Um código novo com a
+    tabela cheia assume o contador do menor, e o valor herdado vira o erro da estimativa;
+    todo código com mais de total/capacity hits está garantidamente na tabela.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = max(1, capacity)
+        self.total = 0.0
+        self._counts = {}  # code -> [contagem, erro]
+        self._heap = []    # (contagem, code) de cada contador; a contagem pode estar atrasada
+        self._lock = threading.Lock()
+
+    def record(self, code, n=1):
+        with self._lock:
+            self.total += n
+            counter = self._counts.get(code)
+            if counter is not None:
+                counter[0] += n
+                return
+            if len(self._counts) < self.capacity:
+                self._counts[code] = [n, 0]
+                heapq.heappush(self._heap, (n, code))
+                return
+            # menor contador real: entradas atrasadas voltam ao heap com o valor atual
+            while True:
+                count, victim = self._heap[0]
+                current = self._counts[victim][0]
+                if current == count:
+                    break
+                heapq.heapreplace(self._heap, (current, victim))
+            del self._counts[victim]
+            self._counts[code] = [count + n, count]
+            heapq.heapreplace(self._heap, (count + n, code))
+
+    def decay(self, factor: float):
+        """Multiplica todas as contagens (meia-vida), para o top-K refletir o tráfego recente."""
+        with self._lock:
+            self.total *= factor
+            for counter in self._counts.values():
+                counter[0] *= factor
+                counter[1] *= factor
+            self._heap = [(c[0], code) for code, c in self._counts.items()]
+            heapq.heapify(self._heap)
+
+    def top(self, k: int) -> list[dict]:
+        with self._lock:
+            items = heapq.nlargest(k, self._counts.items(), key=lambda kv: kv[1][0])
+        return [{"code": code, "hits": round(count), "error": round(error)} for code, (count, error) in items]
+
+    def state(self) -> dict:
+        with self._lock:
+            return {"total": self.total, "counters": [[code, c[0], c[1]] for code, c in self._counts.items()]}
+
+    def load(self, state: dict):
+        counters = sorted(state.get("counters", []), key=lambda c: c[1], reverse=True)[:self.capacity]
+        with self._lock:
+            self.total = float(state.get("total", 0))
+            self._counts = {code: [float(count), float(error)] for code, count, error in counters}
+            self._heap = [(c[0], code) for code, c in self._counts.items()]
+            heapq.heapify(self._heap)
+
+TOP_LINKS = SpaceSaving(TOPK_CAPACITY)
+
+class LinkCache:
+    """
+    Linhas de _load_link em memória por `ttl` segundos, na frente do banco no redirect (os hits
+    continuam indo para o banco). Os códigos fixados por pin() não saem pelo LRU; o
+    _topk_loop os recarrega antes de expirarem. Uma linha lida antes de um invalidate() deste
+    processo não entra (put/pin com loaded_at): seria a configuração antiga.
+    """
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self._lru = OrderedDict()  # code -> (expira_em, link)
+        self._pinned = {}          # code -> (expira_em, link) ou None (invalidado, aguardando recarga)
+        self._invalidated = {}     # code -> monotonic do último invalidate()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, code, stale=False):
+        """
+        stale=True devolve também entradas expiradas (banco fora; ver HitSpool), sem contar
+        hit/miss: é a segunda consulta do mesmo redirect.
+        """
+        with self._lock:
+            entry = self._pinned.get(code)
+            if entry is None:
+                entry = self._lru.get(code)
+                if entry is not None and not stale:
+                    self._lru.move_to_end(code)
+            if stale:
+                return entry[1] if entry is not None else None
+            if entry is None or entry[0] <= time.monotonic():
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def _invalidated_since(self, code, loaded_at) -> bool:
+        t = self._invalidated.get(code)
+        return t is not None and t >= loaded_at
+
+    def put(self, code, link, loaded_at=None):
+        """loaded_at: time.monotonic() de antes da leitura da linha."""
+        entry = (time.monotonic() + self.ttl, link)
+        with self._lock:
+            if loaded_at is not None and self._invalidated_since(code, loaded_at):
+                return
+            if code in self._pinned:
+                self._pinned[code] = entry
+                return
+            self._lru[code] = entry
+            self._lru.move_to_end(code)
+            while len(self._lru) > self.size:
+                self._lru.popitem(last=False)
+
+    def invalidate(self, code):
+        with self._lock:
+            if code in self._pinned:
+                self._pinned[code] = None
+            self._lru.pop(code, None)
+            self._invalidated[code] = time.monotonic()
+
+    def pin(self, links: dict, loaded_at: float):
+        """
+        Fixa exatamente estes links (code -> linha de _load_link, lida a partir de loaded_at);
+        os que saem voltam ao LRU. Código invalidado durante a leitura fica fixado sem linha.
+        """
+        now = time.monotonic()
+        expires = now + self.ttl
+        with self._lock:
+            for code in [c for c in self._pinned if c not in links]:
+                entry = self._pinned.pop(code)
+                if entry is not None:
+                    self._lru[code] = entry
+            for code, link in links.items():
+                self._lru.pop(code, None)
+                fresh = not self._invalidated_since(code, loaded_at)
+                self._pinned[code] = (expires, link) if fresh else None
+            # leituras em andamento começaram há bem menos que isso
+            horizon = now - max(60.0, self.ttl)
+            self._invalidated = {c: t for c, t in self._invalidated.items() if t >= horizon}
+            while len(self._lru) > self.size:
+                self._lru.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._lru), "pinned": len(self._pinned), "hits": self.hits, "misses": self.misses}
+
+LINK_CACHE = LinkCache(LINK_CACHE_SIZE, LINK_CACHE_TTL_SECONDS) if LINK_CACHE_SIZE > 0 else None
+
+def _load_links(cur, codes) -> dict:
+    """_load_link de vários códigos em duas consultas: code -> linha (só os que existem)."""
+    cur.execute(
+        "SELECT code, type, url, distribution, cache_max_age, expires_at, version, template "
+        "FROM urls WHERE code = ANY(%s);", (codes,)
+    )
+    links = {row.pop("code"): row for row in cur.fetchall()}
+    multi = [code for code, link in links.items() if link["type"] == "multi"]
+    if multi:
+        for code in multi:
+            links[code]["targets"] = []
+        cur.execute(
+            "SELECT code, id, url, weight, hits FROM targets WHERE code = ANY(%s) ORDER BY code, id;", (multi,)
+        )
+        for t in cur.fetchall():
+            links[t.pop("code")]["targets"].append(t)
+    return links
+
+def refresh_pinned_links():
+    codes = [entry["code"] for entry in TOP_LINKS.top(TOPK_PIN)]
+    links = {}
+    loaded_at = time.monotonic()
+    if codes:
+        # no primário: uma réplica atrasada refixaria a configuração antiga de um link recém-alterado
+        with DB_POOL.connection() as conn:
+            with conn.cursor(row_factory=dict_row) as cur:
+                links = _load_links(cur, codes)
+            conn.rollback()
+    LINK_CACHE.pin(links, loaded_at)
+
+def save_topk_state(path: str):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(TOP_LINKS.state(), f)
+    os.replace(tmp_path, path)
+
+def load_topk_state(path: str):
+    try:
+        with open(path, encoding="utf-8") as f:
+            TOP_LINKS.load(json.load(f))
+    except FileNotFoundError:
+        return
+    except (ValueError, TypeError) as e:
+        print(f"Top-K: estado em {path} ignorado ({e}).")
+
+def _topk_loop():
+    """Recarrega os links fixados, aplica o decaimento e grava o estado do top-K."""
+    interval = LINK_CACHE_TTL_SECONDS / 2 if LINK_CACHE is not None and TOPK_PIN > 0 else TOPK_SAVE_SECONDS
+    interval = max(0.5, interval)
+    last_decay = last_save = time.monotonic()
+    while True:
+        try:
+            if LINK_CACHE is not None and TOPK_PIN > 0:
+                refresh_pinned_links()
+            now = time.monotonic()
+            if TOPK_HALF_LIFE_SECONDS > 0:
+                TOP_LINKS.decay(0.5 ** ((now - last_decay) / TOPK_HALF_LIFE_SECONDS))
+                last_decay = now
+            if TOPK_STATE_PATH and now - last_save >= TOPK_SAVE_SECONDS:
+                save_topk_state(TOPK_STATE_PATH)
+                last_save = now
+        except Exception as e:
+            print(f"Top-K: erro ao atualizar: {e}")
+        time.sleep(interval)
+
+# -------------------- Spool de hits (banco fora) --------------------
+DB_UNAVAILABLE_ERRORS = (PoolTimeout, psycopg.OperationalError)
+
+class HitSpool:
+    """
+    Hits que não chegaram ao banco, uma linha JSON por hit em segmentos append-only
+    (proc-<pid>-<aleatório>/hits-<ns>-<aleatório>.log). As escritas vão para o buffer do arquivo;
+    uma thread faz flush+fsync a cada fsync_seconds (ou fsync_batch hits pendentes) e outra
+    reaplica os segmentos fechados. Cada segmento é reaplicado numa transação que também grava
+    seu nome em hit_spool_segments: se o processo cair entre o COMMIT e a remoção do arquivo, a
+    próxima reaplicação encontra o nome e só remove o arquivo.
+
+    O subdiretório de cada processo tem um .lock com flock exclusivo até o processo terminar.
+    Só são adotados (movidos para o subdiretório próprio) segmentos de subdiretórios cujo lock
+    está livre, então nunca se reaplica um segmento que outro processo ainda está escrevendo.
+    """
+
+    def __init__(self, directory: str, fsync_seconds: float, fsync_batch: int, segment_bytes: int,
+                 max_bytes: int, replay_seconds: float, retry_seconds: float):
+        self.directory = directory
+        self.fsync_seconds = fsync_seconds
+        self.fsync_batch = fsync_batch
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.replay_seconds = replay_seconds
+        self.retry_seconds = retry_seconds
+        self._cond = threading.Condition()
+        self._file = None          # segmento aberto para escrita
+        self._path = None
+        self._file_bytes = 0
+        self._pending = 0          # hits escritos desde o último fsync
+        self._sealed = []          # segmentos fechados aguardando reaplicação (em ordem)
+        self._sizes = {}           # segmento fechado -> bytes (contados em self.bytes)
+        self._own = None           # subdiretório deste processo
+        self._lock_fd = None
+        self.adopted = 0
+        self.bytes = 0
+        self.written = 0
+        self.replayed = 0
+        self.dropped = 0
+        self.db_down_until = 0.0
+        self.last_error = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        # travado antes de ganhar o nome "proc-": ninguém adota um subdiretório recém-criado
+        name = f"proc-{os.getpid()}-{os.urandom(4).hex()}"
+        tmp = os.path.join(self.directory, "." + name)
+        os.makedirs(tmp)
+        self._lock_fd = os.open(os.path.join(tmp, ".lock"), os.O_CREAT | os.O_RDWR, 0o644)
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._own = os.path.join(self.directory, name)
+        os.rename(tmp, self._own)
+        self._adopt_orphans()
+        threading.Thread(target=self._sync_loop, name="hit-spool-fsync", daemon=True).start()
+        threading.Thread(target=self._replay_loop, name="hit-spool-replay", daemon=True).start()
+
+    def db_down(self) -> bool:
+        return time.monotonic() < self.db_down_until
+
+    def mark_down(self):
+        self.db_down_until = time.monotonic() + self.retry_seconds
+
+    def append(self, code, n, target_id=None):
+        line = json.dumps({"c": code, "n": n, "t": target_id, "ts": round(time.time(), 3)}, separators=(",", ":"))
+        data = (line + "\n").encode("utf-8")
+        with self._cond:
+            if self.bytes + len(data) > self.max_bytes:
+                self.dropped += n
+                return
+            if self._file is None:
+                self._path = os.path.join(self._own, f"hits-{time.time_ns()}-{os.urandom(4).hex()}.log")
+                self._file = open(self._path, "ab")
+                self._file_bytes = 0
+            self._file.write(data)
+            self._file_bytes += len(data)
+            self.bytes += len(data)
+            self.written += n
+            self._pending += 1
+            if self._pending >= self.fsync_batch:
+                self._cond.notify()
+
+    def _seal(self):
+        """Fecha o segmento atual (chamado com o lock); o próximo append abre outro."""
+        self._file.close()
+        self._sealed.append(self._path)
+        self._sizes[self._path] = self._file_bytes
+        self._file = self._path = None
+
+    def _adopt_orphans(self):
+        """Move para o subdiretório próprio os segmentos de processos que já terminaram."""
+        for name in sorted(os.listdir(self.directory)):
+            orphan = os.path.join(self.directory, name)
+            if not name.startswith("proc-") or orphan == self._own:
+                continue
+            try:
+                fd = os.open(os.path.join(orphan, ".lock"), os.O_RDWR)
+            except OSError:
+                continue  # adotado e removido por outro processo agora mesmo
+            try:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # processo vivo
+                for seg in sorted(os.listdir(orphan)):
+                    if seg.startswith("hits-") and seg.endswith(".log"):
+                        path = os.path.join(self._own, seg)  # mesmo nome: é a chave em hit_spool_segments
+                        os.rename(os.path.join(orphan, seg), path)
+                        size = os.path.getsize(path)
+                        with self._cond:
+                            self._sealed.append(path)
+                            self._sizes[path] = size
+                            self.bytes += size
+                            self.adopted += 1
+                os.remove(os.path.join(orphan, ".lock"))
+                os.rmdir(orphan)
+            except OSError as e:
+                ACCESS_LOGGER.event(f"Spool: não foi possível adotar {name}: {e}")
+            finally:
+                os.close(fd)
+
+    def _forget(self, path):
+        with self._cond:
+            self._sealed.remove(path)
+            self.bytes -= self._sizes.pop(path, 0)
+
+    def _sync_loop(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending >= self.fsync_batch, timeout=self.fsync_seconds)
+                f, pending = self._file, self._pending
+                if f is not None and pending:
+                    f.flush()
+                self._pending = 0
+            if f is not None and pending:
+                try:
+                    os.fsync(f.fileno())  # fora do lock: os redirects seguem escrevendo no buffer
+                except (OSError, ValueError):
+                    pass  # segmento fechado no meio do caminho: close() já gravou o buffer
+
+    def _replay_loop(self):
+        while True:
+            try:
+                self._adopt_orphans()
+            except OSError as e:
+                ACCESS_LOGGER.event(f"Spool: erro ao procurar segmentos órfãos: {e}")
+            with self._cond:
+                if self._file is not None and (not self._sealed or self._file_bytes >= self.segment_bytes):
+                    self._file.flush()
+                    os.fsync(self._file.fileno())
+                    self._seal()
+                sealed = list(self._sealed)
+            for path in sealed:
+                try:
+                    self._replay(path)
+                except FileNotFoundError:
+                    ACCESS_LOGGER.event(f"Spool: {os.path.basename(path)} sumiu antes de ser reaplicado.")
+                    self._forget(path)
+                    continue
+                except Exception as e:
+                    error = f"{type(e).__name__}: {e}"
+                    if error != self.last_error:  # uma linha por tipo de falha, não por tentativa
+                        ACCESS_LOGGER.event(f"Spool: reaplicação de {os.path.basename(path)} adiada: {error}")
+                    self.last_error = error
+                    break
+                self._forget(path)
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                self.db_down_until = 0.0  # o banco respondeu
+                self.last_error = None
+            time.sleep(self.replay_seconds)
+
+    def _replay(self, path):
+        hits = {}     # code -> [hits, último hit (epoch)]
+        targets = {}  # target_id -> hits
+        with open(path, "rb") as f:
+            for raw in f:
+                try:
+                    rec = json.loads(raw)
+                except ValueError:
+                    continue  # linha cortada por queda no meio da escrita
+                entry = hits.setdefault(rec["c"], [0, 0.0])
+                entry[0] += rec["n"]
+                entry[1] = max(entry[1], rec["ts"])
+                if rec.get("t") is not None:
+                    targets[rec["t"]] = targets.get(rec["t"], 0) + 1
+        segment = os.path.basename(path)[:-len(".log")]
+        total = sum(n for n, _ in hits.values())
+        with DB_POOL.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "INSERT INTO hit_spool_segments(segment, hits) VALUES (%s,%s) ON CONFLICT (segment) DO NOTHING;",
+                    (segment, total)
+                )
+                applied = cur.rowcount > 0
+                if applied and hits:
+                    cur.executemany(
+                        "UPDATE urls SET hits = hits + %s, last_hit_at = GREATEST(last_hit_at, to_timestamp(%s)) "
+                        "WHERE code = %s;",
+                        [(n, ts, code) for code, (n, ts) in hits.items()]
+                    )
+                    if targets:
+                        cur.executemany(
+                            "UPDATE targets SET hits = hits + %s WHERE id = %s;",
+                            [(n, target_id) for target_id, n in targets.items()]
+                        )
+            conn.commit()
+        if applied:
+            self.replayed += total
+
+    def stats(self) -> dict:
+        with self._cond:
+            paths = self._sealed + ([self._path] if self._path else [])
+            oldest = min((int(os.path.basename(p).split("-")[1]) / 1e9 for p in paths), default=None)
+            return {
+                "segments": len(paths), "bytes": self.bytes, "written": self.written,
+                "replayed": self.replayed, "dropped": self.dropped, "adopted": self.adopted,
+                "db_down": self.db_down(),
+                "replay_lag_seconds": round(time.time() - oldest, 3) if oldest is not None else 0.0,
+                "last_error": self.last_error,
+            }
+
+HIT_SPOOL = HitSpool(
+    HIT_SPOOL_DIR, HIT_SPOOL_FSYNC_SECONDS, HIT_SPOOL_FSYNC_BATCH, HIT_SPOOL_SEGMENT_BYTES,
+    HIT_SPOOL_MAX_BYTES, HIT_SPOOL_REPLAY_SECONDS, HIT_SPOOL_RETRY_SECONDS,
+) if HIT_SPOOL_DIR else None
+
+# -------------------- Índice binário (mmap) --------------------
+# Layout (little-endian): cabeçalho | buckets (uint32: nº do registro + 1, 0 = vazio;
+# sondagem linear pelo hash do código) | links (tamanho fixo) | destinos (tamanho fixo,
+# com peso acumulado por link) | strings UTF-8 referenciadas por (offset, tamanho).
+_IDX_MAGIC = b"SHRTIDX3"
+_IDX_HEADER = struct.Struct("<8sQIII")     # magic, geração (ns), buckets, links, destinos
+_IDX_BUCKET = struct.Struct("<I")
+_IDX_LINK = struct.Struct("<QIHBBIIiqIIqB")  # hash, code (off, len), type, distribution, url (off, len),
+                                             # cache_max_age (-1 = NULL), expires_at (ms, 0 = NULL),
+                                             # destinos (início, qtd), urls.version, template
+_IDX_TARGET = struct.Struct("<qIIdd")      # id, url (off, len), peso, peso acumulado
+_IDX_TYPES = ("single", "multi")
+
+def export_link_index(path: str) -> int:
+    """
+    Grava o índice de urls+targets em path. Escreve num temporário e troca com os.replace,
+    então leitores nunca veem um arquivo pela metade. Retorna o número de links.
+    """
+    generation = time.time_ns()  # antes do snapshot: alterações locais depois disso seguem no banco
+    with DB_POOL.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;")
+            cur.execute(
+                "SELECT code, type, url, distribution, cache_max_age, expires_at, version, template "
+                "FROM urls ORDER BY code;"
+            )
+            links = cur.fetchall()
+            cur.execute("SELECT code, id, url, weight FROM targets ORDER BY code, id;")
+            targets = {}
+            for code, tid, url, weight in cur:
+                targets.setdefault(code, []).append((tid, url, float(weight)))
+        conn.rollback()
+
+    strings = bytearray()
+
+    def put(text):
+        raw = text.encode("utf-8")
+        strings.extend(raw)
+        return len(strings) - len(raw), len(raw)
+
+    nbuckets = 8
+    while nbuckets < 2 * len(links):
+        nbuckets *= 2
+    buckets = [0] * nbuckets
+    link_recs = bytearray()
+    target_recs = bytearray()
+    ntargets = 0
+    for i, (code, kind, url, distribution, cache_max_age, expires_at, version, template) in enumerate(links):
+        h = _hash64(code)
+        slot = h & (nbuckets - 1)
+        while buckets[slot]:
+            slot = (slot + 1) & (nbuckets - 1)
+        buckets[slot] = i + 1
+        ts = targets.get(code, [])
+        cum = 0.0
+        for tid, turl, w in ts:
+            cum += w
+            target_recs += _IDX_TARGET.pack(tid, *put(turl), w, cum)
+        link_recs += _IDX_LINK.pack(
+            h, *put(code), _IDX_TYPES.index(kind), DISTRIBUTIONS.index(distribution), *put(url or ""),
+            -1 if cache_max_age is None else cache_max_age,
+            0 if expires_at is None else int(expires_at.timestamp() * 1000),
+            ntargets, len(ts), version, template
+        )
+        ntargets += len(ts)
+
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "wb") as f:
+        f.write(_IDX_HEADER.pack(_IDX_MAGIC, generation, nbuckets, len(links), ntargets))
+        f.write(struct.pack(f"<{nbuckets}I", *buckets))
+        f.write(link_recs)
+        f.write(target_recs)
+        f.write(strings)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    print(f"{path}: {len(links)} links, {ntargets} destinos.")
+    return len(links)
+
+class LinkIndex:
+    """
+    Leitor do índice. O mmap fica no page cache, compartilhado pelos processos do host.
+    Um stat a cada LINK_INDEX_CHECK_SECONDS detecta a troca do arquivo e passa a usar a
+    nova geração; leituras em andamento continuam no mmap antigo até soltá-lo.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._gen = None       # geração atual (dict), trocada por inteiro
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._stale = {}       # code -> time_ns da alteração feita por este processo
+        self.hits = 0
+        self.misses = 0
+
+    def _current(self):
+        now = time.monotonic()
+        if now - self._checked_at >= LINK_INDEX_CHECK_SECONDS and self._lock.acquire(blocking=False):
+            try:
+                self._checked_at = now
+                self._reload()
+            except (OSError, ValueError, struct.error) as e:
+                ACCESS_LOGGER.event(f"Índice {self.path}: erro ao carregar, mantendo a geração atual: {e}")
+            finally:
+                self._lock.release()
+        return self._gen
+
+    def _reload(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            self._gen = None
+            return
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if self._gen is not None and self._gen["key"] == key:
+            return
+        with open(self.path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, generation, nbuckets, nlinks, ntargets = _IDX_HEADER.unpack_from(mm, 0)
+        if magic != _IDX_MAGIC:
+            raise ValueError("formato desconhecido")
+        links = _IDX_HEADER.size + _IDX_BUCKET.size * nbuckets
+        targets = links + _IDX_LINK.size * nlinks
+        self._gen = {
+            "key": key, "mm": mm, "generation": generation, "mask": nbuckets - 1, "links": links,
+            "targets": targets, "strings": targets + _IDX_TARGET.size * ntargets, "nlinks": nlinks,
+            "expired": False,
+        }
+        # alterações locais anteriores a esta exportação já estão no arquivo
+        self._stale = {c: t for c, t in self._stale.items() if t >= generation}
+        ACCESS_LOGGER.event(f"Índice de links: geração {generation} com {nlinks} links.")
+
+    def invalidate(self, code):
+        """Código alterado por este processo: volta ao banco até a próxima exportação."""
+        with self._lock:
+            self._stale[code] = time.time_ns()
+
+    @staticmethod
+    def _str(g, off, n) -> str:
+        base = g["strings"] + off
+        return g["mm"][base:base + n].decode("utf-8")
+
+    def _find(self, g, code):
+        mm = g["mm"]
+        key = code.encode("utf-8")
+        h = _hash64(code)
+        slot = h & g["mask"]
+        while True:
+            (n,) = _IDX_BUCKET.unpack_from(mm, _IDX_HEADER.size + _IDX_BUCKET.size * slot)
+            if n == 0:
+                return None
+            rec = _IDX_LINK.unpack_from(mm, g["links"] + _IDX_LINK.size * (n - 1))
+            if rec[0] == h and mm[g["strings"] + rec[1]:g["strings"] + rec[1] + rec[2]] == key:
+                return rec
+            slot = (slot + 1) & g["mask"]
+
+    def _target(self, g, i) -> dict:
+        tid, off, n, weight, _ = _IDX_TARGET.unpack_from(g["mm"], g["targets"] + _IDX_TARGET.size * i)
+        return {"id": tid, "url": self._str(g, off, n), "weight": weight, "hits": 0}
+
+    def _pick_weighted(self, g, start, count) -> dict:
+        """Sorteio ponderado por busca binária nos pesos acumulados, sem materializar os destinos."""
+        mm, base, size = g["mm"], g["targets"] + _IDX_TARGET.size * start, _IDX_TARGET.size
+        total = _IDX_TARGET.unpack_from(mm, base + size * (count - 1))[4]
+        if total <= 0:
+            return self._target(g, start + random.randrange(count))
+        r = random.random() * total
+        lo, hi = 0, count - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if _IDX_TARGET.unpack_from(mm, base + size * mid)[4] > r:
+                hi = mid
+            else:
+                lo = mid + 1
+        return self._target(g, start + lo)
+
+    def resolve(self, code, visitor=None):
+        """
+        (destino, cache_max_age, hits a somar, target_id, urls.version, template): _redirect_decision
+        mais a versão exportada, conferida na contagem, e a flag de template. None = sem índice, geração vencida, código fora
+        dele, alterado aqui depois da exportação ou "swrr" (o estado depende de targets.hits):
+        nesses casos vale o banco.
+        """
+        g = self._current()
+        if g is None or code in self._stale:
+            return None
+        if LINK_INDEX_MAX_AGE_SECONDS and time.time_ns() - g["generation"] > LINK_INDEX_MAX_AGE_SECONDS * 1e9:
+            if not g["expired"]:
+                g["expired"] = True
+                ACCESS_LOGGER.event(f"Índice de links: geração {g['generation']} vencida, consultando o banco.")
+            return None
+        rec = self._find(g, code)
+        if rec is None:
+            self.misses += 1
+            return None
+        _, _, _, kind, dist, url_off, url_len, max_age, exp_ms, t_start, t_count, version, template = rec
+        template = bool(template)
+        distribution = DISTRIBUTIONS[dist]
+        if _IDX_TYPES[kind] == "multi" and distribution == "swrr":
+            return None
+        self.hits += 1
+        link = {
+            "type": _IDX_TYPES[kind],
+            "url": self._str(g, url_off, url_len),
+            "distribution": distribution,
+            "cache_max_age": None if max_age < 0 else max_age,
+            "expires_at": datetime.fromtimestamp(exp_ms / 1000, timezone.utc) if exp_ms else None,
+        }
+        if link["type"] == "multi":
+            expired = exp_ms and exp_ms <= time.time() * 1000
+            if t_count and not expired and not (distribution == "sticky" and visitor):
+                if link["expires_at"] is not None:
+                    remember_expiry(code, link["expires_at"])
+                row = self._pick_weighted(g, t_start, t_count)
+                return row["url"], None, 1, row["id"], version, template
+            link["targets"] = [self._target(g, t_start + i) for i in range(t_count)]
+        return (*_redirect_decision(code, link, visitor), version, template)
+
+    def stats(self) -> dict:
+        g = self._gen
+        return {
+            "path": self.path, "generation": g["generation"] if g else None, "links": g["nlinks"] if g else 0,
+            "hits": self.hits, "misses": self.misses, "stale": len(self._stale),
+        }
+
+LINK_INDEX = LinkIndex(LINK_INDEX_PATH) if LINK_INDEX_PATH else None
+
+# -------------------- Importação de logs de CDN --------------------
+# Common/Combined Log Format: ... "GET /codigo HTTP/1.1" 301 ...
+_CDN_LOG_RE = re.compile(r'"(?:GET|HEAD) (/[^ "?#]*)[^ "]* HTTP/[0-9.]+" (\d{3}) ')
+_CDN_LOG_TIME_RE = re.compile(r'\[(\d{2}/\w{3}/\d{4}:\d{2}:\d{2}:\d{2} [+-]\d{4})\]')
+
+def _cdn_log_time(line: str):
+    """Epoch do [dd/Mon/aaaa:hh:mm:ss +zzzz] da linha; None se ausente/inválido."""
+    m = _CDN_LOG_TIME_RE.search(line)
+    if not m:
+        return None
+    try:
+        return datetime.strptime(m.group(1), "%d/%b/%Y:%H:%M:%S %z").timestamp()
+    except ValueError:
+        return None
+
+def import_cdn_log(path: str) -> int:
+    """
+    Soma em urls.hits os redirects servidos pelo CDN (status 301/302/308) para links SINGLE
+    cacheáveis. Idempotente: o SHA-256 do arquivo fica em cdn_log_imports e reimportar o
+    mesmo arquivo não conta de novo. Aceita .gz. Use com CACHE_HIT_SOURCE=cdnlog.
+    last_hit_at avança até o último acesso do log (ou agora, sem data na linha).
+    Retorna o total de hits aplicados.
+    """
+    if CACHE_HIT_SOURCE != "cdnlog":
+        print("Aviso: CACHE_HIT_SOURCE não é 'cdnlog'; a origem também está contando esses links.")
+    digest = hashlib.sha256()
+    counts = {}
+    last_seen = {}  # code -> epoch do último acesso no log (None = sem data)
+    lines = 0
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        for raw in f:
+            digest.update(raw)
+            lines += 1
+            line = raw.decode("utf-8", "replace")
+            m = _CDN_LOG_RE.search(line)
+            if not m or m.group(2) not in ("301", "302", "308"):
+                continue
+            code = urllib.parse.unquote(m.group(1).lstrip("/"))
+            if code:
+                counts[code] = counts.get(code, 0) + 1
+                at = _cdn_log_time(line)
+                if code not in last_seen or (at is not None and (last_seen[code] or 0) < at):
+                    last_seen[code] = at
+
+    with DB_POOL.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO cdn_log_imports(digest, path, lines, hits) VALUES (%s,%s,%s,0) "
+                "ON CONFLICT (digest) DO NOTHING RETURNING digest;",
+                (digest.hexdigest(), path, lines)
+            )
+            if cur.fetchone() is None:
+                print(f"{path}: já importado, ignorando.")
+                return 0
+            cur.execute("""
+                WITH v AS (SELECT unnest(%s::text[]) AS code, unnest(%s::bigint[]) AS n,
+                                  unnest(%s::float8[]) AS at),
+                upd AS (
+                  UPDATE urls u SET hits = u.hits + v.n,
+                    last_hit_at = GREATEST(u.last_hit_at, COALESCE(to_timestamp(v.at), now()))
+                  FROM v
+                  WHERE u.code = v.code AND u.type = 'single' AND u.cache_max_age IS NOT NULL
+                  RETURNING v.n
+                )
+                SELECT COALESCE(SUM(n), 0) FROM upd;
+            """, (list(counts), list(counts.values()), [last_seen[c] for c in counts]))
+            applied = cur.fetchone()[0]
+            cur.execute("UPDATE cdn_log_imports SET hits = %s WHERE digest = %s;", (applied, digest.hexdigest()))
+        conn.commit()
+    print(f"{path}: {lines} linhas, {applied} hits aplicados.")
+    return applied
+
+# -------------------- QR code --------------------
+# Codificador próprio: modo byte, correção de erros nível M, versões 1–40, máscara escolhida
+# pela penalidade da ISO/IEC 18004. Tabelas indexadas pela versão (índice 0 não usado).
+_QR_ECC_PER_BLOCK = (
+    -1, 10, 16, 26, 18, 24, 16, 18, 22, 22, 26, 30, 22, 22, 24, 24, 28, 28, 26, 26, 26,
+    26, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28,
+)
+_QR_BLOCKS = (
+    -1, 1, 1, 1, 2, 2, 4, 4, 4, 5, 5, 5, 8, 9, 9, 10, 10, 11, 13, 14, 16,
+    17, 17, 18, 20, 21, 23, 25, 26, 28, 29, 31, 33, 35, 37, 38, 40, 43, 45, 47, 49,
+)
+_QR_FORMAT_M = 0b00  # bits do nível M no formato
+_QR_REV = "1"        # entra no ETag: mudar o desenho invalida os caches
+
+_GF_EXP = [0] * 512
+_GF_LOG = [0] * 256
+_v = 1
+for _i in range(255):
+    _GF_EXP[_i] = _v
+    _GF_LOG[_v] = _i
+    _v <<= 1
+    if _v & 0x100:
+        _v ^= 0x11D
+for _i in range(255, 512):
+    _GF_EXP[_i] = _GF_EXP[_i - 255]
+del _v, _i
+
+def _gf_mul(a: int, b: int) -> int:
+    return 0 if a == 0 or b == 0 else _GF_EXP[_GF_LOG[a] + _GF_LOG[b]]
+
+@functools.lru_cache(maxsize=None)
+def _rs_divisor(degree: int) -> tuple:
+    """Coeficientes (sem o líder) do gerador Reed-Solomon de grau `degree`."""
+    result = [0] * (degree - 1) + [1]
+    root = 1
+    for _ in range(degree):
+        for j in range(degree):
+            result[j] = _gf_mul(result[j], root)
+            if j + 1 < degree:
+                result[j] ^= result[j + 1]
+        root = _gf_mul(root, 0x02)
+    return tuple(result)
+
+def _rs_remainder(data, divisor) -> list:
+    result = [0] * len(divisor)
+    for b in data:
+        factor = b ^ result.pop(0)
+        result.append(0)
+        for i, coef in enumerate(divisor):
+            result[i] ^= _gf_mul(coef, factor)
+    return result
+
+def _qr_raw_modules(version: int) -> int:
+    """Módulos de dados (com correção) da versão: área total menos padrões fixos."""
+    result = (16 * version + 128) * version + 64
+    if version >= 2:
+        n = version // 7 + 2
+        result -= (25 * n - 10) * n - 55
+        if version >= 7:
+            result -= 36
+    return result
+
+def _qr_data_codewords(version: int) -> int:
+    return _qr_raw_modules(version) // 8 - _QR_ECC_PER_BLOCK[version] * _QR_BLOCKS[version]
+
+def _qr_alignment_positions(version: int) -> list:
+    if version == 1:
+        return []
+    n = version // 7 + 2
+    size = version * 4 + 17
+    step = (version * 8 + n * 3 + 5) // (n * 4 - 4) * 2
+    return [6] + sorted(size - 7 - i * step for i in range(n - 1))
+
+def _qr_codewords(data: bytes, version: int) -> list:
+    """Bits do modo byte + terminador + preenchimento, com correção intercalada por bloco."""
+    bits = []
+    def put(value, length):
+        bits.extend((value >> i) & 1 for i in reversed(range(length)))
+    put(0b0100, 4)
+    put(len(data), 8 if version <= 9 else 16)
+    for b in data:
+        put(b, 8)
+    capacity = _qr_data_codewords(version) * 8
+    put(0, min(4, capacity - len(bits)))
+    put(0, -len(bits) % 8)
+    codewords = [int("".join(map(str, bits[i:i + 8])), 2) for i in range(0, len(bits), 8)]
+    for pad in itertools.cycle((0xEC, 0x11)):
+        if len(codewords) * 8 >= capacity:
+            break
+        codewords.append(pad)
+
+    num_blocks, ecc_len = _QR_BLOCKS[version], _QR_ECC_PER_BLOCK[version]
+    raw = _qr_raw_modules(version) // 8
+    num_short = num_blocks - raw % num_blocks
+    short_len = raw // num_blocks
+    divisor = _rs_divisor(ecc_len)
+    blocks, k = [], 0
+    for i in range(num_blocks):
+        block = codewords[k:k + short_len - ecc_len + (0 if i < num_short else 1)]
+        k += len(block)
+        ecc = _rs_remainder(block, divisor)
+        if i < num_short:
+            block.append(0)  # posição vazia: blocos curtos têm um codeword a menos
+        blocks.append(block + ecc)
+    return [
+        block[i]
+        for i in range(len(blocks[0]))
+        for j, block in enumerate(blocks)
+        if i != short_len - ecc_len or j >= num_short
+    ]
+
+_QR_MASKS = (
+    lambda x, y: (x + y) % 2 == 0,
+    lambda x, y: y % 2 == 0,
+    lambda x, y: x % 3 == 0,
+    lambda x, y: (x + y) % 3 == 0,
+    lambda x, y: (x // 3 + y // 2) % 2 == 0,
+    lambda x, y: x * y % 2 + x * y % 3 == 0,
+    lambda x, y: (x * y % 2 + x * y % 3) % 2 == 0,
+    lambda x, y: ((x + y) % 2 + x * y % 3) % 2 == 0,
+)
+_QR_FINDER_LIKE = ("10111010000", "00001011101")
+
+def _qr_penalty(modules) -> int:
+    size = len(modules)
+    score = 0
+    lines = ["".join("1" if m else "0" for m in row) for row in modules]
+    lines += ["".join("1" if modules[y][x] else "0" for y in range(size)) for x in range(size)]
+    for line in lines:
+        for run in re.findall(r"0{5,}|1{5,}", line):
+            score += 3 + len(run) - 5
+        padded = "0000" + line + "0000"  # a zona de silêncio conta como clara
+        for pattern in _QR_FINDER_LIKE:
+            i = padded.find(pattern)
+            while i != -1:
+                score += 40
+                i = padded.find(pattern, i + 1)
+    for y in range(size - 1):
+        for x in range(size - 1):
+            c = modules[y][x]
+            if c == modules[y][x + 1] == modules[y + 1][x] == modules[y + 1][x + 1]:
+                score += 3
+    dark = sum(map(sum, modules))
+    total = size * size
+    score += ((abs(dark * 20 - total * 10) + total - 1) // total - 1) * 10
+    return score
+
+def qr_matrix(text: str, mask: int | None = None) -> list:
+    """Matriz (lista de linhas de bool, True = escuro) do QR code de `text`, sem a borda."""
+    data = text.encode("utf-8")
+    for version in range(1, 41):
+        if 4 + (8 if version <= 9 else 16) + 8 * len(data) <= _qr_data_codewords(version) * 8:
+            break
+    else:
+        raise ValueError("Texto longo demais para um QR code.")
+    size = version * 4 + 17
+    modules = [[False] * size for _ in range(size)]
+    function = [[False] * size for _ in range(size)]
+
+    def fixed(x, y, dark):
+        modules[y][x] = dark
+        function[y][x] = True
+
+    for i in range(size):
+        fixed(6, i, i % 2 == 0)
+        fixed(i, 6, i % 2 == 0)
+    for cx, cy in ((3, 3), (size - 4, 3), (3, size - 4)):
+        for dy in range(-4, 5):
+            for dx in range(-4, 5):
+                x, y = cx + dx, cy + dy
+                if 0 <= x < size and 0 <= y < size:
+                    fixed(x, y, max(abs(dx), abs(dy)) not in (2, 4))
+    positions = _qr_alignment_positions(version)
+    last = len(positions) - 1
+    for i, cx in enumerate(positions):
+        for j, cy in enumerate(positions):
+            if (i, j) in ((0, 0), (0, last), (last, 0)):
+                continue  # sobreposto aos padrões de localização
+            for dy in range(-2, 3):
+                for dx in range(-2, 3):
+                    fixed(cx + dx, cy + dy, max(abs(dx), abs(dy)) != 1)
+
+    def draw_format(mask_id):
+        value = _QR_FORMAT_M << 3 | mask_id
+        rem = value
+        for _ in range(10):
+            rem = (rem << 1) ^ ((rem >> 9) * 0x537)
+        bits = (value << 10 | rem) ^ 0x5412
+        bit = lambda i: (bits >> i) & 1 == 1
+        for i in range(6):
+            fixed(8, i, bit(i))
+        fixed(8, 7, bit(6))
+        fixed(8, 8, bit(7))
+        fixed(7, 8, bit(8))
+        for i in range(9, 15):
+            fixed(14 - i, 8, bit(i))
+        for i in range(8):
+            fixed(size - 1 - i, 8, bit(i))
+        for i in range(8, 15):
+            fixed(8, size - 15 + i, bit(i))
+        fixed(8, size - 8, True)
+
+    draw_format(0)  # reserva as posições; o valor final depende da máscara
+    if version >= 7:
+        rem = version
+        for _ in range(12):
+            rem = (rem << 1) ^ ((rem >> 11) * 0x1F25)
+        bits = version << 12 | rem
+        for i in range(18):
+            dark = (bits >> i) & 1 == 1
+            a, b = size - 11 + i % 3, i // 3
+            fixed(a, b, dark)
+            fixed(b, a, dark)
+
+    codewords = _qr_codewords(data, version)
+    i, total_bits = 0, len(codewords) * 8
+    for right in range(size - 1, 0, -2):  # colunas em pares, da direita para a esquerda, em zigue-zague
+        if right <= 6:
+            right -= 1  # pula a coluna do padrão de temporização
+        upward = (right + 1) & 2 == 0
+        for vert in range(size):
+            y = size - 1 - vert if upward else vert
+            for x in (right, right - 1):
+                if not function[y][x] and i < total_bits:
+                    modules[y][x] = (codewords[i >> 3] >> (7 - (i & 7))) & 1 == 1
+                    i += 1
+
+    def masked(mask_id):
+        test = _QR_MASKS[mask_id]
+        return [
+            [m ^ (not function[y][x] and test(x, y)) for x, m in enumerate(row)]
+            for y, row in enumerate(modules)
+        ]
+
+    candidates = range(8) if mask is None else (mask,)
+    best = None
+    for mask_id in candidates:
+        draw_format(mask_id)
+        result = masked(mask_id)
+        score = _qr_penalty(result) if mask is None else 0
+        if best is None or score < best[0]:
+            best = (score, result)
+    return best[1]
+
+def qr_png(matrix, scale: int, border: int = 4) -> bytes:
+    """PNG em tons de cinza de 1 bit (0 = preto), sem dependências: zlib + struct."""
+    size = (len(matrix) + 2 * border) * scale
+    blank = "1" * size
+    rows = []
+    for y in range(-border, len(matrix) + border):
+        line = matrix[y] if 0 <= y < len(matrix) else None
+        if line is None:
+            bits = blank
+        else:
+            edge = "1" * (border * scale)
+            bits = edge + "".join(("0" if m else "1") * scale for m in line) + edge
+        packed = b"\x00" + int(bits + "0" * (-size % 8), 2).to_bytes((size + 7) // 8, "big")
+        rows.extend([packed] * scale)
+
+    def chunk(kind, body):
+        return struct.pack(">I", len(body)) + kind + body + struct.pack(">I", zlib.crc32(kind + body))
+
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 1, 0, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(b"".join(rows), 9))
+        + chunk(b"IEND", b"")
+    )
+
+def qr_svg(matrix, border: int = 4) -> bytes:
+    """SVG com um único path: um retângulo por sequência horizontal de módulos escuros."""
+    size = len(matrix) + 2 * border
+    parts = []
+    for y, row in enumerate(matrix):
+        x = 0
+        while x < len(row):
+            if row[x]:
+                start = x
+                while x < len(row) and row[x]:
+                    x += 1
+                parts.append(f"M{start + border} {y + border}h{x - start}v1h-{x - start}z")
+            x += 1
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {size} {size}" shape-rendering="crispEdges">'
+        f'<rect width="{size}" height="{size}" fill="#fff"/><path fill="#000" d="{"".join(parts)}"/></svg>'
+    ).encode("utf-8")
+
+class QRCache:
+    """
+    Imagens prontas por ETag (derivado de URL, formato, escala e _QR_REV), num LRU limitado por
+    bytes e, com `directory`, também em disco. Uma requisição com o ETag já conhecido pelo
+    cliente nem chega aqui (304). O diretório fica limitado a `dir_max_bytes`: passando do teto,
+    os arquivos menos usados (mtime, renovado a cada leitura) são apagados até sobrar 90%.
+    """
+
+    def __init__(self, max_bytes: int, directory: str = "", dir_max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.dir_max_bytes = dir_max_bytes
+        self._items = OrderedDict()  # etag -> bytes
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self._disk_bytes = None  # estimativa; recalculada por varredura (outros processos também gravam)
+        self.hits = 0
+        self.disk_hits = 0
+        self.renders = 0
+        self.evicted = 0
+
+    @staticmethod
+    def etag(url: str, fmt: str, scale: int) -> str:
+        return '"' + hashlib.sha1(f"{_QR_REV}|{fmt}|{scale}|{url}".encode("utf-8")).hexdigest()[:20] + '"'
+
+    def get(self, url: str, fmt: str, scale: int) -> tuple[str, bytes]:
+        tag = self.etag(url, fmt, scale)
+        with self._lock:
+            body = self._items.get(tag)
+            if body is not None:
+                self._items.move_to_end(tag)
+                self.hits += 1
+                return tag, body
+        path = os.path.join(self.directory, f"{tag.strip(chr(34))}.{fmt}") if self.directory else None
+        body = None
+        if path:
+            try:
+                with open(path, "rb") as f:
+                    body = f.read()
+                os.utime(path)
+                self.disk_hits += 1
+            except FileNotFoundError:
+                pass
+        if body is None:
+            matrix = qr_matrix(url)
+            body = qr_png(matrix, scale) if fmt == "png" else qr_svg(matrix)
+            self.renders += 1
+            if path:
+                os.makedirs(self.directory, exist_ok=True)
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(body)
+                os.replace(tmp_path, path)
+                self._account_disk(len(body))
+        with self._lock:
+            if tag not in self._items and len(body) <= self.max_bytes:
+                self._items[tag] = body
+                self._bytes += len(body)
+                while self._bytes > self.max_bytes:
+                    _, old = self._items.popitem(last=False)
+                    self._bytes -= len(old)
+        return tag, body
+
+    def _account_disk(self, n: int) -> None:
+        with self._disk_lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += n
+                if self._disk_bytes <= self.dir_max_bytes:
+                    return
+            self._evict_disk()
+
+    def _evict_disk(self) -> None:
+        """Varre o diretório e apaga os arquivos mais antigos até ficar em 90% do teto."""
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith((".png", ".svg")):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        if total > self.dir_max_bytes:
+            entries.sort()
+            for _, size, file_path in entries:
+                if total <= self.dir_max_bytes * 0.9:
+                    break
+                try:
+                    os.remove(file_path)
+                    self.evicted += 1
+                except FileNotFoundError:
+                    pass
+                total -= size
+        self._disk_bytes = total
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._items), "bytes": self._bytes, "hits": self.hits,
+                    "disk_hits": self.disk_hits, "renders": self.renders,
+                    "disk_bytes": self._disk_bytes, "evicted": self.evicted}
+
+QR_CACHE = QRCache(QR_CACHE_BYTES, QR_CACHE_DIR, QR_CACHE_DIR_BYTES)
+
+def link_exists(code: str) -> bool:
+    if LINK_CACHE is not None and LINK_CACHE.get(code) is not None:
+        return True
+    with read_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1 FROM urls WHERE code = %s;", (code,), prepare=DB_PREPARE)
+            return cur.fetchone() is not None
+
+# -------------------- Sessões / Cookies --------------------
+def new_session(user_id: int, ip: str | None, user_agent: str | None) -> str:
+    token = os.urandom(32).hex()
+    expires = datetime.utcnow() + timedelta(hours=SESSION_TTL_HOURS)
+    with DB_POOL.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO sessions(token, user_id, expires_at, ip, user_agent) VALUES (%s,%s,%s,%s,%s);",
+                (token, user_id, expires, ip, user_agent)
+            )
+    return token
+
+def get_session_user(token: str | None):
+    if not token:
+        return None
+    with DB_POOL.connection() as conn:
+        with conn.cursor(row_factory=dict_row) as cur:
+            cur.execute("DELETE FROM sessions WHERE expires_at < NOW();")  # limpeza simples
+            cur.execute("""
+                SELECT u.id, u.username
+                FROM sessions s JOIN users u ON u.id = s.user_id
+                WHERE s.token = %s AND s.expires_at > NOW();
+            """, (token,))
+            return cur.fetchone()
+
+def destroy_session(token: str | None):
+    if not token:
+        return
+    with DB_POOL.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM sessions WHERE token = %s;", (token,))
+
+# -------------------- Backpressure / Load shedding --------------------
+# Pool esgotado (checkout com timeout) ou statement_timeout estourado viram 503.
+OVERLOAD_ERRORS = (PoolTimeout, psycopg.errors.QueryCanceled)
+
+_REQUEST = threading.local()  # .route: classe da rota da requisição atual
+
+def current_route():
+    return getattr(_REQUEST, "route", None)
+
+def route_class(method: str, path: str):
+    """Classe de admissão da rota; None = não usa o banco (sem limite)."""
+    if path == "help":
+        return None
+    if path in ("login", "logout", "register"):
+        return "auth"
+    if path == "events":
+        return "stream"
+    if method != "GET" or path in ("", "index.html") or path.split("/", 1)[0] in RESERVED:
+        return "api"
+    return "redirect"
+
+_CONN_TIMEOUT = weakref.WeakKeyDictionary()  # conexão -> statement_timeout (ms) já aplicado
+
+def _apply_statement_timeout(conn):
+    """Ajusta statement_timeout da sessão à rota atual; só custa um round trip quando muda."""
+    ms = int(STATEMENT_TIMEOUT_MS.get(current_route(), 0))  # sem rota (jobs de fundo) = sem limite
+    if _CONN_TIMEOUT.get(conn) == ms:
+        return
+    with conn.pipeline():
+        conn.execute(f"SET statement_timeout = {ms};")  # SET não aceita parâmetros
+        conn.commit()
+    _CONN_TIMEOUT[conn] = ms
+
+class Admission:
+    """Limite de concorrência de uma classe de rota, com fila limitada e espera máxima."""
+
+    def __init__(self, route, concurrency, queue, wait):
+        self.route = route
+        self.queue_max = int(queue)
+        self.wait = wait
+        self._slots = threading.Semaphore(int(concurrency))
+        self._lock = threading.Lock()
+        self.concurrency = int(concurrency)
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+        self.db_timeouts = 0
+
+    def acquire(self) -> bool:
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                if self.waiting >= self.queue_max:
+                    self.shed += 1
+                    return False
+                self.waiting += 1
+                self.queued += 1
+            ok = self._slots.acquire(timeout=self.wait)
+            with self._lock:
+                self.waiting -= 1
+                if not ok:
+                    self.shed += 1
+                    return False
+        with self._lock:
+            self.active += 1
+            self.admitted += 1
+        return True
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+        self._slots.release()
+
+    def count_db_timeout(self):
+        with self._lock:
+            self.db_timeouts += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "concurrency": self.concurrency, "active": self.active, "waiting": self.waiting,
+                "admitted": self.admitted, "queued": self.queued, "shed": self.shed,
+                "db_timeouts": self.db_timeouts,
+            }
+
+ADMISSION = {
+    route: Admission(route, ADMISSION_CONCURRENCY[route], ADMISSION_QUEUE.get(route, 0),
+                     ADMISSION_WAIT_SECONDS.get(route, 0))
+    for route in ADMISSION_CONCURRENCY
+}
+
+class ShortenerServer(ThreadingTCPServer):
+    """ThreadingTCPServer com teto de threads: acima de MAX_THREADS responde 503 sem criar thread."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, *args, **kwargs):
+        self._slots = threading.BoundedSemaphore(MAX_THREADS)
+        self.shed = 0
+        super().__init__(*args, **kwargs)
+
+    def process_request(self, request, client_address):
+        if not self._slots.acquire(blocking=False):
+            self.shed += 1
+            try:
+                request.sendall(
+                    f"HTTP/1.1 503 Service Unavailable\r\nRetry-After: {RETRY_AFTER_SECONDS}\r\n"
+                    "Content-Length: 0\r\nConnection: close\r\n\r\n".encode("ascii")
+                )
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        try:
+            super().process_request(request, client_address)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self._slots.release()
+
+SERVER = None  # ShortenerServer em execução (para métricas)
+
+def metrics_snapshot() -> dict:
+    """Contadores em memória deste processo (GET /metrics)."""
+    return {
+        "admission": {route: gate.stats() for route, gate in ADMISSION.items()},
+        "server": {"max_threads": MAX_THREADS, "shed": SERVER.shed if SERVER else 0},
+        "db_pool": DB_POOL.stats(),
+        "access_log": ACCESS_LOGGER.stats(),
+        "link_index": LINK_INDEX.stats() if LINK_INDEX is not None else None,
+        "events": HIT_FEED.stats(),
+        "bots": {"hits": dict(_BOT_HITS), "ua_cache": bot_kind.cache_info()._asdict()},
+        "link_cache": LINK_CACHE.stats() if LINK_CACHE is not None else None,
+        "hit_spool": HIT_SPOOL.stats() if HIT_SPOOL is not None else None,
+        "qr": QR_CACHE.stats(),
+    }
+
+# -------------------- Log de acesso --------------------
+class AccessLog:
+    """
+    Log de acesso assíncrono: a thread da requisição só enfileira um dict num buffer
+    limitado; uma thread de fundo serializa e grava em lotes. Nunca bloqueia o redirect.
+    event() usa o mesmo buffer para avisos do caminho da requisição (503, réplica fora...);
+    com ACCESS_LOG=off, só esses avisos são gravados (em stderr).
+    """
+
+    def __init__(self, target, capacity, batch, flush_seconds):
+        self.target = target
+        self.capacity = capacity
+        self.batch = batch
+        self.flush_seconds = flush_seconds
+        self._buf = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="access-log", daemon=True)
+            self._thread.start()
+
+    def submit(self, entry: dict, sample: float = 1.0):
+        if self._thread is None or self.target == "off":
+            return
+        if sample < 1.0 and random.random() >= sample:
+            with self._cond:
+                self.sampled_out += 1
+            return
+        self._enqueue(entry)
+
+    def event(self, message: str):
+        """Aviso operacional sem bloquear a requisição (antes de start(), vai direto para stderr)."""
+        if self._thread is None:
+            print(message)
+            return
+        self._enqueue({"ts": time.time(), "event": message})
+
+    def _enqueue(self, entry: dict):
+        with self._cond:
+            if len(self._buf) >= self.capacity:
+                self.dropped += 1
+                return
+            self._buf.append(entry)
+            self.enqueued += 1
+            if len(self._buf) >= self.batch:
+                self._cond.notify()
+
+    def _run(self):
+        out = sys.stderr if self.target in ("-", "off") else open(self.target, "a", encoding="utf-8")
+        while True:
+            with self._cond:
+                if len(self._buf) < self.batch:
+                    self._cond.wait(self.flush_seconds)
+                batch = list(self._buf)
+                self._buf.clear()
+            if not batch:
+                continue
+            lines = []
+            for e in batch:
+                e["ts"] = datetime.fromtimestamp(e["ts"], timezone.utc).isoformat(timespec="milliseconds")
+                lines.append(json.dumps(e, ensure_ascii=False, default=str))
+            try:
+                out.write("\n".join(lines) + "\n")
+                out.flush()
+                written, dropped = len(batch), 0
+            except OSError:
+                written, dropped = 0, len(batch)
+            with self._cond:
+                self.written += written
+                self.dropped += dropped
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "enqueued": self.enqueued, "written": self.written, "dropped": self.dropped,
+                "sampled_out": self.sampled_out, "buffered": len(self._buf),
+            }
+
+ACCESS_LOGGER = AccessLog(ACCESS_LOG, ACCESS_LOG_BUFFER, ACCESS_LOG_BATCH, ACCESS_LOG_FLUSH_SECONDS)
+
+# -------------------- Contadores ao vivo (SSE) --------------------
+_OWNERS = OrderedDict()  # code -> owner_id, para separar as janelas do /events por usuário
+_OWNERS_LOCK = threading.Lock()
+OWNER_CACHE_MAX = 100_000
+
+def link_owners(codes) -> dict:
+    """Dono de cada código: do cache em memória, e os que faltam numa única consulta."""
+    with _OWNERS_LOCK:
+        found = {c: _OWNERS[c] for c in codes if c in _OWNERS}
+    missing = [c for c in codes if c not in found]
+    if missing:
+        with DB_POOL.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT code, owner_id FROM urls WHERE code = ANY(%s);", (missing,))
+                rows = cur.fetchall()
+            conn.rollback()
+        with _OWNERS_LOCK:
+            for code, owner_id in rows:
+                found[code] = _OWNERS[code] = owner_id
+            while len(_OWNERS) > OWNER_CACHE_MAX:
+                _OWNERS.popitem(last=False)
+    return found
+
+class HitFeed:
+    """
+    Agrega os hits servidos por este processo em janelas curtas e entrega cada janela,
+    serializada uma única vez por usuário, às filas (limitadas) dos painéis conectados em
+    GET /events. Sem painel conectado, record() não guarda nada.
+    """
+
+    def __init__(self, window, queue_size):
+        self.window = window
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._links = {}    # code -> hits na janela
+        self._targets = {}  # code -> {url: hits}
+        self._subs = {}     # fila -> owner_id do painel
+        self._thread = None
+        self.windows = 0
+        self.lagged = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="hit-feed", daemon=True)
+            self._thread.start()
+
+    def record(self, code, target_url, n=1):
+        if not self._subs:
+            return
+        with self._lock:
+            self._links[code] = self._links.get(code, 0) + n
+            per_target = self._targets.setdefault(code, {})
+            per_target[target_url] = per_target.get(target_url, 0) + n
+
+    def subscribe(self, owner_id):
+        sub = queue.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._subs[sub] = owner_id
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subs.pop(sub, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.window)
+            with self._lock:
+                links, targets = self._links, self._targets
+                self._links, self._targets = {}, {}
+                subs = dict(self._subs)
+            if not links or not subs:
+                continue
+            try:
+                owners = link_owners(list(links))
+            except Exception as e:
+                print(f"Eventos: janela descartada, erro ao consultar donos: {e}")
+                continue
+            self.windows += 1
+            messages = {}  # owner_id -> janela serializada (b"" = nada desse usuário)
+            for sub, owner_id in subs.items():
+                msg = messages.get(owner_id)
+                if msg is None:
+                    mine = [c for c in links if owners.get(c) == owner_id]
+                    payload = {"links": {c: links[c] for c in mine}, "targets": {c: targets[c] for c in mine}}
+                    msg = messages[owner_id] = (
+                        ("event: hits\ndata: " + json.dumps(payload, ensure_ascii=False) + "\n\n").encode("utf-8")
+                        if mine else b""
+                    )
+                if not msg:
+                    continue
+                try:
+                    sub.put_nowait(msg)
+                except queue.Full:
+                    # painel lento: os deltas perdidos o deixariam errado; desconecta (o cliente recarrega a lista)
+                    self.unsubscribe(sub)
+                    self.lagged += 1
+                    try:
+                        sub.get_nowait()
+                        sub.put_nowait(None)
+                    except (queue.Empty, queue.Full):
+                        pass
+
+    def stats(self) -> dict:
+        return {"subscribers": len(self._subs), "windows": self.windows, "lagged": self.lagged}
+
+HIT_FEED = HitFeed(EVENTS_WINDOW_SECONDS, EVENTS_QUEUE)
+
+# -------------------- HTTP Handler --------------------
+class ShortenerHandler(http.server.SimpleHTTPRequestHandler):
+    log_status = None
+    log_target = None
+
+    # -------- Log --------
+    def send_response(self, code, message=None):
+        self.log_status = code
+        super().send_response(code, message)
+
+    def log_request(self, code="-", size="-"):
+        pass  # o acesso é registrado em dispatch(), de forma assíncrona
+
+    def log_message(self, format, *args):
+        # erros do http.server (requisição malformada, timeout...) também saem pelo log assíncrono
+        ACCESS_LOGGER.submit({"ts": time.time(), "level": "error", "ip": self.client_ip(), "msg": format % args})
+
+    # -------- Helpers de resposta --------
+    def send_json(self, raw_json, status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(raw_json.encode("utf-8"))))
+        self.end_headers()
+        self.wfile.write(raw_json.encode("utf-8"))
+
+    def respond_text(self, text, status=200):
+        data = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def respond_html(self, html, status=200):
+        data = html.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        # evitar cache da UI
+        self.send_header("Cache-Control", "no-store, no-cache, must-revalidate, max-age=0")
+        self.send_header("Pragma", "no-cache")
+        self.send_header("Expires", "0")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def redirect(self, location: str, status=302):
+        self.send_response(status)
+        self.send_header("Location", location)
+        self.end_headers()
+
+    # -------- Cookies / Auth --------
+    def get_cookie(self, name: str):
+        cookies = self.headers.get("Cookie", "")
+        for c in cookies.split(";"):
+            c = c.strip()
+            if not c: continue
             if "=" not in c: continue
             k, v = c.split("=", 1)
             if k.strip() == name:
@@ -889,16 +3949,38 @@ class ShortenerHandler(http.server.SimpleHTTPRequestHandler):
             parts.append("Secure")
         self.send_header("Set-Cookie", "; ".join(parts))
 
+    def client_ip(self) -> str:
+        # atrás do proxy do Render o IP real vem no primeiro item do X-Forwarded-For
+        fwd = self.headers.get("X-Forwarded-For")
+        if fwd:
+            return fwd.split(",", 1)[0].strip()
+        return self.client_address[0] if self.client_address else ""
+
+    def visitor_key(self) -> tuple[str, bool]:
+        """Chave estável do visitante: cookie 'vid' ou hash de IP+User-Agent. Retorna (chave, veio_do_cookie)."""
+        vid = self.get_cookie(VISITOR_COOKIE)
+        if vid:
+            return vid, True
+        raw = f"{self.client_ip()}|{self.headers.get('User-Agent', '')}"
+        return hashlib.blake2b(raw.encode("utf-8"), digest_size=12).hexdigest(), False
+
+    def set_visitor_cookie(self, vid: str):
+        parts = [f"{VISITOR_COOKIE}={vid}", "Path=/", "HttpOnly", "SameSite=Lax", "Max-Age=31536000"]
+        if COOKIE_SECURE:
+            parts.append("Secure")
+        self.send_header("Set-Cookie", "; ".join(parts))
+
     def current_user(self):
         token = self.get_cookie("session")
         return get_session_user(token)
 
-    def require_auth_api(self) -> bool:
-        """Para endpoints de API (retorna 401 em vez de redirecionar)."""
-        if self.current_user():
-            return True
+    def require_auth_api(self):
+        """Para endpoints de API (retorna 401 em vez de redirecionar). Retorna o usuário logado ou None."""
+        user = self.current_user()
+        if user:
+            return user
         self.respond_text("Não autorizado.", status=401)
-        return False
+        return None
 
     def require_auth_page(self) -> bool:
         """Para páginas HTML (redireciona ao /login)."""
@@ -907,8 +3989,61 @@ class ShortenerHandler(http.server.SimpleHTTPRequestHandler):
         self.redirect("/login")
         return False
 
-    # -------------------- GET --------------------
+    def respond_overloaded(self):
+        data = "Servidor sobrecarregado, tente novamente.".encode("utf-8")
+        self.send_response(503)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Retry-After", str(RETRY_AFTER_SECONDS))
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # -------- Admissão --------
     def do_GET(self):
+        self.dispatch(self.handle_get)
+
+    def do_POST(self):
+        self.dispatch(self.handle_post)
+
+    def dispatch(self, handler):
+        """Aplica a admissão da classe da rota e converte esgotamento do banco em 503."""
+        t0 = time.perf_counter()
+        path = urllib.parse.urlparse(self.path).path.lstrip("/")
+        route = route_class(self.command, path)
+        self.log_status = None
+        self.log_target = None
+        _REQUEST.db_time = 0.0
+        gate = ADMISSION.get(route)
+        if gate is not None and not gate.acquire():
+            self.respond_overloaded()
+        else:
+            _REQUEST.route = route
+            try:
+                handler()
+            except OVERLOAD_ERRORS as e:
+                if gate is not None:
+                    gate.count_db_timeout()
+                ACCESS_LOGGER.event(f"503 em /{route}: {type(e).__name__}: {e}")
+                self.respond_overloaded()
+            finally:
+                _REQUEST.route = None
+                if gate is not None:
+                    gate.release()
+        status = self.log_status or 0
+        ACCESS_LOGGER.submit({
+            "ts": time.time(),
+            "route": route,
+            "method": self.command,
+            "code" if route == "redirect" else "path": path,
+            "status": status,
+            "latency_ms": round((time.perf_counter() - t0) * 1000, 2),
+            "db_ms": round(_REQUEST.db_time * 1000, 2),
+            "target": self.log_target,
+            "ip": self.client_ip(),
+        }, sample=1.0 if status >= 500 else ACCESS_LOG_SAMPLE.get(route, 1.0))
+
+    # -------------------- GET --------------------
+    def handle_get(self):
         parsed = urllib.parse.urlparse(self.path)
         path = parsed.path.lstrip("/")
 
@@ -931,37 +4066,116 @@ class ShortenerHandler(http.server.SimpleHTTPRequestHandler):
                 "Endpoints:\n"
                 " POST /login { user, password }\n"
                 " POST /logout\n"
-                " POST /new { urls:[...], weights:[...], code?:slug }\n"
-                " POST /update { code, new_code?, urls, weights }\n"
+                " POST /new { urls:[...], weights:[...], code?:slug (ou prefixo/*), distribution?:random|sticky|swrr, cache_max_age?:segundos, expires_at?:ISO8601, forward_path?:bool, template?:bool }\n"
+                " POST /update { code, new_code?, urls, weights, distribution?, cache_max_age?, expires_at?, forward_path?, template? }\n"
                 " POST /delete { code }\n"
-                " GET /list (autenticado)\n"
-                " GET /get/{code} (autenticado)\n"
+                " POST /bulk/targets { action:replace|remove|reweight, url?|phone?, new_url?|new_phone?, weight? }\n"
+                " GET /list (autenticado; links do usuário)\n"
+                " GET /search?q=texto&limit=N (autenticado)\n"
+                " GET /export (autenticado; CSV)\n"
+                " GET /top?k=N (autenticado; links mais acessados)\n"
+                " GET /qr/{code}.png|svg (público; ?scale=N pixels por módulo no PNG)\n"
+                " GET /get/{code} (autenticado; inclui links arquivados)\n"
                 " GET /stats/{code} (autenticado)\n"
+                " GET /metrics (autenticado)\n"
+                " GET /events (autenticado; Server-Sent Events com deltas de hits)\n"
                 " GET /{code} (público)\n"
             )
 
-        # Lista exige login
-        if path == "list":
+        if path == "metrics":
             if not self.require_auth_api():
                 return
-            data = list_all()
-            lines = []
-            for e in data:
-                if e["type"] == "single":
-                    lines.append(f"{e['code']} -> {e['url']} (hits: {e['hits']})")
-                else:
-                    parts = [f"{t['url']} [w={t['weight']} hits={t['hits']}]" for t in e["targets"]]
-                    lines.append(f"{e['code']} -> MULTI: {', '.join(parts)} (total hits: {e['hits']})")
+            return self.send_json(json.dumps(metrics_snapshot(), default=str))
+
+        if path == "events":
+            user = self.require_auth_api()
+            if not user:
+                return
+            return self.stream_events(user["id"])
+
+        # Lista exige login (só os links do usuário)
+        if path == "list":
+            user = self.require_auth_api()
+            if not user:
+                return
+            lines = format_list_lines(list_all(user["id"]))
             return self.respond_text("\n".join(lines) if lines else "Sem links ainda.")
 
+        # GET /search?q=texto&limit=N (autenticado; código, URL ou destino)
+        if path == "search":
+            user = self.require_auth_api()
+            if not user:
+                return
+            params = urllib.parse.parse_qs(parsed.query)
+            q = (params.get("q") or [""])[0].strip()
+            if not q:
+                return self.respond_text("Uso: /search?q=texto", status=400)
+            try:
+                limit = min(1000, max(1, int((params.get("limit") or ["100"])[0])))
+            except ValueError:
+                return self.respond_text("Erro: 'limit' deve ser inteiro.", status=400)
+            lines = format_list_lines(search_links(user["id"], q, limit))
+            return self.respond_text("\n".join(lines) if lines else "Nenhum link encontrado.")
+
+        # GET /qr/{code}.png|svg (público; ?scale=N para o PNG)
+        if path.startswith("qr/"):
+            name, _, fmt = path[3:].rpartition(".")
+            if fmt not in ("png", "svg") or not name:
+                return self.respond_text("Uso: /qr/{code}.png ou /qr/{code}.svg", status=400)
+            try:
+                scale = int((urllib.parse.parse_qs(parsed.query).get("scale") or [str(QR_SCALE)])[0])
+            except ValueError:
+                return self.respond_text("Erro: 'scale' deve ser inteiro.", status=400)
+            scale = min(40, max(1, scale)) if fmt == "png" else 1
+            if not link_exists(name):
+                return self.respond_text("Código não encontrado.", status=404)
+            url = f"{qr_short_base(self)}/{name}"
+            tag = QRCache.etag(url, fmt, scale)
+            if tag in [t.strip() for t in self.headers.get("If-None-Match", "").split(",")]:
+                self.send_response(304)
+                self.send_header("ETag", tag)
+                self.end_headers()
+                return
+            tag, body = QR_CACHE.get(url, fmt, scale)
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png" if fmt == "png" else "image/svg+xml")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", tag)
+            self.send_header("Cache-Control", f"public, max-age={QR_MAX_AGE}")
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        # GET /top?k=N (autenticado; links do usuário mais acessados, estimativa deste processo)
+        if path == "top":
+            user = self.require_auth_api()
+            if not user:
+                return
+            try:
+                k = min(TOPK_CAPACITY, max(1, int((urllib.parse.parse_qs(parsed.query).get("k") or ["10"])[0])))
+            except ValueError:
+                return self.respond_text("Erro: 'k' deve ser inteiro.", status=400)
+            ranked = TOP_LINKS.top(TOPK_CAPACITY)
+            owners = link_owners([entry["code"] for entry in ranked]) if ranked else {}
+            mine = [entry for entry in ranked if owners.get(entry["code"]) == user["id"]][:k]
+            return self.send_json(json.dumps({"top": mine}))
+
+        # GET /export (autenticado; CSV com um destino por linha)
+        if path == "export":
+            user = self.require_auth_api()
+            if not user:
+                return
+            return self.stream_export(user["id"])
+
         # GET /get/{code} (autenticado)
         if path.startswith("get/"):
-            if not self.require_auth_api():
+            user = self.require_auth_api()
+            if not user:
                 return
             code = path.split("/", 1)[1] if "/" in path else ""
             if not code:
                 return self.respond_text("Uso: /get/{code}", status=400)
-            entry = get_entry(code)
+            entry = get_entry(code, user["id"])
             if not entry:
                 return self.respond_text("Código não encontrado.", status=404)
             raw = json.dumps({"code": code, **entry}, ensure_ascii=False, default=str)
@@ -969,21 +4183,29 @@ class ShortenerHandler(http.server.SimpleHTTPRequestHandler):
 
         # GET /stats/{code} (autenticado)
         if path.startswith("stats/"):
-            if not self.require_auth_api():
+            user = self.require_auth_api()
+            if not user:
                 return
             code = path.split("/", 1)[1] if "/" in path else ""
             if not code:
                 return self.respond_text("Uso: /stats/{code}", status=400)
-            entry = get_entry(code)
+            entry = get_entry(code, user["id"])
             if not entry:
                 return self.respond_text("Código não encontrado.", status=404)
+            validity = ""
+            if entry["expires_at"]:
+                validity += f"Expira em: {entry['expires_at']}\n"
+            if entry.get("archived_at"):
+                validity += f"Arquivado em: {entry['archived_at']}\n"
             if entry["type"] == "single":
                 text = (
                     f"Código: {code}\n"
                     f"Tipo: SINGLE\n"
                     f"URL: {entry['url']}\n"
                     f"Hits: {entry['hits']}\n"
+                    f"Cache: {'max-age=' + str(entry['cache_max_age']) if entry['cache_max_age'] else 'desligado'}\n"
                     f"Criado em: {entry['created_at']}\n"
+                    f"{validity}"
                 )
                 return self.respond_text(text)
             else:
@@ -991,6 +4213,7 @@ class ShortenerHandler(http.server.SimpleHTTPRequestHandler):
                     f"Código: {code}",
                     "Tipo: MULTI",
                     f"Criado em: {entry['created_at']}",
+                    *validity.splitlines(),
                     f"Total hits: {entry['hits']}",
                     "Destinos:"
                 ]
@@ -1001,19 +4224,92 @@ class ShortenerHandler(http.server.SimpleHTTPRequestHandler):
                 return self.respond_text("\n".join(lines))
 
         # Redirecionamento público
-        target = pick_target_and_count(path)
+        if link_gone(path):
+            return self.respond_text("Link expirado.", status=410)
+        bot = bot_kind(self.headers.get("User-Agent", "")) if BOT_FILTER else None
+        visitor = {}  # chave e origem, preenchidas só se o link resolvido for "sticky"
+
+        def visitor_key():
+            if not visitor:
+                visitor["key"], visitor["from_cookie"] = self.visitor_key()
+            return visitor["key"]
+
+        vk = None if bot else visitor_key
+        code = path
+        target, max_age, n = pick_target_and_count(code, visitor=vk, query=parsed.query, count=not bot)
+        if target is None:
+            wildcard = WILDCARDS.match(path)
+            if wildcard is None and "/" in path and probe_wildcards():
+                wildcard = WILDCARDS.match(path)
+            if wildcard is not None:
+                code, rest, forward = wildcard
+                target, max_age, n = pick_target_and_count(code, visitor=vk, query=parsed.query, rest=rest,
+                                                           count=not bot, forward=forward)
+        self.log_target = target
         if target is None:
             return self.respond_text("Código não encontrado.", status=404)
         if target == "ERR_NO_TARGETS":
             return self.respond_text("Configuração inválida para MULTI (sem targets).", status=500)
+        if target == "ERR_GONE":
+            return self.respond_text("Link expirado.", status=410)
+        if bot:
+            record_bot(bot)
+        elif n:  # só o que foi somado em urls.hits (SINGLE cacheável é amostrado)
+            HIT_FEED.record(code, target, n)
+            TOP_LINKS.record(code, n)
+        if max_age is not None:
+            # SINGLE cacheável: CDN/navegador absorvem os cliques repetidos (sem cookie na resposta)
+            self.send_response(CACHE_REDIRECT_STATUS)
+            self.send_header("Location", target)
+            self.send_header("Cache-Control", f"public, max-age={max_age}")
+            self.end_headers()
+            return
         self.send_response(302)
         self.send_header("Location", target)
         self.send_header("Cache-Control", "no-store, no-cache, must-revalidate, max-age=0")
         self.send_header("Pragma", "no-cache")
+        if visitor and not visitor["from_cookie"]:
+            # fixa a chave derivada de IP+UA para o visitante continuar no mesmo destino se o IP mudar
+            self.set_visitor_cookie(visitor["key"])
         self.end_headers()
 
+    def stream_events(self, owner_id):
+        """GET /events: mantém a conexão aberta enviando as janelas do HIT_FEED e heartbeats."""
+        sub = HIT_FEED.subscribe(owner_id)
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("X-Accel-Buffering", "no")  # proxies (nginx) não devem segurar o stream
+            self.end_headers()
+            self.wfile.write(b"retry: 3000\n\n")
+            self.wfile.flush()
+            while True:
+                try:
+                    msg = sub.get(timeout=EVENTS_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    msg = b": ping\n\n"
+                if msg is None:
+                    return
+                self.wfile.write(msg)
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError, TimeoutError):
+            pass
+        finally:
+            HIT_FEED.unsubscribe(sub)
+
+    def stream_export(self, owner_id):
+        f, size = export_csv(owner_id)  # conexão já devolvida daqui em diante
+        with f:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/csv; charset=utf-8")
+            self.send_header("Content-Disposition", 'attachment; filename="links.csv"')
+            self.send_header("Content-Length", str(size))
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile, 64 * 1024)
+
     # -------------------- POST --------------------
-    def do_POST(self):
+    def handle_post(self):
         parsed = urllib.parse.urlparse(self.path)
         path = parsed.path.lstrip("/")
 
@@ -1033,14 +4329,14 @@ class ShortenerHandler(http.server.SimpleHTTPRequestHandler):
             if not user or not pwd:
                 return self.respond_text("Usuário e senha obrigatórios.", status=400)
 
+            # Usa a função hash_password definida no topo do arquivo (antes do checkout: PBKDF2 é lento)
+            salt_hex, hash_hex = hash_password(pwd)
             with DB_POOL.connection() as conn:
                 with conn.cursor(row_factory=dict_row) as cur:
                     cur.execute("SELECT 1 FROM users WHERE username=%s;", (user,))
                     if cur.fetchone():
                         return self.respond_text("Usuário já existe.", status=409)
 
-                    # Usa a função hash_password definida no topo do arquivo
-                    salt_hex, hash_hex = hash_password(pwd)
                     cur.execute(
                         "INSERT INTO users(username, password_salt, password_hash) VALUES (%s,%s,%s);",
                         (user, salt_hex, hash_hex)
@@ -1058,14 +4354,14 @@ class ShortenerHandler(http.server.SimpleHTTPRequestHandler):
                 with conn.cursor(row_factory=dict_row) as cur:
                     cur.execute("SELECT id, username, password_salt, password_hash FROM users WHERE username = %s;", (user,))
                     u = cur.fetchone()
-                    if not u or not verify_password(pwd, u["password_salt"], u["password_hash"]):
-                        return self.respond_text("Login inválido.", status=403)
-                    # ok: cria sessão
-                    token = new_session(u["id"], self.client_address[0] if self.client_address else None, self.headers.get("User-Agent"))
-                    # atualiza last_login
-                    with conn.cursor() as cur2:
-                        cur2.execute("UPDATE users SET last_login_at = NOW() WHERE id = %s;", (u["id"],))
-                    conn.commit()
+            # PBKDF2 sem segurar conexão: o pool "auth" é pequeno e fica livre durante o hash
+            if not u or not verify_password(pwd, u["password_salt"], u["password_hash"]):
+                return self.respond_text("Login inválido.", status=403)
+            # ok: cria sessão
+            token = new_session(u["id"], self.client_address[0] if self.client_address else None, self.headers.get("User-Agent"))
+            # atualiza last_login
+            with DB_POOL.connection() as conn:
+                conn.execute("UPDATE users SET last_login_at = NOW() WHERE id = %s;", (u["id"],))
             self.send_response(200)
             self.set_session_cookie(token)
             self.end_headers()
@@ -1082,17 +4378,36 @@ class ShortenerHandler(http.server.SimpleHTTPRequestHandler):
             return
 
         # ---- Demais endpoints exigem auth ----
-        if path in {"new", "update", "delete"}:
-            if not self.require_auth_api():
+        if path in {"new", "update", "delete", "bulk/targets"}:
+            owner = self.require_auth_api()
+            if not owner:
                 return
 
         if path == "new":
             urls = payload.get("urls", [])
             weights = payload.get("weights", [])
             custom_code = payload.get("code", None)
+            distribution = payload.get("distribution", "random")
+            cache_max_age = payload.get("cache_max_age", None)
+            forward_path = payload.get("forward_path", False)
+            template = payload.get("template", False)
 
+            if distribution not in DISTRIBUTIONS:
+                return self.respond_text(f"Erro: 'distribution' deve ser um de: {', '.join(DISTRIBUTIONS)}.", status=400)
+            if not valid_cache_max_age(cache_max_age):
+                return self.respond_text(f"Erro: 'cache_max_age' deve ser inteiro entre 1 e {CACHE_MAX_AGE_LIMIT} (ou null).", status=400)
+            try:
+                expires_at = parse_expires_at(payload.get("expires_at", None))
+            except ValueError as e:
+                return self.respond_text(str(e), status=400)
+            if expires_at is not None and expires_at <= datetime.now(timezone.utc):
+                return self.respond_text("Erro: 'expires_at' deve estar no futuro.", status=400)
+            if not isinstance(forward_path, bool):
+                return self.respond_text("Erro: 'forward_path' deve ser true/false.", status=400)
+            if not isinstance(template, bool):
+                return self.respond_text("Erro: 'template' deve ser true/false.", status=400)
             if custom_code is not None and (not isinstance(custom_code, str) or not validate_slug_path(custom_code)):
-                return self.respond_text("Erro: 'code' inválido. Use letras/números/hífen por segmento (1–32), separados por '/'.", status=400)
+                return self.respond_text("Erro: 'code' inválido. Use letras/números/hífen por segmento (1–32), separados por '/' (último pode ser '*').", status=400)
             if not urls or not isinstance(urls, list):
                 return self.respond_text("Erro: 'urls' deve ser lista com ao menos 1 item.", status=400)
             urls = [u.strip() for u in urls if isinstance(u, str) and u.strip()]
@@ -1100,6 +4415,8 @@ class ShortenerHandler(http.server.SimpleHTTPRequestHandler):
                 return self.respond_text("Erro: nenhuma URL válida em 'urls'.", status=400)
             if not all(is_http_url(u) for u in urls):
                 return self.respond_text("Erro: todas as URLs devem começar com http:// ou https://", status=400)
+            if template and not all(valid_destination_template(u) for u in urls):
+                return self.respond_text(TEMPLATE_ERROR, status=400)
             try:
                 wtmp = [float(w) for w in weights] if weights else [1.0] * len(urls)
                 weights = [(0.0 if (isinstance(w, float) and w < 0) else (w if isinstance(w, float) else 1.0)) for w in wtmp]
@@ -1110,11 +4427,14 @@ class ShortenerHandler(http.server.SimpleHTTPRequestHandler):
             if custom_code and custom_code in RESERVED:
                 return self.respond_text("Erro: slug reservado. Escolha outro nome.", status=400)
             try:
-                code = create_short(urls, weights, custom_code)
+                code = create_short(urls, weights, custom_code, distribution, cache_max_age, expires_at, forward_path,
+                                    owner_id=owner["id"], template=template)
                 short = f"{build_short_base(self)}/{code}"
                 return self.respond_text(short)
             except ValueError as e:
                 return self.respond_text(str(e), status=409)
+            except OVERLOAD_ERRORS:
+                raise
             except Exception as e:
                 return self.respond_text(f"Erro ao criar link: {e}", status=500)
 
@@ -1123,9 +4443,27 @@ class ShortenerHandler(http.server.SimpleHTTPRequestHandler):
             new_code = payload.get("new_code", None)
             urls = payload.get("urls", [])
             weights = payload.get("weights", [])
+            distribution = payload.get("distribution", None)
+            cache_max_age = payload.get("cache_max_age", _KEEP)
+            forward_path = payload.get("forward_path", _KEEP)
+            template = payload.get("template", _KEEP)
 
             if not code or not isinstance(code, str):
                 return self.respond_text("Erro: 'code' é obrigatório.", status=400)
+            if distribution is not None and distribution not in DISTRIBUTIONS:
+                return self.respond_text(f"Erro: 'distribution' deve ser um de: {', '.join(DISTRIBUTIONS)}.", status=400)
+            if cache_max_age is not _KEEP and not valid_cache_max_age(cache_max_age):
+                return self.respond_text(f"Erro: 'cache_max_age' deve ser inteiro entre 1 e {CACHE_MAX_AGE_LIMIT} (ou null).", status=400)
+            if forward_path is not _KEEP and not isinstance(forward_path, bool):
+                return self.respond_text("Erro: 'forward_path' deve ser true/false.", status=400)
+            if template is not _KEEP and not isinstance(template, bool):
+                return self.respond_text("Erro: 'template' deve ser true/false.", status=400)
+            expires_at = _KEEP
+            if "expires_at" in payload:
+                try:
+                    expires_at = parse_expires_at(payload["expires_at"])
+                except ValueError as e:
+                    return self.respond_text(str(e), status=400)
             if new_code is not None and (not isinstance(new_code, str) or not validate_slug_path(new_code)):
                 return self.respond_text("Erro: 'new_code' inválido.", status=400)
             if not urls or not isinstance(urls, list):
@@ -1135,6 +4473,8 @@ class ShortenerHandler(http.server.SimpleHTTPRequestHandler):
                 return self.respond_text("Erro: nenhuma URL válida em 'urls'.", status=400)
             if not all(is_http_url(u) for u in urls):
                 return self.respond_text("Erro: todas as URLs devem começar com http:// ou https://", status=400)
+            if template is True and not all(valid_destination_template(u) for u in urls):
+                return self.respond_text(TEMPLATE_ERROR, status=400)
             try:
                 wtmp = [float(w) for w in weights] if weights else [1.0] * len(urls)
                 weights = [(0.0 if (isinstance(w, float) and w < 0) else (w if isinstance(w, float) else 1.0)) for w in wtmp]
@@ -1145,13 +4485,16 @@ class ShortenerHandler(http.server.SimpleHTTPRequestHandler):
             if new_code and new_code in RESERVED:
                 return self.respond_text("Erro: slug reservado.", status=400)
             try:
-                code2 = update_short(code, new_code, urls, weights)
+                code2 = update_short(code, new_code, urls, weights, distribution, cache_max_age, expires_at, forward_path,
+                                     owner_id=owner["id"], template=template)
                 if not code2:
                     return self.respond_text("Código não encontrado.", status=404)
                 short = f"{build_short_base(self)}/{code2}"
                 return self.respond_text(short)
             except ValueError as e:
-                return self.respond_text(str(e), status=409)
+                return self.respond_text(str(e), status=400 if str(e) == TEMPLATE_ERROR else 409)
+            except OVERLOAD_ERRORS:
+                raise
             except Exception as e:
                 return self.respond_text(f"Erro ao atualizar link: {e}", status=500)
 
@@ -1160,19 +4503,99 @@ class ShortenerHandler(http.server.SimpleHTTPRequestHandler):
             if not code or not isinstance(code, str):
                 return self.respond_text("Erro: 'code' é obrigatório.", status=400)
             try:
-                delete_short(code)
+                if not delete_short(code, owner["id"]):
+                    return self.respond_text("Código não encontrado.", status=404)
                 return self.respond_text(f"Excluído: {code}")
+            except OVERLOAD_ERRORS:
+                raise
             except Exception as e:
                 return self.respond_text(f"Erro ao excluir: {e}", status=500)
 
+        if path == "bulk/targets":
+            action = payload.get("action")
+            url = payload.get("url", None)
+            phone = payload.get("phone", None)
+            new_url = payload.get("new_url", None)
+            new_phone = payload.get("new_phone", None)
+            weight = payload.get("weight", None)
+
+            if action not in BULK_ACTIONS:
+                return self.respond_text(f"Erro: 'action' deve ser um de: {', '.join(BULK_ACTIONS)}.", status=400)
+            if (url is None) == (phone is None):
+                return self.respond_text("Erro: informe 'url' ou 'phone' (um dos dois).", status=400)
+            if url is not None and not is_http_url(url):
+                return self.respond_text("Erro: 'url' deve começar com http:// ou https://", status=400)
+            if phone is not None:
+                phone = normalize_phone(phone)
+                if not phone:
+                    return self.respond_text("Erro: 'phone' deve ter de 8 a 15 dígitos (com DDI).", status=400)
+            if action == "replace":
+                if url is not None and not is_http_url(new_url):
+                    return self.respond_text("Erro: 'new_url' deve começar com http:// ou https://", status=400)
+                if url is not None and not valid_destination_template(new_url):
+                    return self.respond_text(TEMPLATE_ERROR, status=400)
+                if phone is not None:
+                    new_phone = normalize_phone(new_phone)
+                    if not new_phone:
+                        return self.respond_text("Erro: 'new_phone' deve ter de 8 a 15 dígitos (com DDI).", status=400)
+            if weight is not None or action == "reweight":
+                try:
+                    weight = max(0.0, float(weight))
+                except (TypeError, ValueError):
+                    return self.respond_text("Erro: 'weight' deve ser número.", status=400)
+            try:
+                result = bulk_targets(owner["id"], action, url, phone, new_url, new_phone, weight)
+                return self.send_json(json.dumps(result, ensure_ascii=False))
+            except OVERLOAD_ERRORS:
+                raise
+            except Exception as e:
+                return self.respond_text(f"Erro na alteração em massa: {e}", status=500)
+
         return self.respond_text("Endpoint POST não encontrado.", status=404)
 
 # -------------------- Run --------------------
 def run():
-    ensure_schema()
-    with ThreadingTCPServer((HOST, PORT), ShortenerHandler) as httpd:
+    global SERVER
+    if not DATABASE_URL:
+        raise RuntimeError("DATABASE_URL não definido nas variáveis de ambiente.")
+    for route, concurrency in ADMISSION_CONCURRENCY.items():
+        if route not in DB_POOL_BRIEF_ROUTES and DB_POOL_SIZES.get(route, 0) < concurrency:
+            raise RuntimeError(
+                f"DB_POOL_SIZES[{route}]={DB_POOL_SIZES.get(route, 0):g} menor que ADMISSION_CONCURRENCY"
+                f"[{route}]={concurrency:g}: requisições admitidas ficariam esperando conexão."
+            )
+    if CACHE_REDIRECT_STATUS not in (301, 308):
+        raise RuntimeError(f"CACHE_REDIRECT_STATUS deve ser 301 ou 308 (recebido: {CACHE_REDIRECT_STATUS}).")
+    if MIGRATE_ON_START == "blocking":
+        ensure_schema()
+    elif MIGRATE_ON_START != "off":
+        threading.Thread(target=ensure_schema, name="migrations", daemon=True).start()
+    DB_POOL.open()  # abre os pools em background enquanto o socket já aceita conexões
+    ACCESS_LOGGER.start()
+    HIT_FEED.start()
+    if HIT_SPOOL is not None:
+        HIT_SPOOL.start()
+    if ARCHIVE_INTERVAL_SECONDS > 0:
+        threading.Thread(target=_archiver_loop, name="archiver", daemon=True).start()
+    threading.Thread(target=probe_wildcards, name="wildcards-probe", daemon=True).start()
+    if TOPK_STATE_PATH:
+        load_topk_state(TOPK_STATE_PATH)  # o primeiro ciclo do _topk_loop já fixa e aquece esses links
+    threading.Thread(target=_topk_loop, name="topk", daemon=True).start()
+    with ShortenerServer((HOST, PORT), ShortenerHandler) as httpd:
+        SERVER = httpd
         print(f"Servidor rodando em http://{HOST}:{PORT}")
         httpd.serve_forever()
 
 if __name__ == "__main__":
-    run()
+    if len(sys.argv) > 2 and sys.argv[1] == "import-cdn-log":
+        # python shortner.py import-cdn-log access.log [access2.log.gz ...]
+        for log_path in sys.argv[2:]:
+            import_cdn_log(log_path)
+    elif len(sys.argv) > 1 and sys.argv[1] == "export-index":
+        # python shortner.py export-index [ARQUIVO]   (padrão: LINK_INDEX_PATH)
+        index_path = sys.argv[2] if len(sys.argv) > 2 else LINK_INDEX_PATH
+        if not index_path:
+            sys.exit("Informe o arquivo do índice ou defina LINK_INDEX_PATH.")
+        export_link_index(index_path)
+    else:
+        run()
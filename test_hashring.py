@@ -0,0 +1,49 @@
+"""
+Regressão do roteamento fixo (HashRing): a divisão do tráfego segue os pesos, também acima
+do teto de pontos por destino, e mudar um peso move só parte dos visitantes.
+"""
+import pytest
+
+import shortner
+
+KEYS = [f"visitante-{i}" for i in range(20000)]
+
+
+def _targets(*weights):
+    return [{"url": f"https://d{i}.example/", "weight": w} for i, w in enumerate(weights)]
+
+
+def _split(ring, n):
+    counts = [0] * n
+    for key in KEYS:
+        counts[ring.lookup(key)] += 1
+    return [c / len(KEYS) for c in counts]
+
+
+@pytest.mark.parametrize("weights", [(5, 3, 2), (50, 30, 20), (500, 300, 200), (1, 1, 1, 1)])
+def test_split_follows_weights(weights):
+    split = _split(shortner.HashRing(_targets(*weights)), len(weights))
+    total = sum(weights)
+    for share, w in zip(split, weights):
+        assert share == pytest.approx(w / total, abs=0.04)
+
+
+def test_vnodes_proportional_under_cap():
+    ring = shortner.HashRing(_targets(50, 30, 20))
+    counts = [ring.owners.count(i) for i in range(3)]
+    assert max(counts) <= shortner.STICKY_MAX_VNODES
+    assert counts[0] / counts[2] == pytest.approx(2.5, rel=0.01)
+    assert counts[1] / counts[2] == pytest.approx(1.5, rel=0.01)
+
+
+def test_zero_weight_never_chosen():
+    assert _split(shortner.HashRing(_targets(3, 0, 1)), 3)[1] == 0
+
+
+def test_reweight_moves_only_part_of_the_keys():
+    before = shortner.HashRing(_targets(5, 3, 2))
+    after = shortner.HashRing(_targets(5, 3, 4))
+    moved = [k for k in KEYS if before.lookup(k) != after.lookup(k)]
+    # só o destino que ganhou peso recebe visitantes; os demais ficam onde estavam
+    assert all(after.lookup(k) == 2 for k in moved)
+    assert 0 < len(moved) / len(KEYS) < 0.25
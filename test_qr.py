@@ -0,0 +1,112 @@
+"""
+Regressão do codificador de QR code: matrizes de referência (conferidas com um codificador
+independente, máscara a máscara) para algumas versões. Rode com `python -m pytest test_qr.py`.
+"""
+import hashlib
+import os
+import types
+
+import pytest
+
+import shortner
+
+# Tamanho do texto que enche exatamente a versão (modo byte, nível M).
+CAPACITY = {1: 14, 2: 26, 7: 122, 10: 213, 25: 997, 40: 2331}
+
+# sha256 (16 primeiros hex) da matriz em linhas de "#"/".", por versão e máscara 0..7.
+MATRIX_SHA = {
+    1: ("c68d0349f56527ae", "22c602750f578cff", "d910392c4ca5610c", "d1c2b3ffbb0ac702", "91177fa737084c9a", "5121a107b63aafd5", "0454b9fecbe3dd14", "8672485f0318b383"),
+    2: ("c2a61ae9a814008b", "daec801850187005", "6fae993d0b08f71a", "3e4fb69584d60467", "a3e02f30939a7804", "2a95955ff09d469f", "1193148031c36aa4", "cc5fc780dc87f747"),
+    7: ("1eb7de5ee5a6e7bd", "1118ac1a068bba91", "43394a0c9420ac4a", "618d1ee1ba7d6cc7", "05e57005854e3201", "cec99b8d49c62f3f", "90bc8b280fcc5636", "3a105c44c1982c2a"),
+    10: ("8402822d69cf6c21", "393f8d0dda3bdc3e", "153eeadce9b4af2d", "c755600151390915", "834e5424a49176c9", "82d97111b13ca670", "0b1a6de50bb7b259", "ea16a2fa06a6d3d6"),
+    25: ("261b4b662440aeed", "f6b0e8b157363025", "f649bda5dca2fca2", "2ab948ad68651e1e", "dfbb3ffdadd7b794", "b82af8042b181953", "b79dce183f954a26", "6fb47d3cacb54005"),
+    40: ("6521ea04b8ff8da5", "c0213110e8996fde", "3f8aa0682dedbcb6", "01ed9e5e0e46f0e2", "154e50e2aec656f7", "bfc6f893bae7365f", "956781ed9740f098", "e52fe3996202eeb4"),
+}
+
+# Máscara escolhida pela penalidade para cada texto de CAPACITY.
+AUTO_MASK = {1: 2, 2: 2, 7: 0, 10: 0, 25: 0, 40: 0}
+
+# Versão 1, máscara 0, "http://s.rt/xx".
+V1_MASK0 = (
+    "#######..#.#..#######",
+    "#.....#.####..#.....#",
+    "#.###.#..#....#.###.#",
+    "#.###.#....##.#.###.#",
+    "#.###.#.###.#.#.###.#",
+    "#.....#....#..#.....#",
+    "#######.#.#.#.#######",
+    "...........#.........",
+    "#.#.#.#...#.....#..#.",
+    ".#...#.#.##.##..#...#",
+    ".##...##..####.##.###",
+    ".......##..#.#..#..#.",
+    "#..#..#.##.....#.#...",
+    "........#...#.###..##",
+    "#######...###...#.###",
+    "#.....#..#..#...#..##",
+    "#.###.#.##.#.#.#.#.#.",
+    "#.###.#...####.###.#.",
+    "#.###.#.##..#...#.#.#",
+    "#.....#....#...###.#.",
+    "#######.#.####...#.##",
+)
+
+
+def _text(version: int, extra: int = 0) -> str:
+    return "http://s.rt/" + "x" * (CAPACITY[version] - 12 + extra)
+
+
+def _rows(matrix) -> list:
+    return ["".join("#" if c else "." for c in row) for row in matrix]
+
+
+def _sha(matrix) -> str:
+    return hashlib.sha256("\n".join(_rows(matrix)).encode()).hexdigest()[:16]
+
+
+def test_version1_full_matrix():
+    assert _rows(shortner.qr_matrix(_text(1), 0)) == list(V1_MASK0)
+
+
+@pytest.mark.parametrize("version", sorted(MATRIX_SHA))
+@pytest.mark.parametrize("mask", range(8))
+def test_known_matrices(version, mask):
+    matrix = shortner.qr_matrix(_text(version), mask)
+    assert len(matrix) == len(matrix[0]) == version * 4 + 17
+    assert _sha(matrix) == MATRIX_SHA[version][mask]
+
+
+@pytest.mark.parametrize("version", sorted(AUTO_MASK))
+def test_auto_mask(version):
+    text = _text(version)
+    assert shortner.qr_matrix(text) == shortner.qr_matrix(text, AUTO_MASK[version])
+
+
+@pytest.mark.parametrize("version", [1, 2, 7, 10, 25])
+def test_version_boundary(version):
+    assert len(shortner.qr_matrix(_text(version, 1))) > version * 4 + 17
+
+
+def test_too_long():
+    with pytest.raises(ValueError):
+        shortner.qr_matrix(_text(40, 1))
+
+
+def test_short_base_ignores_unknown_host(monkeypatch):
+    handler = types.SimpleNamespace(headers={"Host": "evil.example"})
+    monkeypatch.setattr(shortner, "QR_PUBLIC_BASE", "")
+    monkeypatch.setattr(shortner, "QR_ALLOWED_HOSTS", {"sho.rt"})
+    assert shortner.qr_short_base(handler) == f"http://{shortner.HOST}:{shortner.PORT}"
+    handler.headers["Host"] = "SHO.RT"
+    assert shortner.qr_short_base(handler).endswith("://sho.rt")
+    monkeypatch.setattr(shortner, "QR_PUBLIC_BASE", "https://l.example")
+    assert shortner.qr_short_base(handler) == "https://l.example"
+
+
+def test_disk_cache_is_capped(tmp_path):
+    cache = shortner.QRCache(0, str(tmp_path), dir_max_bytes=4096)
+    for i in range(40):
+        cache.get(f"http://s.rt/{i}", "svg", 1)
+    total = sum(os.path.getsize(p) for p in tmp_path.iterdir())
+    assert total <= 4096
+    assert cache.stats()["evicted"] > 0